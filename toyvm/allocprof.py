@@ -0,0 +1,203 @@
+"""
+Allocation profiler: count the W_ objects allocated by each code site.
+
+While an AllocProfiler is active, the constructors of the object model are
+patched to record each new object, together with the site which allocated
+it: the (code, pc) of the innermost toy frame which is running (Frame and
+its subclasses, RegFrame) or of the op which RainbowInterpreter is pevaling.
+Objects allocated outside of any toy frame are attributed to code None.
+When no profiler is active, the constructors are the original ones, so the
+cost is zero.
+
+The bytes are approximate: the shallow size of the object, plus the str
+payload of flat W_Strs and the list of W_Tuples.
+
+    with AllocProfiler() as prof:
+        w_func.call(...)
+    print(prof.report(10))
+
+Since a run compiles its own code objects, the results of two different
+runs are compared by code name, see diff().
+"""
+
+import sys
+from toyvm.objects import (W_Int, W_Str, W_Tuple, W_TupleIterator,
+                           W_Function, Closure)
+
+# the profiler which records the allocations, if any
+current = None
+
+CLASSES = (W_Int, W_Str, W_Tuple, W_TupleIterator, W_Function, Closure)
+
+# code object of an executor method -> function which takes its f_locals and
+# returns (code, pc). Filled lazily, to avoid circular imports.
+SITE_GETTERS = {}
+
+# cls -> original __init__, while the constructors are patched
+_originals = {}
+
+
+def _init_site_getters():
+    from toyvm.frame import Frame, FastFrame
+    from toyvm.packed import PackedFrame
+    from toyvm.regvm import RegFrame
+    from toyvm.rainbow import RainbowInterpreter
+    from_self = lambda f_locals: (f_locals['self'].code, f_locals['self'].pc)
+    # RegFrame.run() doesn't have a pc yet when it dispatches to
+    # run_metered() or run_counting()
+    from_local = lambda f_locals: (f_locals['self'].code,
+                                   f_locals.get('pc', -1))
+    for meth in [Frame.run, Frame.resume, FastFrame.run, PackedFrame.run,
+                 PackedFrame.resume]:
+        SITE_GETTERS[meth.__code__] = from_self
+    for meth in [RegFrame.run, RegFrame.run_counting, RegFrame.run_metered,
+                 RegFrame.resume, RainbowInterpreter.run_single_op]:
+        SITE_GETTERS[meth.__code__] = from_local
+
+def get_site(depth=2):
+    """
+    Return the (code, pc) which is being executed by the innermost toy frame
+    """
+    f = sys._getframe(depth)
+    while f is not None:
+        getter = SITE_GETTERS.get(f.f_code)
+        if getter is not None:
+            return getter(f.f_locals)
+        f = f.f_back
+    return None, -1
+
+def sizeof(w_obj):
+    size = sys.getsizeof(w_obj)
+    if type(w_obj) is W_Str and w_obj._value is not None:
+        size += sys.getsizeof(w_obj._value)
+    elif type(w_obj) is W_Tuple:
+        size += sys.getsizeof(w_obj.items_w)
+    return size
+
+
+def _patch(cls):
+    orig = cls.__dict__['__init__']
+    def __init__(self, *args, **kwargs):
+        orig(self, *args, **kwargs)
+        if current is not None:
+            current.record(self)
+    __init__.__qualname__ = orig.__qualname__
+    _originals[cls] = orig
+    cls.__init__ = __init__
+
+def install():
+    if not SITE_GETTERS:
+        _init_site_getters()
+    for cls in CLASSES:
+        _patch(cls)
+    # W_Str._lazy bypasses __init__
+    orig_lazy = W_Str.__dict__['_lazy']
+    def _lazy(*args, **kwargs):
+        w_res = orig_lazy.__func__(*args, **kwargs)
+        if current is not None:
+            current.record(w_res)
+        return w_res
+    _originals['_lazy'] = orig_lazy
+    W_Str._lazy = staticmethod(_lazy)
+
+def uninstall():
+    W_Str._lazy = _originals.pop('_lazy')
+    for cls in CLASSES:
+        cls.__init__ = _originals.pop(cls)
+
+
+class AllocProfiler:
+
+    def __init__(self):
+        # (code, pc, typename) -> [count, bytes]. It also keeps the codes
+        # alive, so that their ids are not reused.
+        self.sites = {}
+        self.prev = None
+
+    def __enter__(self):
+        global current
+        if not _originals:
+            install()
+        self.prev = current
+        current = self
+        return self
+
+    def __exit__(self, etype, evalue, tb):
+        global current
+        current = self.prev
+        self.prev = None
+        if current is None:
+            uninstall()
+
+    def record(self, w_obj):
+        code, pc = get_site(depth=3)
+        key = (code, pc, type(w_obj).__name__)
+        entry = self.sites.get(key)
+        if entry is None:
+            entry = self.sites[key] = [0, 0]
+        entry[0] += 1
+        entry[1] += sizeof(w_obj)
+
+    def stats(self):
+        """
+        Return a dict {(code name, pc, typename): (count, bytes)}.
+
+        Codes with the same name are merged.
+        """
+        res = {}
+        for (code, pc, typename), (count, nbytes) in self.sites.items():
+            name = code.name if code is not None else '<host>'
+            key = (name, pc, typename)
+            count0, nbytes0 = res.get(key, (0, 0))
+            res[key] = (count0 + count, nbytes0 + nbytes)
+        return res
+
+    def total(self):
+        count = sum(entry[0] for entry in self.sites.values())
+        nbytes = sum(entry[1] for entry in self.sites.values())
+        return count, nbytes
+
+    def top(self, n=10):
+        """
+        Return the n sites which allocate more bytes, as a list of
+        ((code name, pc, typename), count, bytes)
+        """
+        items = [(key, count, nbytes)
+                 for key, (count, nbytes) in self.stats().items()]
+        items.sort(key=lambda item: (-item[2], -item[1], item[0]))
+        return items[:n]
+
+    def report(self, n=10):
+        count, nbytes = self.total()
+        lines = [f'{count} objects, {nbytes} bytes',
+                 '%-20s %5s %-16s %10s %10s' % ('code', 'pc', 'type',
+                                                'count', 'bytes')]
+        for (name, pc, typename), count, nbytes in self.top(n):
+            lines.append('%-20s %5d %-16s %10d %10d' % (name, pc, typename,
+                                                        count, nbytes))
+        return '\n'.join(lines)
+
+
+def diff(before, after, n=10):
+    """
+    Compare two profiles, and return the n sites whose bytes changed the
+    most, as a list of ((code name, pc, typename), delta count, delta bytes)
+    """
+    stats_a = before.stats()
+    stats_b = after.stats()
+    items = []
+    for key in stats_a.keys() | stats_b.keys():
+        count_a, nbytes_a = stats_a.get(key, (0, 0))
+        count_b, nbytes_b = stats_b.get(key, (0, 0))
+        if (count_a, nbytes_a) != (count_b, nbytes_b):
+            items.append((key, count_b - count_a, nbytes_b - nbytes_a))
+    items.sort(key=lambda item: (-abs(item[2]), -abs(item[1]), item[0]))
+    return items[:n]
+
+def diff_report(before, after, n=10):
+    lines = ['%-20s %5s %-16s %10s %10s' % ('code', 'pc', 'type',
+                                            'count', 'bytes')]
+    for (name, pc, typename), dcount, dbytes in diff(before, after, n):
+        lines.append('%-20s %5d %-16s %+10d %+10d' % (name, pc, typename,
+                                                      dcount, dbytes))
+    return '\n'.join(lines)
@@ -0,0 +1,90 @@
+"""
+AST-level optimizations, done by toy_compile before codegen.
+
+ConstantFolder evaluates the operations whose operands are all constants,
+and removes the branches of the 'if's whose condition is a constant. This
+way, the code run by the plain interpreter is smaller and faster, without
+the need of peval.
+
+The folding must give exactly the same result as the runtime: we fold only
+the combinations of types which are supported by Frame (e.g. str * int but
+not int * str), and leave the others alone, so that they fail at runtime as
+they did before. To avoid bloating the code objects, we don't fold
+operations whose result is too large (e.g. "x" * 1000000).
+"""
+
+import ast
+
+MAX_STR_LENGTH = 256
+MAX_INT_BITS = 128
+
+
+def optimize(tree):
+    tree = ConstantFolder().visit(tree)
+    return ast.fix_missing_locations(tree)
+
+
+def is_const(node, *types):
+    # bools are ints, and the runtime treats them as such
+    return isinstance(node, ast.Constant) and isinstance(node.value, types)
+
+def is_small(value):
+    if isinstance(value, str):
+        return len(value) <= MAX_STR_LENGTH
+    return value.bit_length() <= MAX_INT_BITS
+
+
+class ConstantFolder(ast.NodeTransformer):
+
+    def make_const(self, node, value):
+        if not is_small(value):
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        a = node.left
+        b = node.right
+        op = node.op.__class__.__name__
+        if op == 'Add':
+            if is_const(a, int) and is_const(b, int):
+                return self.make_const(node, a.value + b.value)
+            if is_const(a, str) and is_const(b, str):
+                return self.make_const(node, a.value + b.value)
+        elif op == 'Mult':
+            if is_const(a, int) and is_const(b, int):
+                return self.make_const(node, a.value * b.value)
+            if is_const(a, str) and is_const(b, int):
+                n = max(b.value, 0)
+                if len(a.value) * n > MAX_STR_LENGTH:
+                    return node # don't even compute it
+                return self.make_const(node, a.value * n)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) != 1:
+            return node
+        a = node.left
+        b = node.comparators[0]
+        op = node.ops[0].__class__.__name__
+        if op not in ('Lt', 'Gt'):
+            return node
+        if ((is_const(a, int) and is_const(b, int)) or
+            (is_const(a, str) and is_const(b, str))):
+            if op == 'Lt':
+                return self.make_const(node, a.value < b.value)
+            else:
+                return self.make_const(node, a.value > b.value)
+        return node
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        if is_const(node.test, int):
+            # br_if accepts only ints: for other types, let it fail at
+            # runtime
+            if node.test.value:
+                return node.body
+            else:
+                return node.orelse
+        return node
@@ -0,0 +1,7 @@
+"""
+Performance benchmarks for toyvm.
+
+Run them with:
+
+    python -m toyvm.benchmarks [--baseline FILE] [--output FILE]
+"""
@@ -0,0 +1,4 @@
+import sys
+from toyvm.benchmarks.runner import main
+
+sys.exit(main())
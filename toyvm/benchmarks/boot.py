@@ -0,0 +1,73 @@
+"""
+Measure the boot time from a heap image, compared to booting from source.
+
+Booting from source means compiling all the modules and pevaling all their
+functions. The modules are the ones of the benchmark suite plus a large
+synthetic one (see toyvm.benchmarks.parallel).
+
+    python -m toyvm.benchmarks.boot [--funcs N]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+from toyvm.compiler import toy_compile
+from toyvm.parallel import peval_module
+from toyvm.snapshot import save_image, load_image
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks import parallel
+
+
+def get_sources(n_funcs):
+    sources = {bench.name: bench.get_src(bench.size) for bench in BENCHMARKS}
+    sources['synthetic'] = parallel.make_source(n_funcs)
+    return sources
+
+def boot_from_source(sources):
+    modules = {}
+    for name, src in sources.items():
+        w_mod = toy_compile(src)
+        peval_module(w_mod)
+        modules[name] = w_mod
+    return modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--funcs', type=int, default=300)
+    args = parser.parse_args(argv)
+    sources = get_sources(args.funcs)
+    #
+    a = time.perf_counter()
+    modules = boot_from_source(sources)
+    b = time.perf_counter()
+    t_source = b - a
+    #
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'boot.img')
+        a = time.perf_counter()
+        save_image(filename, modules)
+        b = time.perf_counter()
+        t_save = b - a
+        size = os.path.getsize(filename)
+        results = []
+        for use_mmap in (False, True):
+            a = time.perf_counter()
+            load_image(filename, use_mmap=use_mmap)
+            b = time.perf_counter()
+            results.append(b - a)
+    t_read, t_mmap = results
+    #
+    print(f'{len(sources)} modules, image size: {size/1024:.0f} KiB '
+          f'(saved in {t_save:.3f}s)')
+    print('%-20s %10s %8s' % ('boot', 'time (s)', 'speedup'))
+    for name, t in [('from source', t_source),
+                    ('from image (read)', t_read),
+                    ('from image (mmap)', t_mmap)]:
+        print('%-20s %10.3f %7.1fx' % (name, t, t_source / t))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,44 @@
+"""
+Measure the effect of the binding-time analysis on peval.
+
+Each benchmark is compiled with and without infer_green, then pevaled. We
+report the number of ops folded by peval, the size of its output and the
+execution time of the result.
+
+    python -m toyvm.benchmarks.bta
+"""
+
+import sys
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval_with_stats
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks.metering import timeit
+
+
+def measure(bench, *, infer_green, size=None, repeat=5):
+    """
+    Return (ops folded, ops emitted, time)
+    """
+    if size is None:
+        size = bench.size
+    w_mod = toy_compile(bench.get_src(size), infer_green=infer_green)
+    w_func, stats = peval_with_stats(w_mod.globals_w[bench.entry])
+    args_w = bench.make_args(size)
+    t = timeit(lambda: w_func.call(*args_w), repeat)
+    return stats.ops_folded, len(w_func.code.body), t
+
+
+def main(argv=None):
+    print('%-16s %14s %14s %16s %8s' % (
+        'benchmark', 'folded', 'ops', 'ms', 'speedup'))
+    for bench in BENCHMARKS:
+        folded1, ops1, t1 = measure(bench, infer_green=False)
+        folded2, ops2, t2 = measure(bench, infer_green=True)
+        print('%-16s %6d -> %4d %6d -> %4d %6.2f -> %6.2f %7.2fx' % (
+            bench.name, folded1, folded2, ops1, ops2, t1*1000, t2*1000,
+            t1/t2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""
+Measure the effect of the typed locals on a numeric kernel.
+
+The benchmark is compiled with and without typed_locals. Without them, each
+assignment to h and count boxes the result of the fixed-width op into a new
+W_Int. We report the number of W_Ints allocated by a call, and its execution
+time.
+
+    python -m toyvm.benchmarks.intops
+"""
+
+import sys
+from toyvm.allocprof import AllocProfiler
+from toyvm.compiler import toy_compile
+from toyvm.benchmarks.programs import INT_KERNEL
+from toyvm.benchmarks.runner import MODES
+from toyvm.benchmarks.metering import timeit
+
+
+def measure(bench, mode, *, typed_locals, size=None, repeat=5):
+    """
+    Return (W_Ints allocated, time)
+    """
+    if size is None:
+        size = bench.size
+    w_mod = toy_compile(bench.get_src(size), typed_locals=typed_locals)
+    w_func = MODES[mode](w_mod.globals_w[bench.entry])
+    args_w = bench.make_args(size)
+    with AllocProfiler() as prof:
+        w_func.call(*args_w)
+    n_ints = sum(count for (_, _, typename), (count, _)
+                 in prof.stats().items() if typename == 'W_Int')
+    t = timeit(lambda: w_func.call(*args_w), repeat)
+    return n_ints, t
+
+
+def main(argv=None):
+    print('%-16s %18s %16s %8s' % ('mode', 'W_Ints', 'ms', 'speedup'))
+    for mode in MODES:
+        n1, t1 = measure(INT_KERNEL, mode, typed_locals=False)
+        n2, t2 = measure(INT_KERNEL, mode, typed_locals=True)
+        print('%-16s %8d -> %6d %6.2f -> %6.2f %7.2fx' % (
+            mode, n1, n2, t1*1000, t2*1000, t1/t2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+Measure the effect of loop-invariant code motion on nested loops.
+
+For each benchmark with nested loops, we run the output of the compiler and
+of peval, with and without licm, and report the time per iteration of the
+inner loop. OSR is disabled, so that Frame keeps running the code we give
+to it.
+
+    python -m toyvm.benchmarks.licm
+"""
+
+import sys
+from toyvm import osr
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.benchmarks.programs import NESTED_LOOPS, LOOP_INVARIANTS
+from toyvm.benchmarks.runner import hoisted
+from toyvm.benchmarks.metering import timeit
+
+# these benchmarks run size*size iterations of the inner loop
+NESTED_BENCHMARKS = [NESTED_LOOPS, LOOP_INVARIANTS]
+
+
+def measure(bench, *, use_peval, size=None, repeat=5):
+    """
+    Return (ns per iteration without licm, ns per iteration with licm)
+    """
+    if size is None:
+        size = bench.size
+    w_func = toy_compile(bench.get_src(size)).globals_w[bench.entry]
+    if use_peval:
+        w_func = peval(w_func)
+    w_licm = hoisted(w_func)
+    args_w = bench.make_args(size)
+    old_threshold = osr.THRESHOLD
+    osr.THRESHOLD = float('inf')
+    try:
+        assert w_func.call(*args_w) == w_licm.call(*args_w)
+        t1 = timeit(lambda: w_func.call(*args_w), repeat)
+        t2 = timeit(lambda: w_licm.call(*args_w), repeat)
+    finally:
+        osr.THRESHOLD = old_threshold
+    n = size * size
+    return t1 / n * 1e9, t2 / n * 1e9
+
+
+def main(argv=None):
+    print('%-16s %-10s %12s %12s %8s' % (
+        'benchmark', 'input', 'ns/iter', 'licm ns/iter', 'speedup'))
+    for bench in NESTED_BENCHMARKS:
+        for use_peval in (False, True):
+            t1, t2 = measure(bench, use_peval=use_peval)
+            print('%-16s %-10s %12.1f %12.1f %7.2fx' % (
+                bench.name, 'peval' if use_peval else 'compiler', t1, t2,
+                t1/t2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Measure the memory used by the object model.
+
+For each class we allocate many instances and measure the bytes per
+instance with tracemalloc. To compare with the old layout, we also measure
+an equivalent class which stores its fields in a per-instance __dict__.
+Finally, we measure the bytes per opcode of the output of peval on a large
+UNROLL.
+
+    python -m toyvm.benchmarks.memory
+"""
+
+import sys
+import gc
+import tracemalloc
+from toyvm.opcode import OpCode
+from toyvm.objects import W_Int, W_Str, W_Tuple
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.packed import pack
+from toyvm.benchmarks.programs import LARGE_UNROLL
+
+N = 10000
+
+
+def make_dict_class(cls, fields):
+    """
+    Make a class with the same fields as cls, but stored in the __dict__:
+    this is how instances were laid out before using __slots__
+    """
+    def __init__(self, *args):
+        for name, value in zip(fields, args):
+            setattr(self, name, value)
+    return type(f'Dict{cls.__name__}', (), {'__init__': __init__})
+
+
+def bytes_per_instance(factory, n=N):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        objs = [factory(i) for i in range(n)]
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # don't count the list which holds the objects
+    return (after - before - sys.getsizeof(objs)) / n
+
+
+# name -> (class, fields, factory): the factory takes a class and an index.
+# Make sure that the objects referenced by the fields are allocated in the
+# same way for the slotted and the dict-based case.
+CASES = {
+    'OpCode': (OpCode, ('name', 'args'),
+               lambda cls, i: cls('load_local', 'a', i)),
+    'W_Int': (W_Int, ('value',), lambda cls, i: cls(10**6 + i)),
+    'W_Str': (W_Str, ('value',), lambda cls, i: cls('hello')),
+    'W_Tuple': (W_Tuple, ('items_w',), lambda cls, i: cls(())),
+}
+
+
+def measure_classes():
+    results = {}
+    for name, (cls, fields, factory) in CASES.items():
+        dict_cls = make_dict_class(cls, fields)
+        if cls is OpCode:
+            # OpCode takes *args, and packs them into a tuple
+            make_dict_obj = lambda i: dict_cls('load_local', ('a', i))
+        else:
+            make_dict_obj = lambda i: factory(dict_cls, i)
+        slotted = bytes_per_instance(lambda i: factory(cls, i))
+        dict_based = bytes_per_instance(make_dict_obj)
+        results[name] = (dict_based, slotted)
+    return results
+
+
+def measure_peval(size=2000):
+    src = LARGE_UNROLL.get_src(size)
+    w_func = toy_compile(src).globals_w['main']
+    gc.collect()
+    tracemalloc.start()
+    try:
+        w_func2 = peval(w_func)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    n = len(w_func2.code.body)
+    return n, current / n, peak
+
+
+def measure_packed(size=2000):
+    """
+    Return the bytes per op of the list and of the packed encoding of the
+    output of peval. Only the ops are measured: the W_ objects used as
+    constants are shared by the two forms.
+    """
+    src = LARGE_UNROLL.get_src(size)
+    w_func = peval(toy_compile(src).globals_w['main'])
+    code = w_func.code
+    n = len(code.body)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        body = [op.copy() for op in code.body]
+        middle, _ = tracemalloc.get_traced_memory()
+        packed = pack(code)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return n, (middle - before) / n, (after - middle) / n
+
+
+def main(argv=None):
+    print('%-10s %14s %14s' % ('class', '__dict__ (B)', '__slots__ (B)'))
+    for name, (dict_based, slotted) in measure_classes().items():
+        print('%-10s %14.1f %14.1f' % (name, dict_based, slotted))
+    print()
+    n, per_op, peak = measure_peval()
+    print(f'peval of {LARGE_UNROLL.name}: {n} ops, '
+          f'{per_op:.1f} bytes/op retained, peak {peak/1024:.1f} KiB')
+    n, list_per_op, packed_per_op = measure_packed()
+    print(f'encoding of the same {n} ops: list {list_per_op:.1f} bytes/op, '
+          f'packed {packed_per_op:.1f} bytes/op')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
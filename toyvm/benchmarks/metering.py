@@ -0,0 +1,56 @@
+"""
+Measure the overhead of fuel metering.
+
+Each benchmark is run without metering and with a Fuel large enough to
+never run out, in all the compilation modes.
+
+    python -m toyvm.benchmarks.metering
+"""
+
+import sys
+import time
+from toyvm.compiler import toy_compile
+from toyvm.fuel import Fuel
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks.runner import MODES, NAME_WIDTH, MODE_WIDTH
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for i in range(repeat):
+        a = time.perf_counter()
+        fn()
+        b = time.perf_counter()
+        best = min(best, b-a)
+    return best
+
+
+def measure(bench, mode, *, size=None, repeat=5):
+    if size is None:
+        size = bench.size
+    w_mod = toy_compile(bench.get_src(size))
+    w_func = MODES[mode](w_mod.globals_w[bench.entry])
+    args_w = bench.make_args(size)
+    w_func.call(*args_w) # warmup, e.g. for quickening
+    t_off = timeit(lambda: w_func.call(*args_w), repeat)
+    t_on = timeit(lambda: w_func.call(*args_w, fuel=Fuel(sys.maxsize)),
+                  repeat)
+    fuel = Fuel(sys.maxsize)
+    w_func.call(*args_w, fuel=fuel)
+    return t_off, t_on, fuel.consumed
+
+
+def main(argv=None):
+    print('%-*s %-*s %12s %12s %9s %12s' % (
+        NAME_WIDTH, 'benchmark', MODE_WIDTH, 'mode', 'off (ms)', 'on (ms)', 'overhead', 'fuel used'))
+    for bench in BENCHMARKS:
+        for mode in MODES:
+            t_off, t_on, consumed = measure(bench, mode)
+            print('%-*s %-*s %12.3f %12.3f %8.1f%% %12d' % (
+                NAME_WIDTH, bench.name, MODE_WIDTH, mode, t_off*1000, t_on*1000,
+                (t_on/t_off - 1) * 100, consumed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
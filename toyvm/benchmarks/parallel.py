@@ -0,0 +1,90 @@
+"""
+Measure the wall-clock speedup of peval_module with a pool of processes.
+
+The synthetic module contains many functions which unroll a loop over a
+green table. Half of them also fold a reference to another function of the
+module, so that peval_module needs more than one wave.
+
+    python -m toyvm.benchmarks.parallel [--funcs N] [--workers N ...]
+"""
+
+import os
+import time
+import argparse
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int
+from toyvm.parallel import peval_module
+
+
+def make_source(n_funcs, table_size=30):
+    table = ', '.join(str(i) for i in range(table_size))
+    lines = [
+        '@green',
+        'def TABLE():',
+        f'    return ({table},)',
+        '',
+    ]
+    for i in range(n_funcs):
+        lines += [
+            f'def f{i}(x):',
+            f'    for K in UNROLL(TABLE()):',
+            f'        if K < {i % table_size}:',
+            f'            x = x + K * {i}',
+            f'        else:',
+            f'            x = x * 1',
+            f'    return x',
+            '',
+        ]
+        if i % 2 == 1:
+            # f{i} -> F{i} is folded into g{i}
+            lines += [
+                '@green',
+                f'def F{i}():',
+                f'    return (f{i},)',
+                '',
+                f'def g{i}(x):',
+                f'    for F in UNROLL(F{i}()):',
+                f'        x = F(x)',
+                f'    return x',
+                '',
+            ]
+    return '\n'.join(lines)
+
+
+def measure(n_funcs, workers):
+    """
+    Return (wall-clock time in seconds, checksum of the results)
+    """
+    w_mod = toy_compile(make_source(n_funcs))
+    a = time.perf_counter()
+    peval_module(w_mod, workers=workers)
+    b = time.perf_counter()
+    checksum = 0
+    for name, w_func in w_mod.globals_w.items():
+        if not w_func.is_green:
+            checksum += w_func.call(W_Int(1)).value
+    return b-a, checksum
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--funcs', type=int, default=300)
+    parser.add_argument('--workers', type=int, nargs='*')
+    args = parser.parse_args(argv)
+    workers = args.workers or sorted({1, 2, 4, os.cpu_count() or 1})
+    print(f'{args.funcs} functions, {os.cpu_count()} CPUs')
+    print('%-8s %10s %8s' % ('workers', 'time (s)', 'speedup'))
+    t_seq = None
+    checksums = set()
+    for n in workers:
+        t, checksum = measure(args.funcs, n)
+        checksums.add(checksum)
+        if t_seq is None:
+            t_seq = t
+        print('%-8d %10.3f %7.2fx' % (n, t, t_seq / t))
+    assert len(checksums) == 1, 'the results differ'
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,245 @@
+"""
+A collection of representative toy programs to benchmark.
+
+Each benchmark has an entry point called 'main' and a function which builds
+the arguments to pass to it, given a size parameter.
+"""
+
+from dataclasses import dataclass
+from typing import Callable
+from toyvm.objects import W_Int, W_Str, W_Tuple
+
+
+@dataclass
+class Benchmark:
+    name: str
+    src: str
+    make_args: Callable    # size -> list of W_Objects
+    size: int              # default size
+    entry: str = 'main'
+
+    def get_src(self, size):
+        return self.src
+
+
+def w_ints(n):
+    return W_Tuple([W_Int(i) for i in range(n)])
+
+
+FIB = Benchmark(
+    name = 'fib',
+    src = """
+    def main(n):
+        return fib(0, n)
+
+    # tree-recursive fibonacci: we don't have subtraction, so we count up
+    # from 0 to n instead
+    def fib(i, n):
+        if n < i + 2:
+            return 1
+        return fib(i + 1, n) + fib(i + 2, n)
+    """,
+    make_args = lambda size: [W_Int(size)],
+    size = 15,
+)
+
+NESTED_LOOPS = Benchmark(
+    name = 'nested_loops',
+    src = """
+    def main(rows, cols):
+        total = 0
+        for r in rows:
+            for c in cols:
+                total = total + r * c
+        return total
+    """,
+    make_args = lambda size: [w_ints(size), w_ints(size)],
+    size = 60,
+)
+
+# like NESTED_LOOPS, but part of the computation doesn't depend on the
+# inner loop variable, or on any loop variable at all
+LOOP_INVARIANTS = Benchmark(
+    name = 'loop_invariants',
+    src = """
+    def main(rows, cols, scale):
+        total = 0
+        for r in rows:
+            for c in cols:
+                total = total + c * (r * scale + 1) + scale * (scale + 3)
+        return total
+    """,
+    make_args = lambda size: [w_ints(size), w_ints(size), W_Int(3)],
+    size = 60,
+)
+
+STRING_BUILDING = Benchmark(
+    name = 'string_building',
+    src = """
+    def main(items):
+        out = ""
+        for x in items:
+            out = out + x + ","
+        return out
+    """,
+    make_args = lambda size: [W_Tuple([W_Str(str(i)) for i in range(size)])],
+    size = 2000,
+)
+
+CLOSURES = Benchmark(
+    name = 'closures',
+    src = """
+    def main(items):
+        total = 0
+        for x in items:
+            total = total + make_adder(3)(x)
+        return total
+
+    @green
+    def make_adder(X):
+        def add(y):
+            return X + y
+        return add
+    """,
+    make_args = lambda size: [w_ints(size)],
+    size = 1000,
+)
+
+CONST_EXPRS = Benchmark(
+    name = 'const_exprs',
+    src = """
+    def main(items):
+        total = 0
+        for x in items:
+            if 2 < 1:
+                print("debug:", x)
+            total = total + x * (60 * 60 * 24) + 7 * 3
+        return total
+    """,
+    make_args = lambda size: [w_ints(size)],
+    size = 2000,
+)
+
+# the same computation as CONST_EXPRS, but the constants are in lowercase
+# locals: peval folds them only with toy_compile(..., infer_green=True)
+UNTAGGED_CONSTS = Benchmark(
+    name = 'untagged_consts',
+    src = """
+    @green
+    def seconds_per_day():
+        return 60 * 60 * 24
+
+    def main(items):
+        day = seconds_per_day()
+        week = day * 7
+        offset = week + 3
+        total = 0
+        for x in items:
+            total = total + x * (week + offset)
+        return total
+    """,
+    make_args = lambda size: [w_ints(size)],
+    size = 2000,
+)
+
+# the same closure is called with different constant arguments: peval
+# specializes it for each call site
+CALL_SPECIALIZATION = Benchmark(
+    name = 'call_specialization',
+    src = """
+    @green
+    def make_op():
+        def apply(x, op, k):
+            if op:
+                return x * k
+            return x + k
+        return apply
+
+    def main(items):
+        APPLY = make_op()
+        total = 0
+        for x in items:
+            total = total + APPLY(x, 1, 3) + APPLY(x, 0, 5)
+        return total
+    """,
+    make_args = lambda size: [w_ints(size)],
+    size = 2000,
+)
+
+# the same subexpression is computed many times, in the same block and in
+# the blocks dominated by it: peval leaves it as it is, see toyvm.ssa
+COMMON_SUBEXPRS = Benchmark(
+    name = 'common_subexprs',
+    src = """
+    def main(items, k):
+        total = 0
+        for x in items:
+            if x * k < 1000:
+                total = total + (x * k + 1) * (x * k + 1)
+            else:
+                total = total + x * k
+        return total
+    """,
+    make_args = lambda size: [w_ints(size), W_Int(3)],
+    size = 2000,
+)
+
+# a hash over the items with fixed-width integer ops: with the typed locals,
+# the loop doesn't allocate any W_Int, see toyvm.intops
+INT_KERNEL = Benchmark(
+    name = 'int_kernel',
+    src = """
+    def main(items):
+        h = 2166136261
+        count = 0
+        for x in items:
+            h = __i32_mul__(__i32_xor__(h, x), 16777619)
+            h = __i32_xor__(h, __i32_shr__(h, 15))
+            if __i32_lt__(__i32_and__(h, 255), 100):
+                count = __i64_add__(count, 1)
+        return (h, count)
+    """,
+    make_args = lambda size: [w_ints(size)],
+    size = 2000,
+)
+
+
+@dataclass
+class UnrollBenchmark(Benchmark):
+    """
+    The size of the UNROLLed tuple is part of the source code
+    """
+
+    def get_src(self, size):
+        items = ', '.join(map(str, range(size)))
+        return self.src.replace('ITEMS', items)
+
+
+LARGE_UNROLL = UnrollBenchmark(
+    name = 'large_unroll',
+    src = """
+    def main(a):
+        TUP = (ITEMS,)
+        total = a
+        for X in UNROLL(TUP):
+            total = total + X * a
+        return total
+    """,
+    make_args = lambda size: [W_Int(3)],
+    size = 300,
+)
+
+
+BENCHMARKS = [
+    FIB,
+    NESTED_LOOPS,
+    LOOP_INVARIANTS,
+    STRING_BUILDING,
+    CLOSURES,
+    CONST_EXPRS,
+    UNTAGGED_CONSTS,
+    CALL_SPECIALIZATION,
+    COMMON_SUBEXPRS,
+    INT_KERNEL,
+    LARGE_UNROLL,
+]
@@ -0,0 +1,78 @@
+"""
+Compare the register-based executor against the stack-based one.
+
+For each benchmark, all the non-green functions of the module are run
+either by Frame (the stack executor) or translated by toyvm.regvm, both for
+the output of the compiler and for the output of peval. We report the
+number of dispatched instructions and the execution time. OSR is disabled,
+so that Frame keeps running the code we give to it.
+
+    python -m toyvm.benchmarks.regvm
+"""
+
+import sys
+from toyvm import osr
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Function
+from toyvm.trace import TraceRecorder
+from toyvm.regvm import translate, count_insns
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks.metering import timeit
+from toyvm.benchmarks.runner import NAME_WIDTH
+
+
+def prepare(bench, size, *, use_peval, use_regvm):
+    w_mod = toy_compile(bench.get_src(size))
+    globals_w = w_mod.globals_w
+    for name, w_func in list(globals_w.items()):
+        if w_func.is_green:
+            continue
+        if use_peval:
+            w_func = peval(w_func)
+        if use_regvm:
+            w_func = W_Function(w_func.name, translate(w_func.code),
+                                w_func.closure)
+        globals_w[name] = w_func
+    return globals_w[bench.entry]
+
+def measure(bench, *, size=None, use_peval=False, repeat=5):
+    """
+    Return (stack insns, stack time, register insns, register time)
+    """
+    if size is None:
+        size = bench.size
+    args_w = bench.make_args(size)
+    old_threshold = osr.THRESHOLD
+    osr.THRESHOLD = float('inf')
+    try:
+        w_stack = prepare(bench, size, use_peval=use_peval, use_regvm=False)
+        w_reg = prepare(bench, size, use_peval=use_peval, use_regvm=True)
+        assert w_stack.call(*args_w) == w_reg.call(*args_w)
+        with TraceRecorder(1) as rec:
+            w_stack.call(*args_w)
+        with count_insns() as c:
+            w_reg.call(*args_w)
+        t_stack = timeit(lambda: w_stack.call(*args_w), repeat)
+        t_reg = timeit(lambda: w_reg.call(*args_w), repeat)
+    finally:
+        osr.THRESHOLD = old_threshold
+    return rec.count, t_stack, c.count, t_reg
+
+
+def main(argv=None):
+    print('%-*s %-10s %10s %10s %10s %10s %8s' % (
+        NAME_WIDTH, 'benchmark', 'input', 'stack ops', 'reg ops',
+        'stack ms', 'reg ms', 'speedup'))
+    for bench in BENCHMARKS:
+        for use_peval in (False, True):
+            n_stack, t_stack, n_reg, t_reg = measure(bench,
+                                                     use_peval=use_peval)
+            print('%-*s %-10s %10d %10d %10.2f %10.2f %7.2fx' % (
+                NAME_WIDTH, bench.name, 'peval' if use_peval else 'compiler',
+                n_stack, n_reg, t_stack*1000, t_reg*1000, t_stack/t_reg))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
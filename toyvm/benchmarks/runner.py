@@ -0,0 +1,212 @@
+"""
+Run the benchmarks in all compilation modes, store the results as JSON and
+compare them against a saved baseline.
+"""
+
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Function
+from toyvm.packed import pack
+from toyvm.regvm import translate
+from toyvm.licm import licm
+from toyvm.ssa import optimize
+from toyvm.benchmarks.programs import BENCHMARKS
+
+def packed(w_func):
+    return W_Function(w_func.name, pack(w_func.code), w_func.closure)
+
+def regvm(w_func):
+    return W_Function(w_func.name, translate(w_func.code), w_func.closure)
+
+def hoisted(w_func):
+    return W_Function(w_func.name, licm(w_func.code), w_func.closure)
+
+def optimized(w_func):
+    return W_Function(w_func.name, optimize(w_func.code), w_func.closure)
+
+# mode name -> function which takes a W_Function and returns the W_Function
+# to execute. New backends can be benchmarked by adding an entry here.
+MODES = {
+    'interp': lambda w_func: w_func,
+    'rainbow': peval,
+    'packed': packed,
+    'regvm': regvm,
+    'rainbow_regvm': lambda w_func: regvm(peval(w_func)),
+    'rainbow_licm': lambda w_func: hoisted(peval(w_func)),
+    'rainbow_ssa': lambda w_func: optimized(peval(w_func)),
+}
+
+# width of the benchmark and mode columns in the reports
+NAME_WIDTH = max(len(bench.name) for bench in BENCHMARKS)
+MODE_WIDTH = max(len(mode) for mode in MODES)
+
+TIME_METRICS = ('compile_time', 'peval_time', 'exec_time')
+METRICS = TIME_METRICS + ('peak_memory',)
+
+
+def measure(bench, mode, *, size=None, repeat=3):
+    """
+    Measure a single benchmark in the given mode.
+
+    Return a dict containing all the METRICS: times are in seconds, memory
+    is in bytes.
+    """
+    if size is None:
+        size = bench.size
+    src = bench.get_src(size)
+    prepare = MODES[mode]
+    args_w = bench.make_args(size)
+    #
+    a = time.perf_counter()
+    w_mod = toy_compile(src)
+    b = time.perf_counter()
+    w_func = prepare(w_mod.globals_w[bench.entry])
+    c = time.perf_counter()
+    #
+    exec_time = float('inf')
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        w_res = w_func.call(*args_w)
+        t1 = time.perf_counter()
+        exec_time = min(exec_time, t1-t0)
+    #
+    # measure memory in a separate run, because tracemalloc slows down
+    # everything
+    gc.collect()
+    tracemalloc.start()
+    try:
+        w_mod = toy_compile(src)
+        w_func = prepare(w_mod.globals_w[bench.entry])
+        w_func.call(*args_w)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    #
+    return {
+        'result': w_res.str(),
+        'compile_time': b-a,
+        'peval_time': c-b,
+        'exec_time': exec_time,
+        'peak_memory': peak_memory,
+    }
+
+
+def run_all(*, benchmarks=BENCHMARKS, modes=None, size_factor=1.0,
+            repeat=3, log=None):
+    if modes is None:
+        modes = list(MODES)
+    results = {}
+    for bench in benchmarks:
+        size = max(1, int(bench.size * size_factor))
+        for mode in modes:
+            if log:
+                log(f'{bench.name} [{mode}]...')
+            res = measure(bench, mode, size=size, repeat=repeat)
+            results.setdefault(bench.name, {})[mode] = res
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'size_factor': size_factor,
+        },
+        'benchmarks': results,
+    }
+
+
+def compare(results, baseline, *, threshold=1.10, min_time=1e-4):
+    """
+    Compare two sets of results. Return a list of human-readable strings,
+    one for each metric which is worse than the baseline by more than the
+    given threshold.
+
+    Times smaller than min_time are too noisy to be meaningful and are
+    ignored.
+    """
+    regressions = []
+    for name, modes in results['benchmarks'].items():
+        for mode, res in modes.items():
+            base = baseline['benchmarks'].get(name, {}).get(mode)
+            if base is None:
+                continue
+            for metric in METRICS:
+                old = base[metric]
+                new = res[metric]
+                if metric in TIME_METRICS and new < min_time:
+                    continue
+                if old > 0 and new > old * threshold:
+                    regressions.append(
+                        f'{name} [{mode}] {metric}: '
+                        f'{old:.6g} -> {new:.6g} ({new/old:.2f}x)')
+    return regressions
+
+
+def format_results(results):
+    lines = []
+    # the results might come from a file, with names which we don't know
+    benchmarks = results['benchmarks']
+    name_width = max([len('benchmark')] + [len(name) for name in benchmarks])
+    mode_width = max([len('mode')] + [len(mode)
+                                      for modes in benchmarks.values()
+                                      for mode in modes])
+    header = '%-*s %-*s %12s %12s %12s %12s' % (
+        name_width, 'benchmark', mode_width, 'mode', 'compile (ms)',
+        'peval (ms)', 'exec (ms)', 'peak (KiB)')
+    lines.append(header)
+    lines.append('-' * len(header))
+    for name, modes in benchmarks.items():
+        for mode, res in modes.items():
+            lines.append('%-*s %-*s %12.3f %12.3f %12.3f %12.1f' % (
+                name_width, name, mode_width, mode,
+                res['compile_time'] * 1000,
+                res['peval_time'] * 1000,
+                res['exec_time'] * 1000,
+                res['peak_memory'] / 1024))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the toyvm benchmarks')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare against this JSON file')
+    parser.add_argument('-m', '--mode', action='append', choices=list(MODES),
+                        help='run only the given mode(s)')
+    parser.add_argument('-k', dest='names', action='append',
+                        help='run only the given benchmark(s)')
+    parser.add_argument('--size-factor', type=float, default=1.0,
+                        help='scale the size of all the benchmarks')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=1.10,
+                        help='regression threshold, as a ratio (default: 1.10)')
+    args = parser.parse_args(argv)
+    #
+    benchmarks = BENCHMARKS
+    if args.names:
+        benchmarks = [b for b in BENCHMARKS if b.name in args.names]
+    log = lambda msg: print(msg, file=sys.stderr)
+    results = run_all(benchmarks=benchmarks, modes=args.mode,
+                      size_factor=args.size_factor, repeat=args.repeat,
+                      log=log)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, threshold=args.threshold)
+        print()
+        if regressions:
+            print('REGRESSIONS:')
+            for line in regressions:
+                print('  ' + line)
+            return 1
+        else:
+            print('No regressions')
+    return 0
@@ -0,0 +1,78 @@
+"""
+Measure latency and fairness of the cooperative scheduler.
+
+We run a mix of a few long toy invocations and many short ones, first
+serialized (one after the other, in spawn order) and then interleaved by
+the Scheduler. With serialization, short tasks queued behind a long one
+pay for its whole execution time.
+
+    python -m toyvm.benchmarks.scheduling
+"""
+
+import time
+import argparse
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int
+from toyvm.scheduler import Scheduler
+from toyvm.benchmarks.programs import FIB
+
+
+def make_workload(n_short, n_long, short_size, long_size):
+    w_mod = toy_compile(FIB.src)
+    w_main = w_mod.globals_w['main']
+    workload = []
+    for i in range(n_long):
+        workload.append((w_main, [W_Int(long_size)]))
+    for i in range(n_short):
+        workload.append((w_main, [W_Int(short_size)]))
+    return workload
+
+
+def run_serialized(workload):
+    t_spawn = time.perf_counter()
+    latencies = []
+    for w_func, args_w in workload:
+        w_func.call(*args_w)
+        latencies.append(time.perf_counter() - t_spawn)
+    return latencies
+
+
+def run_scheduled(workload, slice_steps):
+    sched = Scheduler(slice_steps=slice_steps)
+    tasks = [sched.spawn(w_func, *args_w) for w_func, args_w in workload]
+    sched.run()
+    return [task.latency for task in tasks], sched.stats()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--short', type=int, default=50)
+    parser.add_argument('--long', type=int, default=2)
+    parser.add_argument('--slice-steps', type=int, default=200)
+    args = parser.parse_args(argv)
+    workload = make_workload(args.short, args.long, short_size=5,
+                             long_size=18)
+    n_long = args.long
+    #
+    serial = run_serialized(workload)
+    sched, stats = run_scheduled(workload, args.slice_steps)
+    #
+    def mean(xs):
+        return sum(xs) / len(xs) * 1000
+    print(f'{args.long} long tasks, {args.short} short tasks, '
+          f'slice = {args.slice_steps} ops')
+    print()
+    print('%-12s %18s %18s' % ('', 'short latency (ms)', 'long latency (ms)'))
+    print('%-12s %18.3f %18.3f' % ('serialized', mean(serial[n_long:]),
+                                   mean(serial[:n_long])))
+    print('%-12s %18.3f %18.3f' % ('scheduled', mean(sched[n_long:]),
+                                   mean(sched[:n_long])))
+    print()
+    print(f'fairness (Jain index of cpu time per slice): '
+          f'{stats["fairness"]:.3f}')
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Measure how much the SSA passes shrink the output of peval.
+
+For each benchmark, the output of peval is converted to SSA and lowered
+back to bytecode, without passes, with cse and with gvn. We report the size
+of the code in each case, and the execution time before and after gvn.
+OSR is disabled, so that Frame keeps running the code we give to it.
+
+    python -m toyvm.benchmarks.ssa
+"""
+
+import sys
+from toyvm import osr
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Function
+from toyvm.ssa import optimize, cse, gvn
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks.metering import timeit
+
+
+def measure(bench, *, size=None, repeat=5):
+    """
+    Return (peval ops, lowered ops, cse ops, gvn ops, peval time, gvn time)
+    """
+    if size is None:
+        size = bench.size
+    w_func = peval(toy_compile(bench.get_src(size)).globals_w[bench.entry])
+    sizes = [len(w_func.code.body)]
+    for passes in [(), (cse,), (gvn,)]:
+        code = optimize(w_func.code, passes)
+        sizes.append(len(code.body))
+    w_opt = W_Function(w_func.name, code, w_func.closure)
+    args_w = bench.make_args(size)
+    old_threshold = osr.THRESHOLD
+    osr.THRESHOLD = float('inf')
+    try:
+        assert w_func.call(*args_w) == w_opt.call(*args_w)
+        t1 = timeit(lambda: w_func.call(*args_w), repeat)
+        t2 = timeit(lambda: w_opt.call(*args_w), repeat)
+    finally:
+        osr.THRESHOLD = old_threshold
+    return (*sizes, t1, t2)
+
+
+def main(argv=None):
+    print('%-20s %6s %6s %6s %6s %10s %10s %8s' % (
+        'benchmark', 'peval', 'ssa', 'cse', 'gvn', 'peval ms', 'gvn ms',
+        'speedup'))
+    for bench in BENCHMARKS:
+        n0, n1, n2, n3, t1, t2 = measure(bench)
+        print('%-20s %6d %6d %6d %6d %10.2f %10.2f %7.2fx' % (
+            bench.name, n0, n1, n2, n3, t1*1000, t2*1000, t1/t2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Show that tail recursion runs in constant stack depth.
+
+The toy function counts up to N by tail recursion. When it reaches N it
+prints a probe object, which records the depth of the Python stack at that
+point: it must not depend on N.
+
+    python -m toyvm.benchmarks.tailcalls [N ...]
+"""
+
+import io
+import sys
+import time
+import contextlib
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Object, W_Int
+from toyvm.benchmarks.runner import MODES, MODE_WIDTH
+
+SRC = """
+def count(i, n, probe):
+    if i < n:
+        return count(i + 1, n, probe)
+    print(probe)
+    return i
+"""
+
+
+class W_StackProbe(W_Object):
+    __slots__ = ('depth',)
+    type = 'probe'
+
+    def __init__(self):
+        self.depth = None
+
+    def str(self):
+        depth = 0
+        f = sys._getframe()
+        while f is not None:
+            depth += 1
+            f = f.f_back
+        self.depth = depth
+        return ''
+
+
+def measure(n, mode):
+    """
+    Return (python stack depth at the deepest point, time in seconds)
+    """
+    w_mod = toy_compile(SRC)
+    w_count = MODES[mode](w_mod.globals_w['count'])
+    w_mod.globals_w['count'] = w_count
+    w_probe = W_StackProbe()
+    a = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        w_res = w_count.call(W_Int(0), W_Int(n), w_probe)
+    b = time.perf_counter()
+    assert w_res == W_Int(n)
+    return w_probe.depth, b-a
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    sizes = [int(x) for x in argv] or [10, 1000, 1000000]
+    print('%-*s %10s %12s %10s' % (MODE_WIDTH, 'mode', 'N', 'stack depth',
+                                   'time (s)'))
+    for mode in MODES:
+        for n in sizes:
+            depth, t = measure(n, mode)
+            print('%-*s %10d %12d %10.3f' % (MODE_WIDTH, mode, n, depth, t))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+"""
+Measure the overhead of the trace recorder, when it is off and when it is
+on.
+
+    python -m toyvm.benchmarks.tracing
+"""
+
+import sys
+from toyvm.compiler import toy_compile
+from toyvm.trace import TraceRecorder
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks.metering import timeit
+
+
+def measure(bench, *, size=None, repeat=5, buffer_size=4096):
+    if size is None:
+        size = bench.size
+    w_mod = toy_compile(bench.get_src(size))
+    w_func = w_mod.globals_w[bench.entry]
+    args_w = bench.make_args(size)
+    w_func.call(*args_w) # warmup, e.g. for quickening
+    t_off = timeit(lambda: w_func.call(*args_w), repeat)
+    rec = TraceRecorder(buffer_size)
+    with rec:
+        t_on = timeit(lambda: w_func.call(*args_w), repeat)
+    return t_off, t_on, rec.count // repeat
+
+
+def main(argv=None):
+    print('%-16s %12s %12s %9s %12s' % (
+        'benchmark', 'off (ms)', 'on (ms)', 'overhead', 'records'))
+    for bench in BENCHMARKS:
+        t_off, t_on, n = measure(bench)
+        print('%-16s %12.3f %12.3f %8.1f%% %12d' % (
+            bench.name, t_off*1000, t_on*1000, (t_on/t_off - 1) * 100, n))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
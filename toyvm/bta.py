@@ -0,0 +1,154 @@
+"""
+Binding-time analysis: infer which locals can be green.
+
+Normally, a local is green only if its name is uppercase. When toy_compile
+is called with infer_green=True, BindingTimeAnalysis finds the other locals
+of non-green functions whose value is always known at peval time, and the
+compiler emits load_local_green and store_local_green for them, exactly as
+if they had been renamed.
+
+A local is inferred green if it's not an argument nor the target of a for
+loop, and all its assignments:
+
+  - compute a green expression, i.e. one which RainbowInterpreter
+    evaluates in the greenframe: constants, green names, pure ops on green
+    operands (see PURE_OPS), and calls to green functions with green
+    arguments;
+
+  - are not under red control flow, i.e. inside a red loop (whose body
+    is pevaled only once) or inside an 'if' whose condition is red (whose
+    arms are both pevaled).
+
+The analysis starts by assuming that all the candidates are green, and
+demotes them until nothing changes.
+"""
+
+import ast
+from toyvm.opcode import PURE_OPS
+from toyvm.intops import BUILTINS as INT_BUILTINS
+
+BINOPS = {'Add': 'add', 'Mult': 'mul'}
+CMPOPS = {'Lt': 'lt', 'Gt': 'gt'}
+
+
+class BindingTimeAnalysis:
+
+    def __init__(self, funcdef, *, argnames, local_vars, green_vars,
+                 green_nonlocals):
+        self.funcdef = funcdef
+        self.green_vars = green_vars
+        self.green_nonlocals = green_nonlocals
+        self.local_vars = set(local_vars)
+        self.candidates = self.local_vars - set(argnames)
+        self.inferred = set(self.candidates)
+        self.reasons = {} # varname -> why it is red
+        self.changed = False
+
+    def run(self):
+        self.changed = True
+        while self.changed:
+            self.changed = False
+            self.visit_stmts(self.funcdef.body, red_ctx=None)
+        return self.inferred
+
+    def demote(self, varname, reason):
+        if varname in self.inferred:
+            self.inferred.discard(varname)
+            self.reasons[varname] = reason
+            self.changed = True
+
+    def is_green_name(self, name):
+        return (name in self.inferred or name in self.green_vars or
+                (name not in self.local_vars and
+                 name in self.green_nonlocals))
+
+    def is_green(self, expr):
+        """
+        Is expr evaluated in the greenframe by RainbowInterpreter?
+        """
+        if isinstance(expr, ast.Constant):
+            return 'load_const' in PURE_OPS
+        elif isinstance(expr, ast.Name):
+            return self.is_green_name(expr.id)
+        elif isinstance(expr, ast.BinOp):
+            opname = BINOPS.get(expr.op.__class__.__name__)
+            return (opname in PURE_OPS and self.is_green(expr.left) and
+                    self.is_green(expr.right))
+        elif isinstance(expr, ast.Compare):
+            opname = CMPOPS.get(expr.ops[0].__class__.__name__)
+            return (opname in PURE_OPS and self.is_green(expr.left) and
+                    self.is_green(expr.comparators[0]))
+        elif isinstance(expr, ast.Tuple):
+            return ('make_tuple' in PURE_OPS and
+                    all(self.is_green(item) for item in expr.elts))
+        elif isinstance(expr, ast.Call):
+            return self.is_green_call(expr)
+        return False
+
+    def is_green_call(self, expr):
+        if not all(self.is_green(arg) for arg in expr.args):
+            return False
+        func = expr.func
+        if isinstance(func, ast.Name):
+            if func.id == 'UNROLL':
+                return 'unroll' in PURE_OPS
+            elif func.id in INT_BUILTINS:
+                return INT_BUILTINS[func.id] in PURE_OPS
+            elif func.id == 'print':
+                return False
+            # a call to a green function is done at peval time. Locals
+            # might contain non-green functions, e.g. closures
+            return (func.id not in self.local_vars and
+                    func.id not in self.green_vars and
+                    func.id in self.green_nonlocals)
+        return False
+
+    def visit_stmts(self, stmts, red_ctx):
+        """
+        red_ctx is None when the control flow is green, else a string which
+        describes the red construct which contains the stmts
+        """
+        for stmt in stmts:
+            self.visit_stmt(stmt, red_ctx)
+
+    def visit_stmt(self, stmt, red_ctx):
+        if isinstance(stmt, ast.Assign):
+            varname = stmt.targets[0].id
+            if red_ctx is not None:
+                self.demote(varname, f'assigned {red_ctx}')
+            elif not self.is_green(stmt.value):
+                self.demote(varname, f'red value at line {stmt.lineno}')
+        elif isinstance(stmt, ast.If):
+            if red_ctx is None and not self.is_green(stmt.test):
+                red_ctx = f'under a red if at line {stmt.lineno}'
+            self.visit_stmts(stmt.body, red_ctx)
+            self.visit_stmts(stmt.orelse, red_ctx)
+        elif isinstance(stmt, ast.For):
+            # the target of an unrolled loop must be uppercase, so the
+            # target of a lowercase loop is always red
+            self.demote(stmt.target.id,
+                        f'target of a for loop at line {stmt.lineno}')
+            if red_ctx is None and not self.is_unrolled(stmt.iter):
+                red_ctx = f'in a red loop at line {stmt.lineno}'
+            self.visit_stmts(stmt.body, red_ctx)
+
+    def is_unrolled(self, expr):
+        return (isinstance(expr, ast.Call) and
+                isinstance(expr.func, ast.Name) and
+                expr.func.id == 'UNROLL' and
+                self.is_green(expr))
+
+
+def report(inferred):
+    """
+    Format the results of the analysis of a module, i.e. the
+    ModuleCompiler.inferred dict {funcname: BindingTimeAnalysis}
+    """
+    lines = []
+    for funcname, bta in inferred.items():
+        lines.append(f'{funcname}:')
+        for varname in sorted(bta.inferred):
+            lines.append(f'    green {varname}')
+        for varname in sorted(bta.reasons):
+            lines.append(f'    red   {varname}: {bta.reasons[varname]}')
+    return '\n'.join(lines)
@@ -0,0 +1,203 @@
+"""
+Control-flow graph of a CodeObject.
+
+The body is split into basic blocks: a block starts at pc 0, at each label,
+and after each op which ends a block (br, br_if, for_iter, return,
+tail_call, abort). The edges are:
+
+  - br L: to the block of L;
+  - br_if then else endif: to the blocks of then and else. endif is only a
+    marker for peval, it's not a successor;
+  - for_iter: to the next block (the body of the loop), and to endfor;
+  - return, tail_call, abort: none;
+  - any other op: to the next block (fallthrough).
+
+To make the analyses simpler, the CFG always starts with an empty entry
+block, which falls through the block at pc 0: this way, the entry never
+has predecessors, even if pc 0 is the label of a loop.
+"""
+
+from toyvm.verifier import verify
+
+TERMINATORS = ('br', 'br_if', 'for_iter', 'return', 'tail_call', 'abort')
+
+
+class Block:
+
+    def __init__(self, index, pc_start, pc_end, depth):
+        self.index = index
+        self.pc_start = pc_start
+        self.pc_end = pc_end
+        self.depth = depth # the stack depth at the start of the block
+        self.ops = [] # the ops of the block, including label and terminator
+        self.label = None
+        self.succs = []
+        self.preds = []
+        self.reachable = False
+        self.idom = None # the immediate dominator, see compute_dominators
+
+    def __repr__(self):
+        return f'<Block {self.name}>'
+
+    @property
+    def name(self):
+        if self.label is not None:
+            return self.label
+        return f'b{self.index}'
+
+    @property
+    def terminator(self):
+        if self.ops and self.ops[-1].name in TERMINATORS:
+            return self.ops[-1]
+        return None
+
+
+class CFG:
+
+    def __init__(self, code):
+        self.code = code
+        self.blocks = [] # in layout order, blocks[0] is the entry
+        self.by_label = {}
+        self.rpo = [] # the reachable blocks, in reverse postorder
+        self.build()
+        self.compute_rpo()
+        self.compute_dominators()
+
+    @property
+    def entry(self):
+        return self.blocks[0]
+
+    def build(self):
+        code = self.code
+        info = code.verified or verify(code)
+        body = code.body
+        leaders = {0}
+        for pc, op in enumerate(body):
+            if op.name == 'label':
+                leaders.add(pc)
+            elif op.name in TERMINATORS:
+                leaders.add(pc + 1)
+        leaders = sorted(pc for pc in leaders if pc < len(body))
+        self.blocks.append(Block(0, 0, 0, 0)) # the entry
+        for i, pc_start in enumerate(leaders):
+            if i + 1 < len(leaders):
+                pc_end = leaders[i+1]
+            else:
+                pc_end = len(body)
+            block = Block(len(self.blocks), pc_start, pc_end,
+                          info.depths[pc_start])
+            block.ops = body[pc_start:pc_end]
+            if block.ops[0].name == 'label':
+                block.label = block.ops[0].args[0]
+                self.by_label[block.label] = block
+            self.blocks.append(block)
+        #
+        for i, block in enumerate(self.blocks):
+            nextblock = self.blocks[i+1] if i + 1 < len(self.blocks) else None
+            op = block.terminator
+            if op is None:
+                targets = [nextblock] if nextblock is not None else []
+            elif op.name == 'br':
+                targets = [self.by_label[op.args[0]]]
+            elif op.name == 'br_if':
+                then, else_, endif = op.args
+                targets = [self.by_label[then], self.by_label[else_]]
+            elif op.name == 'for_iter':
+                targets = [nextblock, self.by_label[op.args[2]]]
+            else:
+                targets = []
+            for target in targets:
+                if target not in block.succs:
+                    block.succs.append(target)
+        #
+        todo = [self.entry]
+        self.entry.reachable = True
+        while todo:
+            block = todo.pop()
+            for succ in block.succs:
+                if not succ.reachable:
+                    succ.reachable = True
+                    todo.append(succ)
+        # only the reachable blocks are predecessors, in layout order
+        for block in self.blocks:
+            if block.reachable:
+                for succ in block.succs:
+                    succ.preds.append(block)
+
+    def compute_rpo(self):
+        seen = set()
+        postorder = []
+        # iterative DFS: (block, index of the next successor to visit)
+        stack = [(self.entry, 0)]
+        seen.add(self.entry)
+        while stack:
+            block, i = stack.pop()
+            if i < len(block.succs):
+                stack.append((block, i + 1))
+                succ = block.succs[i]
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append((succ, 0))
+            else:
+                postorder.append(block)
+        self.rpo = postorder[::-1]
+
+    def compute_dominators(self):
+        """
+        Compute block.idom with the algorithm by Cooper, Harvey and Kennedy
+        """
+        order = {block: i for i, block in enumerate(self.rpo)}
+        entry = self.entry
+        entry.idom = entry
+        changed = True
+        while changed:
+            changed = False
+            for block in self.rpo[1:]:
+                new_idom = None
+                for pred in block.preds:
+                    if pred.idom is None:
+                        continue
+                    if new_idom is None:
+                        new_idom = pred
+                    else:
+                        new_idom = self.intersect(pred, new_idom, order)
+                if block.idom is not new_idom:
+                    block.idom = new_idom
+                    changed = True
+
+    def intersect(self, b1, b2, order):
+        while b1 is not b2:
+            while order[b1] > order[b2]:
+                b1 = b1.idom
+            while order[b2] > order[b1]:
+                b2 = b2.idom
+        return b1
+
+    def dominates(self, a, b):
+        while b is not a:
+            if b is self.entry:
+                return False
+            b = b.idom
+        return True
+
+    def dominator_tree(self):
+        """
+        Return a dict {block: [blocks immediately dominated by it]}
+        """
+        children = {block: [] for block in self.rpo}
+        for block in self.rpo[1:]:
+            children[block.idom].append(block)
+        return children
+
+    def dump(self):
+        lines = []
+        for block in self.blocks:
+            if not block.reachable:
+                continue
+            succs = ', '.join(succ.name for succ in block.succs)
+            lines.append(f'{block.name}: -> {succs}' if succs else
+                         f'{block.name}:')
+            for op in block.ops:
+                if op.name != 'label':
+                    lines.append(f'    {op.str()}')
+        return '\n'.join(lines)
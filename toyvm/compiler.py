@@ -2,8 +2,12 @@ import ast
 import textwrap
 import symtable
 from collections import Counter
-from toyvm.opcode import CodeObject, OpCode
-from toyvm.objects import W_Int, W_Str, W_Function, w_None, W_Module
+from toyvm.opcode import CodeObject, OpCode, INT_COMPARE_OPS
+from toyvm.objects import W_Int, W_Str, W_Function, w_None, W_Module, Globals
+from toyvm.verifier import verify
+from toyvm import astopt
+from toyvm.intops import BUILTINS as INT_BUILTINS, wrap32, wrap64
+from toyvm.bta import BindingTimeAnalysis
 
 try:
     # add .pp() (pretty print) to all AST classes
@@ -12,17 +16,25 @@ except ImportError:
     pass
 
 
-def toy_compile(src, filename='<unknown>'):
+def toy_compile(src, filename='<unknown>', *, optimize=True,
+                infer_green=False, typed_locals=True):
     src = textwrap.dedent(src)
-    comp = ModuleCompiler(src, filename)
+    comp = ModuleCompiler(src, filename, optimize=optimize,
+                          infer_green=infer_green, typed_locals=typed_locals)
     return comp.compile()
 
 class ModuleCompiler:
 
-    def __init__(self, src, filename):
+    def __init__(self, src, filename, *, optimize=True, infer_green=False,
+                 typed_locals=True):
         self.root = ast.parse(src, filename)
-        self.w_mod = W_Module(globals_w={})
-        self.w_mod.green_funcs = set()
+        if optimize:
+            self.root = astopt.optimize(self.root)
+        self.symtab = symtable.symtable(src, filename, 'exec')
+        self.w_mod = W_Module(globals_w=Globals())
+        self.infer_green = infer_green
+        self.typed_locals = typed_locals
+        self.inferred = {} # funcname -> BindingTimeAnalysis, see toyvm.bta
         self.funcdefs = []
         for funcdef in self.root.body:
             assert isinstance(funcdef, ast.FunctionDef)
@@ -46,23 +58,54 @@ class ModuleCompiler:
             comp = FuncDefCompiler(funcdef,
                                    is_green = is_green,
                                    green_nonlocals = self.w_mod.green_funcs,
-                                   w_mod = self.w_mod)
+                                   w_mod = self.w_mod,
+                                   symtab = get_symtab(self.symtab, funcdef),
+                                   infer_green = self.infer_green,
+                                   typed_locals = self.typed_locals)
+            if comp.bta is not None:
+                self.inferred[funcdef.name] = comp.bta
             w_func = comp.make_func()
             self.w_mod.globals_w[w_func.name] = w_func
         return self.w_mod
 
 
+def get_symtab(parent, funcdef):
+    """
+    Find the symtable of the given funcdef among the children of parent
+    """
+    for child in parent.get_children():
+        if (child.get_name() == funcdef.name and
+            child.get_lineno() == funcdef.lineno):
+            return child
+    assert False, f'cannot find the symtable for {funcdef.name}'
+
+
 class FuncDefCompiler:
 
-    def __init__(self, funcdef, *, is_green, green_nonlocals, w_mod):
+    def __init__(self, funcdef, *, is_green, green_nonlocals, w_mod, symtab,
+                 freevars=(), green_freevars=(), infer_green=False,
+                 typed_locals=True):
         self.funcdef = funcdef
         self.is_green = is_green
         self.green_nonlocals = green_nonlocals
         self.w_mod = w_mod
+        self.symtab = symtab
+        # variables of the enclosing function captured by the closure:
+        # they are accessed by index with load_cell and load_cell_green
+        self.freevars = freevars
+        self.green_freevars = green_freevars
         self.argnames = [a.arg for a in funcdef.args.args]
-        self.code = CodeObject(funcdef.name, self.argnames, [])
+        self.code = CodeObject(funcdef.name, self.argnames, [],
+                               freevars=freevars)
         self.label_counter = 0
         self.compute_local_vars()
+        self.bta = None
+        if infer_green and not is_green:
+            self.infer_green_vars()
+        self.typed_locals = {} # name -> width, see compute_typed_locals
+        if typed_locals and not is_green:
+            self.compute_typed_locals()
+            self.code.islots = tuple(self.typed_locals)
 
     def compute_local_vars(self):
         self.local_vars = set()
@@ -88,6 +131,70 @@ class FuncDefCompiler:
                 varname = node.name
                 self.local_vars_green.add(varname)
 
+    def infer_green_vars(self):
+        self.bta = BindingTimeAnalysis(
+            self.funcdef,
+            argnames = self.argnames,
+            local_vars = self.local_vars,
+            green_vars = self.local_vars_green,
+            green_nonlocals = self.green_nonlocals)
+        inferred = self.bta.run()
+        self.local_vars -= inferred
+        self.local_vars_green |= inferred
+
+    def compute_typed_locals(self):
+        """
+        Find the locals which can live unboxed in frame.islots: the ones
+        whose assignments are all fixed-width integer expressions of the
+        same width, or int constants which fit in that width (but not only
+        constants). Arguments and loop targets always contain W_ objects.
+        Green functions are excluded, because their closures capture the
+        locals.
+        """
+        assigned = {} # name -> list of values
+        excluded = set(self.argnames)
+        for node in ast.walk(self.funcdef):
+            if isinstance(node, ast.Assign):
+                name = self.get_Name(node.targets[0])
+                assigned.setdefault(name, []).append(node.value)
+            elif isinstance(node, ast.For):
+                excluded.add(self.get_Name(node.target))
+        candidates = {name: values for name, values in assigned.items()
+                      if name in self.local_vars and name not in excluded}
+        # a value can be another typed local, so iterate until nothing
+        # changes
+        changed = True
+        while changed:
+            changed = False
+            for name, values in candidates.items():
+                if name in self.typed_locals:
+                    continue
+                widths = {self.int_width(value) for value in values
+                          if not self.is_int_const(value)}
+                if len(widths) == 1 and None not in widths:
+                    width = widths.pop()
+                    wrap = wrap32 if width == 32 else wrap64
+                    # a constant which doesn't fit would be silently wrapped
+                    if all(wrap(value.value) == value.value
+                           for value in values if self.is_int_const(value)):
+                        self.typed_locals[name] = width
+                        changed = True
+
+    def is_int_const(self, expr):
+        return isinstance(expr, ast.Constant) and type(expr.value) is int
+
+    def int_width(self, expr):
+        """
+        Return 32 or 64 if expr computes an unboxed int, else None
+        """
+        if isinstance(expr, ast.Name):
+            return self.typed_locals.get(expr.id)
+        elif isinstance(expr, ast.Call) and isinstance(expr.func, ast.Name):
+            opname = INT_BUILTINS.get(expr.func.id)
+            if opname is not None and opname not in INT_COMPARE_OPS:
+                return int(opname[1:3])
+        return None
+
     def new_label(self, stem):
         n = self.label_counter
         self.label_counter += 1
@@ -114,6 +221,7 @@ class FuncDefCompiler:
 
     def make_func(self):
         code = self.make_code()
+        verify(code)
         w_func = W_Function(self.funcdef.name, code, self.w_mod.get_closure())
         w_func.is_green = self.is_green
         return w_func
@@ -134,21 +242,57 @@ class FuncDefCompiler:
         meth(stmt)
 
     def compile_expr(self, expr):
+        """
+        Compile expr, leaving a W_ object on the stack
+        """
+        width = self.int_width(expr)
+        if width is not None:
+            self.compile_unboxed(expr)
+            self.emit(f'i{width}_box')
+            return
         name = expr.__class__.__name__
         meth = getattr(self, f'expr_{name}', self.unknown_expr)
         meth(expr)
 
+    def compile_unboxed(self, expr):
+        if isinstance(expr, ast.Name):
+            self.emit('load_islot', self.code.islots.index(expr.id))
+        else:
+            self.expr_Call_int(expr)
+
+    def compile_int_expr(self, expr, width):
+        """
+        Compile expr, leaving an unboxed int of the given width on the stack
+        """
+        expr_width = self.int_width(expr)
+        if expr_width is None:
+            self.compile_expr(expr)
+            self.emit(f'i{width}_unbox')
+        else:
+            self.compile_unboxed(expr)
+            if expr_width > width:
+                self.emit('i32_wrap')
+
     def stmt_Pass(self, stmt):
         pass
 
     def stmt_Return(self, ret):
         self.compile_expr(ret.value)
-        self.emit('return')
+        last_op = self.code.body[-1]
+        if last_op.name == 'call':
+            # a call followed by a return: turn it into a tail call
+            self.code.body[-1] = OpCode('tail_call', *last_op.args)
+        else:
+            self.emit('return')
 
     def stmt_Assign(self, stmt):
         assert len(stmt.targets) == 1
         name = self.get_Name(stmt.targets[0])
         assert name in self.local_vars or name in self.local_vars_green
+        if name in self.typed_locals:
+            self.compile_int_expr(stmt.value, self.typed_locals[name])
+            self.emit('store_islot', self.code.islots.index(name))
+            return
         self.compile_expr(stmt.value)
         if name in self.local_vars_green:
             self.emit('store_local_green', name)
@@ -197,11 +341,17 @@ class FuncDefCompiler:
 
     def stmt_FunctionDef(self, stmt):
         assert self.is_green, 'closures are allowed only inside green functions'
+        symtab = get_symtab(self.symtab, stmt)
+        freevars = tuple(sorted(symtab.get_frees()))
+        green_freevars = set(freevars) & self.local_vars_green
         inner_comp = FuncDefCompiler(
             stmt,
             is_green = False,
             green_nonlocals = self.local_vars_green.copy(),
-            w_mod = self.w_mod)
+            w_mod = self.w_mod,
+            symtab = symtab,
+            freevars = freevars,
+            green_freevars = green_freevars)
         code = inner_comp.make_code()
         self.emit('make_function', code)
         self.emit('store_local_green', stmt.name)
@@ -248,6 +398,12 @@ class FuncDefCompiler:
             self.emit('load_local_green', name)
         elif name in self.local_vars:
             self.emit('load_local', name)
+        elif name in self.freevars:
+            i = self.freevars.index(name)
+            if name in self.green_freevars:
+                self.emit('load_cell_green', i)
+            else:
+                self.emit('load_cell', i)
         else:
             if name in self.green_nonlocals:
                 self.emit('load_nonlocal_green', name)
@@ -260,16 +416,27 @@ class FuncDefCompiler:
         self.emit('make_tuple', len(expr.elts))
 
     def expr_Call(self, expr):
-        if (isinstance(expr.func, ast.Name) and
-            expr.func.id in ('print', 'UNROLL', '__i32_add__')):
-            self.expr_Call_builtin(expr)
-            return
+        if isinstance(expr.func, ast.Name):
+            if expr.func.id in ('print', 'UNROLL'):
+                self.expr_Call_builtin(expr)
+                return
+            elif expr.func.id in INT_BUILTINS:
+                self.expr_Call_int(expr)
+                return
         #
         self.compile_expr(expr.func)
         for arg in expr.args:
             self.compile_expr(arg)
         self.emit('call', len(expr.args))
 
+    def expr_Call_int(self, expr):
+        opname = INT_BUILTINS[self.get_Name(expr.func)]
+        assert len(expr.args) == 2, f'{opname} takes 2 arguments'
+        width = int(opname[1:3])
+        for arg in expr.args:
+            self.compile_int_expr(arg, width)
+        self.emit(opname)
+
     def expr_Call_builtin(self, expr):
         funcname = self.get_Name(expr.func)
         for arg in expr.args:
@@ -279,8 +446,5 @@ class FuncDefCompiler:
         elif funcname == 'UNROLL':
             assert len(expr.args) == 1
             self.emit('unroll')
-        elif funcname == '__i32_add__':
-            assert len(expr.args) == 2
-            self.emit('i32_add')
         else:
             assert False, f'unsupported function: {funcname}'
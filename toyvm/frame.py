@@ -1,17 +1,43 @@
 import operator
 from toyvm.objects import W_Object, W_Int, W_Str, W_Tuple, w_None, W_Function
+from toyvm import quicken, trace, osr, intops
+from toyvm.fuel import get_block_costs
 
 class Frame:
+    __slots__ = ('w_func', 'code', 'quickening', 'body', 'locals', 'islots',
+                 'pc', 'stack', 'labels', 'w_result', 'child', 'tail_frame',
+                 'fuel', 'block_costs', 'tracer', 'backedges')
 
-    def __init__(self, w_func):
+    def __init__(self, w_func, *, quickening=True, osr=True):
         assert isinstance(w_func, W_Function)
+        if quickening:
+            body = quicken.get_body(w_func.code)
+        else:
+            body = w_func.code.body
+        self.init_fields(w_func, body, {}, quickening=quickening, osr=osr)
+        self.init_labels()
+
+    def init_fields(self, w_func, body, labels, *, quickening, osr,
+                    tracing=True):
+        """
+        Initialize the fields which are common to all the subclasses
+        """
         self.w_func = w_func
         self.code = w_func.code
+        self.quickening = quickening
+        self.body = body
         self.locals = {}
+        self.islots = [None] * len(self.code.islots) # unboxed ints
         self.pc = 0
         self.stack = []
-        self.labels = {} # name -> pc
-        self.init_labels()
+        self.labels = labels # name -> pc
+        self.w_result = None # set by resume() upon return
+        self.child = None    # set by resume() upon call
+        self.tail_frame = None # set by run() and resume() upon tail_call
+        self.fuel = None
+        self.tracer = trace.current if tracing else None
+        # number of loop back-edges taken, None if OSR is disabled
+        self.backedges = 0 if osr else None
 
     def init_labels(self):
         for pc, op in enumerate(self.code.body):
@@ -20,6 +46,15 @@ class Frame:
                 assert l not in self.labels, f'duplicate label: {l}'
                 self.labels[l] = pc
 
+    def set_fuel(self, fuel):
+        """
+        Start metering: charge the entry block immediately, and the other
+        blocks when we enter them (see toyvm.fuel)
+        """
+        self.fuel = fuel
+        self.block_costs = get_block_costs(self.code).at_label
+        fuel.consume(get_block_costs(self.code).entry)
+
     def push(self, w_value):
         assert isinstance(w_value, W_Object)
         self.stack.append(w_value)
@@ -28,26 +63,77 @@ class Frame:
         return self.stack.pop()
 
     def popn(self, n):
-        assert len(self.stack) >= n
-        res = self.stack[-n:]
-        self.stack[-n:] = []
+        i = len(self.stack) - n
+        assert i >= 0
+        res = self.stack[i:]
+        del self.stack[i:]
         return res
 
     def run(self):
+        """
+        Run the frame until the end and return the result.
+
+        If the frame ends with a tail_call, return None: the execution must
+        continue in self.tail_frame, which replaces this one (see
+        W_Function.call).
+        """
         while True:
-            op = self.code.body[self.pc]
-            # 'return' is special, handle it explicitly
+            op = self.body[self.pc]
+            # 'return' and 'tail_call' are special, handle them explicitly
             if op.name == 'return':
                 n = len(self.stack)
                 assert n == 1, f'Wrong stack size upon return: {n}'
                 w_result = self.pop()
                 return w_result
+            elif op.name == 'tail_call':
+                self.tail_frame = self.make_tail_frame(op.args[0])
+                return None
             else:
                 self.run_op(op)
                 self.pc += 1
                 assert self.pc < len(self.code.body), 'no return?'
 
+    def resume(self, steps):
+        """
+        Resumable version of run(): execute at most 'steps' ops and return
+        the number of ops actually executed.
+
+        Calls are not executed recursively: instead, 'call' creates a new
+        frame for the callee, stores it in self.child and returns. It is up
+        to the caller to run the child and push its result on our stack (see
+        toyvm.scheduler.Task). Upon 'return', the result is stored in
+        self.w_result. Upon 'tail_call', the new frame is stored in
+        self.tail_frame, and it should replace this one.
+        """
+        n = 0
+        while n < steps:
+            op = self.body[self.pc]
+            n += 1
+            if op.name == 'return':
+                self.w_result = self.pop()
+                return n
+            elif op.name == 'tail_call':
+                self.tail_frame = self.make_tail_frame(op.args[0])
+                return n
+            elif op.name == 'call':
+                items_w = self.popn(op.args[0])
+                w_callable = self.pop()
+                self.child = w_callable.make_frame(*items_w, fuel=self.fuel)
+                self.pc += 1
+                return n
+            self.run_op(op)
+            self.pc += 1
+        return n
+
+    def make_tail_frame(self, n):
+        items_w = self.popn(n)
+        w_callable = self.pop()
+        assert not self.stack
+        return w_callable.make_frame(*items_w, fuel=self.fuel)
+
     def run_op(self, op):
+        if self.tracer is not None:
+            self.tracer.record(self.code, self.pc, op.name, len(self.stack))
         meth_name = f'op_{op.name}'
         meth = getattr(self, meth_name, None)
         if meth is None:
@@ -57,6 +143,8 @@ class Frame:
     def jump(self, label):
         assert isinstance(label, str)
         self.pc = self.labels[label]
+        if self.fuel is not None:
+            self.fuel.consume(self.block_costs[self.pc])
 
     def op_load_const(self, w_value):
         self.push(w_value)
@@ -67,10 +155,12 @@ class Frame:
         if w_a.type == w_b.type == 'int':
             w_c = W_Int(w_a.value + w_b.value)
         elif w_a.type == w_b.type == 'str':
-            w_c = W_Str(w_a.value + w_b.value)
+            w_c = w_a.concat(w_b)
         else:
             assert False
         self.push(w_c)
+        if self.quickening:
+            quicken.specialize(self.code, self.pc, w_a, w_b)
 
     def op_mul(self):
         w_b = self.pop()
@@ -78,10 +168,12 @@ class Frame:
         if w_a.type == w_b.type == 'int':
             w_c = W_Int(w_a.value * w_b.value)
         elif w_a.type == 'str' and w_b.type == 'int':
-            w_c = W_Str(w_a.value * w_b.value)
+            w_c = w_a.repeat(w_b.value)
         else:
             assert False
         self.push(w_c)
+        if self.quickening:
+            quicken.specialize(self.code, self.pc, w_a, w_b)
 
     def op_gt(self):
         self._op_compare(operator.gt)
@@ -89,14 +181,6 @@ class Frame:
     def op_lt(self):
         self._op_compare(operator.lt)
 
-    def op_i32_add(self):
-        w_b = self.pop()
-        w_a = self.pop()
-        assert w_a.type == 'int'
-        assert w_b.type == 'int'
-        w_c = W_Int(w_a.value + w_b.value)
-        self.push(w_c)
-
     def _op_compare(self, cmpfunc):
         w_b = self.pop()
         w_a = self.pop()
@@ -106,6 +190,73 @@ class Frame:
         else:
             assert False
         self.push(w_c)
+        if self.quickening:
+            quicken.specialize(self.code, self.pc, w_a, w_b)
+
+    # type-specialized ops installed by toyvm.quicken: if the guard fails,
+    # we deoptimize and execute the generic op
+
+    def deoptimize(self, w_a, w_b):
+        quicken.deoptimize(self.code, self.pc)
+        self.push(w_a)
+        self.push(w_b)
+        self.run_op(self.body[self.pc])
+
+    def op_add_int(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Int or type(w_b) is not W_Int:
+            return self.deoptimize(w_a, w_b)
+        self.push(W_Int(w_a.value + w_b.value))
+
+    def op_add_str(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Str or type(w_b) is not W_Str:
+            return self.deoptimize(w_a, w_b)
+        self.push(w_a.concat(w_b))
+
+    def op_mul_int(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Int or type(w_b) is not W_Int:
+            return self.deoptimize(w_a, w_b)
+        self.push(W_Int(w_a.value * w_b.value))
+
+    def op_mul_str(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Str or type(w_b) is not W_Int:
+            return self.deoptimize(w_a, w_b)
+        self.push(w_a.repeat(w_b.value))
+
+    def op_lt_int(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Int or type(w_b) is not W_Int:
+            return self.deoptimize(w_a, w_b)
+        self.push(W_Int(w_a.value < w_b.value))
+
+    def op_lt_str(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Str or type(w_b) is not W_Str:
+            return self.deoptimize(w_a, w_b)
+        self.push(W_Int(w_a.value < w_b.value))
+
+    def op_gt_int(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Int or type(w_b) is not W_Int:
+            return self.deoptimize(w_a, w_b)
+        self.push(W_Int(w_a.value > w_b.value))
+
+    def op_gt_str(self):
+        w_b = self.pop()
+        w_a = self.pop()
+        if type(w_a) is not W_Str or type(w_b) is not W_Str:
+            return self.deoptimize(w_a, w_b)
+        self.push(W_Int(w_a.value > w_b.value))
 
     def op_store_local(self, name):
         self.locals[name] = self.pop()
@@ -116,17 +267,41 @@ class Frame:
     op_store_local_green = op_store_local
     op_load_local_green = op_load_local
 
+    # the islots and the fixed-width integer ops contain unboxed ints, so
+    # they bypass push(). The integer ops are installed below the class
+
+    def op_store_islot(self, i):
+        self.islots[i] = self.stack.pop()
+
+    def op_load_islot(self, i):
+        value = self.islots[i]
+        if value is None:
+            raise KeyError(self.code.islots[i])
+        self.stack.append(value)
+
     def op_load_nonlocal(self, name):
         w_obj = self.w_func.closure.lookup(name)
         self.push(w_obj)
 
     op_load_nonlocal_green = op_load_nonlocal
 
+    def op_load_cell(self, i):
+        self.push(self.w_func.closure.cells[i])
+
+    op_load_cell_green = op_load_cell
+
     def op_label(self, l):
         assert self.labels[l] == self.pc
+        if self.fuel is not None:
+            self.fuel.consume(self.block_costs[self.pc])
 
     def op_br(self, label):
+        pc = self.pc
         self.jump(label)
+        if self.backedges is not None and self.pc < pc:
+            self.backedges += 1
+            if self.backedges >= osr.THRESHOLD:
+                osr.try_osr(self)
 
     def op_br_if(self, then, else_, endif):
         """
@@ -162,7 +337,7 @@ class Frame:
     def op_call(self, n):
         items_w = self.popn(n)
         w_callable = self.pop()
-        w_res = w_callable.call(*items_w)
+        w_res = w_callable.call(*items_w, fuel=self.fuel)
         self.push(w_res)
 
     def op_pop(self):
@@ -188,9 +363,74 @@ class Frame:
         self.push(w_res)
 
     def op_make_function(self, code):
-        # let's create a closure over the COPY of the current locals
-        closure = self.w_func.closure.copy_and_append(
+        # capture only the free variables of the new function
+        cells_w = tuple([self.locals[name] for name in code.freevars])
+        closure = self.w_func.closure.with_cells(
             f'{self.w_func.name}:locals',
-            self.locals.copy())
+            cells_w)
         w_func = W_Function(code.name, code, closure)
         self.push(w_func)
+
+
+def _make_int_binop(func):
+    def op(self):
+        b = self.stack.pop()
+        self.stack[-1] = func(self.stack[-1], b)
+    return op
+
+def _make_int_unop(func):
+    def op(self):
+        self.stack[-1] = func(self.stack[-1])
+    return op
+
+for _opname, _func in intops.BINOPS.items():
+    setattr(Frame, f'op_{_opname}', _make_int_binop(_func))
+for _opname, _func in intops.UNOPS.items():
+    setattr(Frame, f'op_{_opname}', _make_int_unop(_func))
+
+
+class FastFrame(Frame):
+    """
+    A Frame to execute code which has been checked by toyvm.verifier.
+
+    The verifier already guarantees that the stack never underflows, that
+    labels are consistent and that we always reach a return, so we can skip
+    all the runtime checks done by Frame.
+    """
+    __slots__ = ()
+
+    def __init__(self, w_func, *, osr=True):
+        info = w_func.code.verified
+        assert info is not None, 'FastFrame can run only verified code'
+        self.init_fields(w_func, quicken.get_body(w_func.code), info.labels,
+                         quickening=True, osr=osr)
+
+    def push(self, w_value):
+        self.stack.append(w_value)
+
+    def popn(self, n):
+        i = len(self.stack) - n
+        res = self.stack[i:]
+        del self.stack[i:]
+        return res
+
+    def run(self):
+        while True:
+            # don't cache self.body: it can change because of OSR
+            op = self.body[self.pc]
+            if op.name == 'return':
+                return self.stack.pop()
+            elif op.name == 'tail_call':
+                self.tail_frame = self.make_tail_frame(op.args[0])
+                return None
+            self.run_op(op)
+            self.pc += 1
+
+    def jump(self, label):
+        self.pc = self.labels[label]
+        if self.fuel is not None:
+            self.fuel.consume(self.block_costs[self.pc])
+
+    def op_label(self, l):
+        if self.fuel is not None:
+            self.fuel.consume(self.block_costs[self.pc])
@@ -0,0 +1,68 @@
+"""
+Fuel metering, to bound the amount of work done by a toy function.
+
+Fuel is charged per basic block: when a frame enters a block (at the
+beginning of the code, by jumping to a label or by falling through a label)
+it pays in advance for all the ops of the block. This way the cost of
+metering is paid only once per block instead of once per op. Charging is
+conservative: a block is paid in full even if we leave it early (e.g. when
+for_iter exits the loop).
+
+The Fuel object is shared by all the frames of a call chain, so callees
+consume from the same budget as their caller.
+"""
+
+class ResourceExhausted(Exception):
+    pass
+
+
+class Fuel:
+
+    def __init__(self, amount):
+        self.initial = amount
+        self.remaining = amount
+
+    def __repr__(self):
+        return f'<Fuel {self.remaining}/{self.initial}>'
+
+    @property
+    def consumed(self):
+        return self.initial - self.remaining
+
+    def consume(self, n):
+        if n > self.remaining:
+            self.remaining = 0
+            raise ResourceExhausted(f'out of fuel: {self.initial} ops allowed')
+        self.remaining -= n
+
+
+class BlockCosts:
+    """
+    The cost of each basic block of a CodeObject, precomputed from the
+    labels: 'entry' is the cost of the ops before the first label, and
+    at_label maps the pc of each label to the cost of its block (label
+    included). For a PackedCode, the pcs are offsets into co_code.
+    """
+
+    def __init__(self, code):
+        self.entry = 0
+        self.at_label = {}
+        current = None
+        if hasattr(code, 'iter_ops'): # a PackedCode
+            ops = code.iter_ops()
+        else:
+            ops = enumerate(code.body)
+        for pc, op in ops:
+            if op.name == 'label':
+                current = pc
+                self.at_label[pc] = 0
+            if current is None:
+                self.entry += 1
+            else:
+                self.at_label[current] += 1
+
+
+def get_block_costs(code):
+    if code.block_costs is None:
+        code.block_costs = BlockCosts(code)
+    return code.block_costs
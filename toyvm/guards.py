@@ -0,0 +1,141 @@
+"""
+Guarded specialization of the functions of a module.
+
+peval folds the globals read at peval time into constants: if they are
+later reassigned (e.g. by a hot reload), the specialized code is stale.
+enable_tiering() makes it safe to keep specialized code around:
+
+  - each function starts running its original code, and counts its calls;
+
+  - after `threshold` calls it tiers up: it is pevaled and the specialized
+    code is installed in place, by replacing w_func.code. The W_Function
+    object stays the same, so references to it (including the ones folded
+    into other specialized code) remain valid;
+
+  - the globals which can be folded (see toyvm.parallel.find_deps) are
+    watched: when one of them is reassigned, the specialization is
+    invalidated and the function goes back to the original code. After
+    `threshold` more calls it tiers up again, using the new values.
+
+Frames which are already running the specialized code finish running it.
+"""
+
+from toyvm.objects import W_Function, Globals
+from toyvm import rainbow
+from toyvm.rainbow import peval
+from toyvm.parallel import find_deps
+
+DEFAULT_THRESHOLD = 100
+
+
+def enable_tiering(w_mod, *, threshold=DEFAULT_THRESHOLD, budget=None):
+    """
+    Attach a Tier to all the non-green functions of the module
+    """
+    assert isinstance(w_mod.globals_w, Globals)
+    for w_obj in list(w_mod.globals_w.values()):
+        if isinstance(w_obj, W_Function) and not w_obj.is_green:
+            w_obj.tier = Tier(w_mod, w_obj, threshold=threshold,
+                              budget=budget)
+
+def disable_tiering(w_mod):
+    for w_obj in list(w_mod.globals_w.values()):
+        if isinstance(w_obj, W_Function) and w_obj.tier is not None:
+            w_obj.tier.deoptimize()
+            w_obj.tier = None
+
+
+class Tier:
+    __slots__ = ('w_mod', 'w_func', 'original', 'threshold', 'budget',
+                 'calls', 'deps', 'is_specialized', 'specializations',
+                 'invalidations')
+
+    def __init__(self, w_mod, w_func, *, threshold, budget=None):
+        self.w_mod = w_mod
+        self.w_func = w_func
+        self.original = w_func.code
+        self.threshold = threshold
+        self.budget = budget
+        self.calls = 0
+        self.deps = ()
+        self.is_specialized = False
+        self.specializations = 0
+        self.invalidations = 0
+
+    def __repr__(self):
+        state = 'specialized' if self.is_specialized else 'original'
+        return f'<Tier {self.w_func.name!r} {state} calls={self.calls}>'
+
+    def count_call(self):
+        if self.is_specialized:
+            return
+        self.calls += 1
+        if self.calls >= self.threshold:
+            self.specialize()
+
+    def specialize(self):
+        assert not self.is_specialized
+        w_func = W_Function(self.w_func.name, self.original,
+                            self.w_func.closure)
+        w_spec = peval(w_func, budget=self.budget)
+        self.deps = find_deps(self.w_mod.globals_w, self.original)
+        for name in self.deps:
+            self.w_mod.globals_w.watch(name, self)
+        # if peval exceeded the budget, we keep running the original code,
+        # without trying again until the next invalidation
+        self.w_func.code = w_spec.code
+        self.is_specialized = True
+        self.specializations += 1
+
+    def deoptimize(self):
+        for name in self.deps:
+            self.w_mod.globals_w.unwatch(name, self)
+        self.deps = ()
+        self.w_func.code = self.original
+        self.is_specialized = False
+        self.calls = 0
+
+    def global_changed(self, name):
+        if self.is_specialized:
+            self.invalidations += 1
+            self.deoptimize()
+            # the specializations on constant arguments might have folded
+            # the old value, too
+            rainbow.SPEC_CACHE.clear()
+
+
+class DepsGuard:
+    """
+    Reset code.<attr> to None when one of the globals which peval can fold
+    into the specialized versions of code is reassigned. It's used for the
+    caches which are attached to the code object, see toyvm.osr and
+    rainbow.SpecializationCache.
+
+    The globals can be watched only if all the scopes are Globals: use
+    can_watch() to check.
+    """
+    __slots__ = ('code', 'attr', 'scopes', 'deps')
+    transient = True # not saved in images, like the caches it guards
+
+    def __init__(self, code, attr, scopes):
+        assert can_watch(scopes)
+        self.code = code
+        self.attr = attr
+        self.scopes = scopes
+        self.deps = set()
+        for globals_w in scopes:
+            self.deps |= find_deps(globals_w, code)
+
+    def watch(self):
+        for globals_w in self.scopes:
+            for name in self.deps:
+                globals_w.watch(name, self)
+
+    def global_changed(self, name):
+        setattr(self.code, self.attr, None)
+        for globals_w in self.scopes:
+            for dep in self.deps:
+                globals_w.unwatch(dep, self)
+
+def can_watch(scopes):
+    return all(isinstance(ns_w, Globals) for ns_w in scopes)
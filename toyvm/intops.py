@@ -0,0 +1,83 @@
+"""
+Fixed-width integer arithmetic.
+
+The i32_* and i64_* ops work on unboxed ints: plain Python ints on the
+stack, in the registers of toyvm.regvm and in frame.islots, instead of
+W_Ints. The result of add, sub, mul and shl is wrapped to the width of the
+op in two's complement, as in C or WebAssembly; the shift count is taken
+modulo the width, and shr is an arithmetic shift. The comparisons return a
+boxed W_Int, 0 or 1, which is preallocated.
+
+The compiler emits them for the builtins __i32_add__(a, b), __i64_xor__(a,
+b), etc., and converts at the boundaries with the rest of the code:
+iN_unbox turns a W_Int into an unboxed int (wrapping it), iN_box goes the
+other way, and i32_wrap turns an unboxed i64 into an i32. A local which is
+assigned only unboxed ints of the same width lives in a slot of
+frame.islots (see FuncDefCompiler.compute_typed_locals), so a numeric
+kernel allocates a W_Int only when a value escapes, e.g. when it's
+returned.
+"""
+
+from toyvm.objects import W_Int
+from toyvm.opcode import INT_BINOPS
+
+# name of the builtin -> opname, e.g. '__i32_add__' -> 'i32_add'
+BUILTINS = {f'__{opname}__': opname for opname in INT_BINOPS}
+
+W_FALSE = W_Int(0)
+W_TRUE = W_Int(1)
+
+
+def wrap32(value):
+    value &= 0xFFFFFFFF
+    if value & 0x80000000:
+        value -= 0x100000000
+    return value
+
+def wrap64(value):
+    value &= 0xFFFFFFFFFFFFFFFF
+    if value & 0x8000000000000000:
+        value -= 0x10000000000000000
+    return value
+
+
+def make_binops(bits, wrap):
+    """
+    Return {opname: func} for the binary ops of the given width. The
+    operands are always in range, so the bitwise ops and shr don't need to
+    wrap their result
+    """
+    mask = bits - 1
+    return {
+        f'i{bits}_add': lambda a, b: wrap(a + b),
+        f'i{bits}_sub': lambda a, b: wrap(a - b),
+        f'i{bits}_mul': lambda a, b: wrap(a * b),
+        f'i{bits}_and': lambda a, b: a & b,
+        f'i{bits}_or': lambda a, b: a | b,
+        f'i{bits}_xor': lambda a, b: a ^ b,
+        f'i{bits}_shl': lambda a, b: wrap(a << (b & mask)),
+        f'i{bits}_shr': lambda a, b: a >> (b & mask),
+        f'i{bits}_lt': lambda a, b: W_TRUE if a < b else W_FALSE,
+        f'i{bits}_gt': lambda a, b: W_TRUE if a > b else W_FALSE,
+        f'i{bits}_eq': lambda a, b: W_TRUE if a == b else W_FALSE,
+    }
+
+def unbox32(w_a):
+    assert w_a.type == 'int'
+    return wrap32(w_a.value)
+
+def unbox64(w_a):
+    assert w_a.type == 'int'
+    return wrap64(w_a.value)
+
+
+BINOPS = {**make_binops(32, wrap32), **make_binops(64, wrap64)}
+assert list(BINOPS) == INT_BINOPS
+
+UNOPS = {
+    'i32_unbox': unbox32,
+    'i64_unbox': unbox64,
+    'i32_box': W_Int,
+    'i64_box': W_Int,
+    'i32_wrap': wrap32,
+}
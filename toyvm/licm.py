@@ -0,0 +1,220 @@
+"""
+Loop-invariant code motion.
+
+licm() looks for the red loops of a CodeObject, which the compiler and
+peval emit with this structure:
+
+    get_iter @iter
+    for:
+      for_iter @iter x endfor
+      ...
+      br for
+    endfor:
+
+Inside the loop, an invariant expression is a sequence of ops which
+computes a single value using only ops in PURE_OPS (except unroll), whose
+leaves are constants or locals which are not stored anywhere in the loop
+(including the loop variables of the loop itself and of the nested ones).
+Each maximal invariant expression which contains at least one op besides
+the loads is moved to the preheader, where its value is stored in a new
+local @licm_N, and replaced by a load_local of it.
+
+The pure ops can still fail, e.g. add with a W_Str and a W_Int: we must
+not execute them if the original program doesn't. So, only the
+expressions which are executed by every iteration are hoisted, i.e. the
+ones in a block which dominates all the back edges and all the exits of
+the loop (see toyvm.cfg). Moreover, the preheader runs only if the loop
+runs at least once: it is guarded by a copy of the for_iter, which also
+computes the first item, and then jumps into the body:
+
+    get_iter @iter
+    for_iter @iter x endfor       <== the preheader
+    ...
+    store_local @licm_0
+    br for_body
+    for:
+      for_iter @iter x endfor
+    for_body:
+      ...
+      br for
+    endfor:
+
+Loops are processed from the outermost, so that an expression which is
+invariant also for the outer loop is moved out of both, but only if the
+inner loop is executed by every iteration of the outer one.
+"""
+
+from toyvm.opcode import CodeObject, OpCode, PURE_OPS, INT_OPS
+from toyvm.verifier import verify
+from toyvm.cfg import CFG
+
+# unroll is pure, but it creates an iterator which is consumed: each
+# iteration needs its own. The fixed-width integer ops are pure too, but
+# most of them compute unboxed ints, which can't be stored in a local
+HOISTABLE_OPS = PURE_OPS - {'unroll'} - INT_OPS
+
+# ops which read a local: their value is invariant if the local is not
+# stored in the loop
+LOAD_LOCAL_OPS = ('load_local', 'load_local_green')
+STORE_LOCAL_OPS = ('store_local', 'store_local_green')
+
+
+def licm(code):
+    """
+    Return a new CodeObject, or code itself if there is nothing to hoist
+    """
+    body = list(code.body)
+    counter = 0
+    i = 0
+    changed = False
+    while i < len(body):
+        loop = find_loop(body, i)
+        if loop is not None:
+            executed = always_executed(code, body, *loop)
+            exprs = find_invariants(body, *loop, executed)
+            if exprs:
+                body, i, counter = hoist(body, loop[0], exprs, counter)
+                changed = True
+        i += 1
+    if not changed:
+        return code
+    code2 = CodeObject(code.name, code.argnames, body,
+                       freevars=code.freevars, islots=code.islots)
+    verify(code2)
+    return code2
+
+
+def stored_locals(ops):
+    """
+    Return the names of the locals which are assigned by the given ops,
+    including the loop variables
+    """
+    stored = set()
+    for op in ops:
+        if op.name in STORE_LOCAL_OPS:
+            stored.add(op.args[0])
+        elif op.name == 'for_iter':
+            stored.add(op.args[1])
+    return stored
+
+
+def find_loop(body, i):
+    """
+    If body[i] is the label of a loop header, return (i, pc_endfor), where
+    pc_endfor is the pc of the endfor label. Else, return None.
+    """
+    op = body[i]
+    if op.name != 'label' or i + 1 >= len(body):
+        return None
+    next_op = body[i+1]
+    if next_op.name != 'for_iter':
+        return None
+    endfor = next_op.args[2]
+    for j in range(i + 2, len(body)):
+        if body[j].name == 'label' and body[j].args[0] == endfor:
+            return i, j
+    return None
+
+
+def always_executed(code, body, start, end):
+    """
+    Return the set of the pcs of the loop between start and end which are
+    executed by every iteration
+    """
+    cfg = CFG(CodeObject(code.name, code.argnames, body,
+                         freevars=code.freevars, islots=code.islots))
+    header = body[start].args[0]
+    blocks = [block for block in cfg.rpo if start < block.pc_start < end]
+    # the blocks which end an iteration
+    ends = []
+    for block in blocks:
+        op = block.terminator
+        if op is None:
+            continue
+        if ((op.name == 'br' and op.args[0] == header) or
+            op.name in ('return', 'tail_call', 'abort')):
+            ends.append(block)
+    result = set()
+    for block in blocks:
+        if all(cfg.dominates(block, end_block) for end_block in ends):
+            result.update(range(block.pc_start, block.pc_end))
+    return result
+
+def find_invariants(body, start, end, executed):
+    """
+    Return the list of (pc_start, pc_end) of the maximal invariant
+    expressions between start and end, considering only the pcs in
+    executed
+    """
+    stored = stored_locals(body[start:end])
+    #
+    result = []
+    # symbolic stack: (pc_start, pc_end, is_trivial) for the values computed
+    # by the invariant expression body[pc_start:pc_end], or None for the
+    # other values
+    stack = []
+    for pc in range(start, end):
+        op = body[pc]
+        if (pc in executed and op.name in LOAD_LOCAL_OPS and
+            op.args[0] not in stored):
+            stack.append((pc, pc+1, True))
+            continue
+        pops = op.num_pops()
+        args = stack[len(stack)-pops:]
+        del stack[len(stack)-pops:]
+        if (pc in executed and op.name in HOISTABLE_OPS and
+            op.num_pushes() == 1 and is_contiguous(args, pc)):
+            if args:
+                stack.append((args[0][0], pc+1, False))
+            else:
+                stack.append((pc, pc+1, True)) # e.g. load_const
+            continue
+        # the args are consumed by a non-invariant op: they are maximal
+        for arg in args:
+            if arg is not None and not arg[2]:
+                result.append(arg[:2])
+        stack += [None] * op.num_pushes()
+    return result
+
+def is_contiguous(args, pc):
+    """
+    Check that the args are computed by consecutive invariant expressions
+    which end just before pc
+    """
+    if None in args:
+        return False
+    for arg1, arg2 in zip(args, args[1:]):
+        if arg1[1] != arg2[0]:
+            return False
+    return not args or args[-1][1] == pc
+
+
+def hoist(body, pc_header, exprs, counter):
+    """
+    Return (new body, new pc of the header, new counter)
+    """
+    header = body[pc_header]
+    for_iter = body[pc_header+1]
+    body_label = f'{header.args[0]}_body'
+    preheader = [for_iter.copy()]
+    replacements = {} # pc_start -> (pc_end, name)
+    for pc_start, pc_end in exprs:
+        name = f'@licm_{counter}'
+        counter += 1
+        preheader += [op.copy() for op in body[pc_start:pc_end]]
+        preheader.append(OpCode('store_local', name))
+        replacements[pc_start] = (pc_end, name)
+    preheader.append(OpCode('br', body_label))
+    new_body = body[:pc_header] + preheader + [
+        header, for_iter, OpCode('label', body_label)]
+    pc_new_header = pc_header + len(preheader)
+    pc = pc_header + 2
+    while pc < len(body):
+        if pc in replacements:
+            pc_end, name = replacements[pc]
+            new_body.append(OpCode('load_local', name))
+            pc = pc_end
+        else:
+            new_body.append(body[pc])
+            pc += 1
+    return new_body, pc_new_header, counter
@@ -1,14 +1,15 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from toyvm.opcode import CodeObject
 
 class W_Object:
+    __slots__ = ()
     type = 'object'
 
     def get_iter(self):
         raise TypeError(f"cannot call get_iter on instances of '{self.type}'")
 
 
-@dataclass
+@dataclass(slots=True)
 class W_Int(W_Object):
     type = 'int'
     value: int
@@ -19,10 +20,92 @@ class W_Int(W_Object):
     def str(self):
         return str(self.value)
 
-@dataclass
 class W_Str(W_Object):
+    """
+    A toy string.
+
+    To avoid quadratic behavior when building strings by repeated
+    concatenation, concat() and repeat() don't build the result eagerly.
+    The actual string is computed only when someone reads .value, and then
+    it is cached. This is completely transparent to the users of W_Str.
+
+    A W_Str can be:
+      - flat: _value is the string;
+      - a builder: the string is ''.join(_parts[:_n]). concat() appends to
+        _parts in place when it can, i.e. when nobody else appended to it
+        in the meantime: this way, each concatenation is O(1) and the
+        intermediate results don't keep each other alive;
+      - a repetition: the string is _base.value * _count.
+    """
+    __slots__ = ('_value', '_parts', '_n', '_base', '_count', 'length')
     type = 'str'
-    value: str
+
+    # concatenations shorter than this are done eagerly
+    SHORT = 64
+
+    def __init__(self, value):
+        self._value = value
+        self._parts = None
+        self._n = 0
+        self._base = None
+        self._count = 0
+        self.length = len(value)
+
+    @staticmethod
+    def _lazy(length, parts=None, base=None, count=0):
+        w_res = W_Str.__new__(W_Str)
+        w_res._value = None
+        w_res._parts = parts
+        w_res._n = len(parts) if parts is not None else 0
+        w_res._base = base
+        w_res._count = count
+        w_res.length = length
+        return w_res
+
+    def concat(self, w_other):
+        length = self.length + w_other.length
+        if (length <= self.SHORT and self._value is not None and
+            w_other._value is not None):
+            return W_Str(self._value + w_other._value)
+        parts = self._parts
+        if parts is None:
+            parts = [self.value]
+        elif self._n != len(parts):
+            # someone else already appended to our parts: we need a copy
+            parts = parts[:self._n]
+        parts.append(w_other.value)
+        return self._lazy(length, parts=parts)
+
+    def repeat(self, n):
+        n = max(n, 0)
+        length = self.length * n
+        if length <= self.SHORT:
+            return W_Str(self.value * n)
+        return self._lazy(length, base=self, count=n)
+
+    @property
+    def value(self):
+        if self._value is None:
+            parts = self._parts
+            if parts is not None:
+                if self._n != len(parts):
+                    parts = parts[:self._n]
+                self._value = ''.join(parts)
+            else:
+                self._value = self._base.value * self._count
+            self._parts = None
+            self._base = None
+        return self._value
+
+    def __eq__(self, other):
+        if other.__class__ is not W_Str:
+            return NotImplemented
+        return self.length == other.length and self.value == other.value
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (W_Str, (self.value,))
 
     def __repr__(self):
         return f'W_Str({self.value!r})'
@@ -32,17 +115,26 @@ class W_Str(W_Object):
 
 
 class Closure:
+    """
+    scopes is a list of dicts which are searched by name by lookup(), from
+    the last to the first. cells contains the values of the free variables
+    captured by make_function, in the order of code.freevars: they are
+    accessed by index.
+    """
+
+    __slots__ = ('name', 'scopes', 'cells')
 
-    def __init__(self, name, scopes):
+    def __init__(self, name, scopes, cells=()):
         self.name = name
         self.scopes = scopes
+        self.cells = cells
 
     def __repr__(self):
         return f"<Closure '{self.name}'>"
 
-    def copy_and_append(self, name, ns_w):
-        new_scopes = self.scopes + [ns_w]
-        return Closure(name, new_scopes)
+    def with_cells(self, name, cells_w):
+        # the scopes are never modified, so we can share them
+        return Closure(name, self.scopes, cells_w)
 
     def lookup(self, name):
         for ns_w in reversed(self.scopes):
@@ -50,30 +142,55 @@ class Closure:
                 return ns_w[name]
         raise KeyError(name)
 
-@dataclass
+@dataclass(slots=True)
 class W_Function(W_Object):
     type = 'function'
-    is_green = False
     #
     name: str
     code: CodeObject
     closure: Closure
-
-    def call(self, *args_w):
-        from toyvm.frame import Frame
-        frame = Frame(self)
+    is_green: bool = field(default=False, repr=False, compare=False)
+    tier: object = field(default=None, repr=False, compare=False)
+
+    def make_frame(self, *args_w, fuel=None):
+        from toyvm.frame import Frame, FastFrame
+        from toyvm.packed import PackedCode, PackedFrame
+        from toyvm.regvm import RegCode, RegFrame
+        if self.tier is not None:
+            self.tier.count_call() # see toyvm.guards
+        if isinstance(self.code, RegCode):
+            frame = RegFrame(self, args_w)
+            if fuel is not None:
+                frame.set_fuel(fuel)
+            return frame
+        if isinstance(self.code, PackedCode):
+            frame = PackedFrame(self)
+        elif self.code.verified is not None:
+            frame = FastFrame(self)
+        else:
+            frame = Frame(self)
         # setup parameters
         assert len(self.code.argnames) == len(args_w)
         for varname, w_arg in zip(self.code.argnames, args_w):
             frame.locals[varname] = w_arg
-        #
-        return frame.run()
+        if fuel is not None:
+            frame.set_fuel(fuel)
+        return frame
+
+    def call(self, *args_w, fuel=None):
+        frame = self.make_frame(*args_w, fuel=fuel)
+        while True:
+            w_res = frame.run()
+            if frame.tail_frame is None:
+                return w_res
+            # tail call: continue in the new frame, without recursion
+            frame = frame.tail_frame
 
     def str(self):
         return f"<toy function '{self.name}'>"
 
 
-@dataclass
+@dataclass(slots=True)
 class W_Tuple(W_Object):
     type = 'tuple'
     items_w: list[W_Object]
@@ -88,11 +205,12 @@ class W_Tuple(W_Object):
     def unroll(self):
         return W_TupleIterator(self, unroll=True)
 
-@dataclass
+@dataclass(slots=True)
 class W_TupleIterator(W_Object):
     type = 'tuple_iterator'
     w_tuple: W_Tuple
     unroll: bool
+    _iter: object = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
         self._iter = iter(self.w_tuple.items_w)
@@ -104,23 +222,107 @@ class W_TupleIterator(W_Object):
         return next(self._iter, 'STOP')
 
 
-@dataclass
+@dataclass(slots=True)
 class W_NoneType(W_Object):
     type = 'NoneType'
 
     def __repr__(self):
         return 'w_None'
 
+    def __reduce__(self):
+        # pickle by reference, to preserve the identity of the singleton
+        return 'w_None'
+
     def str(self):
         return '<toy None>'
 
 w_None = W_NoneType()
 
 
-@dataclass
+class Globals(dict):
+    """
+    The dict of the globals of a module.
+
+    It notifies the changes to the watchers: watchers[name] is a set of
+    objects whose global_changed(name) method is called when name is
+    assigned or deleted. See toyvm.guards.
+
+    When pickled, the watchers which have a true 'transient' attribute are
+    dropped: they guard caches which are not saved either (e.g.
+    toyvm.guards.DepsGuard). The others, e.g. toyvm.guards.Tier, are saved,
+    since they guard specialized code which is part of the heap.
+    """
+    __slots__ = ('watchers',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.watchers = {}
+
+    def __reduce__(self):
+        watchers = {}
+        for name, objs in self.watchers.items():
+            objs = {obj for obj in objs
+                    if not getattr(obj, 'transient', False)}
+            if objs:
+                watchers[name] = objs
+        return (Globals, (), (None, {'watchers': watchers}), None,
+                iter(self.items()))
+
+    def watch(self, name, watcher):
+        self.watchers.setdefault(name, set()).add(watcher)
+
+    def unwatch(self, name, watcher):
+        watchers = self.watchers.get(name)
+        if watchers:
+            watchers.discard(watcher)
+
+    def changed(self, name):
+        watchers = self.watchers.get(name)
+        if watchers:
+            for watcher in list(watchers):
+                watcher.global_changed(name)
+
+    def __setitem__(self, name, w_value):
+        changed = self.get(name) is not w_value
+        super().__setitem__(name, w_value)
+        if changed:
+            self.changed(name)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.changed(name)
+
+    def pop(self, name, *default):
+        res = super().pop(name, *default)
+        self.changed(name)
+        return res
+
+    def setdefault(self, name, w_value=None):
+        if name not in self:
+            self[name] = w_value
+        return self[name]
+
+    def update(self, *args, **kwargs):
+        for name, w_value in dict(*args, **kwargs).items():
+            self[name] = w_value
+
+    def popitem(self):
+        name, w_value = super().popitem()
+        self.changed(name)
+        return name, w_value
+
+    def clear(self):
+        names = list(self)
+        super().clear()
+        for name in names:
+            self.changed(name)
+
+
+@dataclass(slots=True)
 class W_Module(W_Object):
     type = 'module'
-    globals_w: dict[str, W_Object]
+    globals_w: Globals[str, W_Object]
+    green_funcs: set = field(default_factory=set, repr=False, compare=False)
 
     def get_closure(self):
         return Closure('globals', [self.globals_w])
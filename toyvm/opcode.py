@@ -12,19 +12,39 @@ STACK_EFFECT = {
     'store_local_green': (1, 0),
     'load_nonlocal': (0, 1),
     'load_nonlocal_green': (0, 1),
+    'load_cell': (0, 1),
+    'load_cell_green': (0, 1),
     'return': (1, 0),
     'abort': (0, 0),
     'add': (2, 1),
     'mul': (2, 1),
     'lt': (2, 1),
     'gt': (2, 1),
-    'i32_add': (2, 1),
+    # fixed-width integer ops which are not binary, see toyvm.intops. The
+    # binary ones are added below
+    'i32_unbox': (1, 1),
+    'i64_unbox': (1, 1),
+    'i32_box': (1, 1),
+    'i64_box': (1, 1),
+    'i32_wrap': (1, 1),
+    'load_islot': (0, 1),
+    'store_islot': (1, 0),
+    # type-specialized variants, used only by toyvm.quicken
+    'add_int': (2, 1),
+    'add_str': (2, 1),
+    'mul_int': (2, 1),
+    'mul_str': (2, 1),
+    'lt_int': (2, 1),
+    'lt_str': (2, 1),
+    'gt_int': (2, 1),
+    'gt_str': (2, 1),
     'label': (0, 0),
     'br_if': (1, 0),
     'br': (0, 0),
     'make_tuple': ('ARG', 1), # special, num_pops depends on the arg
     'print': ('ARG', 1),
-    'call': ('ARG', 1),
+    'call': ('ARG+1', 1), # pops the args and the callable
+    'tail_call': ('ARG+1', 0), # like call, but also returns
     'pop': (1, 0),
     'get_iter': (1, 0),
     'for_iter': (0, 0),
@@ -32,17 +52,63 @@ STACK_EFFECT = {
     'make_function': (0, 1),
 }
 
+# binary fixed-width integer ops: they pop two unboxed ints. See
+# toyvm.intops for their semantics
+INT_BINOPS = [f'i{bits}_{name}' for bits in (32, 64)
+              for name in ('add', 'sub', 'mul', 'and', 'or', 'xor', 'shl',
+                           'shr', 'lt', 'gt', 'eq')]
+STACK_EFFECT.update((opname, (2, 1)) for opname in INT_BINOPS)
+# the comparisons push a boxed W_Int
+INT_COMPARE_OPS = {opname for opname in INT_BINOPS
+                   if opname[4:] in ('lt', 'gt', 'eq')}
+
+# all the fixed-width integer ops except load_islot and store_islot, which
+# are not pure
+INT_OPS = set(INT_BINOPS) | {'i32_unbox', 'i64_unbox', 'i32_box', 'i64_box',
+                             'i32_wrap'}
+
 PURE_OPS = set([
     'load_const',
     'add',
     'mul',
-    'i32_add',
     'make_tuple',
     'unroll',
     'load_nonlocal_green',
-])
+    'load_cell_green',
+]) | INT_OPS
+
+# the kind of the arguments of each op: 'const', 'name', 'label' or 'int'.
+# Ops which are not listed take no arguments. See toyvm.packed
+OPARGS = {
+    'load_const': ('const',),
+    'load_local': ('name',),
+    'store_local': ('name',),
+    'load_local_green': ('name',),
+    'store_local_green': ('name',),
+    'load_nonlocal': ('name',),
+    'load_nonlocal_green': ('name',),
+    'load_cell': ('int',),
+    'load_cell_green': ('int',),
+    'load_islot': ('int',),
+    'store_islot': ('int',),
+    'abort': ('const',),
+    'label': ('label',),
+    'br_if': ('label', 'label', 'label'),
+    'br': ('label',),
+    'make_tuple': ('int',),
+    'print': ('int',),
+    'call': ('int',),
+    'tail_call': ('int',),
+    'get_iter': ('name',),
+    'for_iter': ('name', 'name', 'label'),
+    'make_function': ('const',),
+}
+
+# numeric opcodes, used by the compact encodings
+OPNAMES = list(STACK_EFFECT)
+OPNUMS = {name: i for i, name in enumerate(OPNAMES)}
 
-@dataclass
+@dataclass(slots=True)
 class OpCode:
     name: str
     args: tuple
@@ -55,6 +121,10 @@ class OpCode:
     def __repr__(self):
         return f'<OpCode "{self.str()}">'
 
+    def __reduce__(self):
+        # much more compact than the default pickling of slotted objects
+        return (OpCode, (self.name,) + self.args)
+
     def str(self):
         parts = [self.name] + list(map(str, self.args))
         return ' '.join(parts)
@@ -73,14 +143,15 @@ class OpCode:
         pops = STACK_EFFECT[self.name][0]
         if pops == 'ARG':
             return self.args[0]
+        elif pops == 'ARG+1':
+            return self.args[0] + 1
         return pops
 
     def num_pushes(self):
         return STACK_EFFECT[self.name][1]
 
     def stack_effect(self):
-        pops, pushes = STACK_EFFECT[self.name]
-        return pushes - pops
+        return self.num_pushes() - self.num_pops()
 
     def relabel(self, label_map):
         if self.name in ('br', 'br_if', 'label'):
@@ -94,17 +165,53 @@ class OpCode:
         return OpCode(self.name, *args)
 
 class CodeObject:
+    __slots__ = ('name', 'argnames', 'body', 'freevars', 'islots',
+                 'verified', 'quickened', 'site_stats', 'block_costs',
+                 'osr_target', 'origin', 'spec_variants')
 
-    def __init__(self, name, argnames, body):
+    def __init__(self, name, argnames, body, *, freevars=(), islots=()):
         self.name = name
         self.argnames = argnames
         self.body = body
+        self.freevars = freevars # names of the variables in closure.cells
+        self.islots = islots # names of the locals in frame.islots
+        self.verified = None # set by toyvm.verifier.verify
+        self.quickened = None # see toyvm.quicken
+        self.site_stats = None
+        self.block_costs = None # see toyvm.fuel
+        self.osr_target = None # see toyvm.osr
+        # the code which peval specialized to produce this one, and the
+        # versions of this code specialized on the values of its arguments:
+        # see toyvm.rainbow.SpecializationCache
+        self.origin = None
+        self.spec_variants = None
+
+    # caches which are valid only in the current process: they are not
+    # saved by pickle (see toyvm.snapshot)
+    PROCESS_CACHES = ('quickened', 'site_stats', 'osr_target',
+                      'spec_variants')
 
     def __repr__(self):
         return f'<CodeObject {self.name!r}>'
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__
+                if name not in self.PROCESS_CACHES}
+
+    def __setstate__(self, state):
+        for name in self.PROCESS_CACHES:
+            setattr(self, name, None)
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def emit(self, op):
         self.body.append(op)
+        self.verified = None
+        self.quickened = None
+        self.site_stats = None
+        self.block_costs = None
+        self.osr_target = None
+        self.spec_variants = None
 
     def dump(self, *, show_pc=False, use_colors=False):
         lines = []
@@ -0,0 +1,121 @@
+"""
+On-stack replacement.
+
+A function which is called once but runs a long loop never reaches the
+call-count threshold of toyvm.guards. Instead, each Frame counts the
+back-edges it takes (the 'br' at the end of each 'for' loop). When the
+count reaches THRESHOLD, the function is pevaled and, if the output
+contains the same loop, the frame switches to the specialized code and
+continues at its header: the locals (including the iterator) and the
+stack are kept as they are.
+
+This is possible only if the state at the loop header means the same thing
+in both versions of the code. The compiler never leaves values on the
+stack across a 'for', and peval keeps the names of the red locals and of
+the labels of the red loops, so we only need to check that:
+
+  - the loop was not renamed by peval (e.g. because it is inside an
+    unrolled loop), so that we can find its header;
+
+  - the stack depth at the header is the same;
+
+  - the loop doesn't assign green variables, including its own target in
+    the case of UNROLL(): the values that peval folds into the loop would
+    be different from the ones of the current frame.
+
+Each frame tries OSR at most once. The specialized code is cached in
+code.osr_target, or code.osr_target is False if OSR is not possible at
+all, including when peval fails. The globals which peval can fold are watched (see
+toyvm.guards.DepsGuard): when one of them is reassigned, code.osr_target
+is reset and the next OSR pevals the function again.
+"""
+
+from toyvm import quicken
+from toyvm.fuel import get_block_costs
+
+THRESHOLD = 1000
+
+
+def try_osr(frame):
+    """
+    Called by Frame.op_br when the back-edge counter reaches THRESHOLD.
+    frame.pc is the pc of the label of the loop header.
+
+    Return True if the frame has been switched to the specialized code.
+    """
+    frame.backedges = None # don't try again
+    code = frame.code
+    if code.osr_target is False or frame.w_func.is_green:
+        return False
+    label = code.body[frame.pc].args[0]
+    if not loop_is_red(code, frame.pc):
+        return False
+    target = get_target(frame.w_func)
+    if target is None:
+        return False
+    pc = target.verified.labels.get(label)
+    if pc is None or target.verified.depths[pc] != len(frame.stack):
+        return False
+    #
+    frame.code = target
+    if frame.quickening:
+        frame.body = quicken.get_body(target)
+    else:
+        frame.body = target.body
+    frame.labels = target.verified.labels
+    frame.pc = pc
+    if frame.fuel is not None:
+        frame.block_costs = get_block_costs(target).at_label
+    return True
+
+def get_target(w_func):
+    """
+    Return the verified specialized code for w_func, or None
+    """
+    from toyvm.rainbow import peval
+    from toyvm.guards import DepsGuard, can_watch
+    code = w_func.code
+    if code.osr_target is not None:
+        return code.osr_target or None
+    # peval supports make_function only inside green functions
+    if any(op.name == 'make_function' for op in code.body):
+        w_spec = w_func
+    else:
+        try:
+            w_spec = peval(w_func)
+        except Exception:
+            # OSR is an optimization: a function which peval rejects (e.g.
+            # because of UNROLL() on a red value) keeps running as it is
+            w_spec = w_func
+    if w_spec is w_func:
+        target = False
+    else:
+        target = w_spec.code
+        target.osr_target = False # it's already specialized
+    scopes = w_func.closure.scopes
+    if not code.freevars and can_watch(scopes):
+        # the output depends on the closure only via the cells, and on
+        # the globals, which we watch
+        code.osr_target = target
+        DepsGuard(code, 'osr_target', scopes).watch()
+    return target or None
+
+
+def loop_is_red(code, pc_label):
+    """
+    Check that the loop starting at the given label doesn't store any green
+    variable
+    """
+    op = code.body[pc_label + 1]
+    if op.name != 'for_iter':
+        return False
+    itername, targetname, endfor = op.args
+    if targetname.isupper():
+        # a loop over UNROLL(): peval unrolls it
+        return False
+    for op in code.body[pc_label+1:]:
+        if op.name == 'label' and op.args[0] == endfor:
+            return True
+        if op.name == 'store_local_green':
+            return False
+    return False
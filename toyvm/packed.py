@@ -0,0 +1,176 @@
+"""
+Compact encoding of code objects.
+
+Similarly to CPython's co_code, a PackedCode stores the ops in a flat
+array('i'). Each instruction is its opcode number (see opcode.OPNUMS)
+followed by one int per argument: ints are stored as they are, the other
+arguments are indices into the constant, name and label pools of the code
+(see opcode.OPARGS).
+
+label_offsets[i] is the offset in co_code of the label labels[i], so that
+jumps don't need any dict lookup. pack() and PackedCode.unpack() convert
+losslessly between the two forms.
+"""
+
+from array import array
+from toyvm.opcode import OpCode, CodeObject, OPARGS, OPNAMES, OPNUMS
+from toyvm.objects import W_Function
+from toyvm.frame import Frame
+
+# opnum -> kinds of its arguments
+OPARG_KINDS = [OPARGS.get(name, ()) for name in OPNAMES]
+RETURN = OPNUMS['return']
+CALL = OPNUMS['call']
+TAIL_CALL = OPNUMS['tail_call']
+
+
+class PackedCode:
+    __slots__ = ('name', 'argnames', 'freevars', 'islots', 'co_code',
+                 'consts', 'names', 'labels', 'label_offsets', 'block_costs')
+
+    def __init__(self, name, argnames, freevars, islots=()):
+        self.name = name
+        self.argnames = argnames
+        self.freevars = freevars
+        self.islots = islots
+        self.co_code = array('i')
+        self.consts = []
+        self.names = []
+        self.labels = []
+        self.label_offsets = array('i')
+        self.block_costs = None # see toyvm.fuel
+
+    def __repr__(self):
+        return f'<PackedCode {self.name!r}>'
+
+    def decode(self, offset):
+        """
+        Decode the instruction at the given offset: return
+        (opname, args, size)
+        """
+        co_code = self.co_code
+        opnum = co_code[offset]
+        kinds = OPARG_KINDS[opnum]
+        args = []
+        for i, kind in enumerate(kinds, offset+1):
+            arg = co_code[i]
+            if kind == 'const':
+                arg = self.consts[arg]
+            elif kind == 'name':
+                arg = self.names[arg]
+            elif kind == 'label':
+                arg = self.labels[arg]
+            args.append(arg)
+        return OPNAMES[opnum], args, len(kinds) + 1
+
+    def iter_ops(self):
+        """
+        Yield (offset, OpCode) for all the instructions
+        """
+        offset = 0
+        while offset < len(self.co_code):
+            name, args, size = self.decode(offset)
+            yield offset, OpCode(name, *args)
+            offset += size
+
+    def unpack(self):
+        body = [op for offset, op in self.iter_ops()]
+        return CodeObject(self.name, self.argnames, body,
+                          freevars=self.freevars, islots=self.islots)
+
+    def dump(self, **kwargs):
+        return self.unpack().dump(**kwargs)
+
+
+def pack(code):
+    """
+    Convert a CodeObject into a PackedCode
+    """
+    packed = PackedCode(code.name, code.argnames, code.freevars,
+                        code.islots)
+    const_idx = {} # id(obj) -> index; W_ objects are not hashable
+    name_idx = {}
+    label_idx = {}
+    label_offsets = {}
+
+    def index_of(pool, d, key, obj):
+        i = d.get(key)
+        if i is None:
+            i = d[key] = len(pool)
+            pool.append(obj)
+        return i
+
+    for op in code.body:
+        if op.name == 'label':
+            label_offsets[op.args[0]] = len(packed.co_code)
+        packed.co_code.append(OPNUMS[op.name])
+        for kind, arg in zip(OPARGS.get(op.name, ()), op.args, strict=True):
+            if kind == 'const':
+                arg = index_of(packed.consts, const_idx, id(arg), arg)
+            elif kind == 'name':
+                arg = index_of(packed.names, name_idx, arg, arg)
+            elif kind == 'label':
+                arg = index_of(packed.labels, label_idx, arg, arg)
+            packed.co_code.append(arg)
+    #
+    packed.label_offsets.extend(label_offsets[l] for l in packed.labels)
+    return packed
+
+
+class PackedFrame(Frame):
+    """
+    A Frame which executes a PackedCode directly. Here, self.pc is an offset
+    into co_code, also for fuel metering (see toyvm.fuel.BlockCosts).
+    Quickening and tracing are not supported.
+    """
+    __slots__ = ()
+
+    def __init__(self, w_func):
+        assert isinstance(w_func, W_Function)
+        assert isinstance(w_func.code, PackedCode)
+        code = w_func.code
+        labels = dict(zip(code.labels, code.label_offsets))
+        self.init_fields(w_func, None, labels, quickening=False, osr=False,
+                         tracing=False)
+
+    def next_pc(self):
+        # after a jump self.pc is the offset of the label, so we must look
+        # at the op which is there now, not at the one we just executed
+        return self.pc + len(OPARG_KINDS[self.code.co_code[self.pc]]) + 1
+
+    def run(self):
+        co_code = self.code.co_code
+        while True:
+            if co_code[self.pc] == RETURN:
+                n = len(self.stack)
+                assert n == 1, f'Wrong stack size upon return: {n}'
+                return self.pop()
+            elif co_code[self.pc] == TAIL_CALL:
+                self.tail_frame = self.make_tail_frame(co_code[self.pc+1])
+                return None
+            name, args, size = self.code.decode(self.pc)
+            getattr(self, f'op_{name}')(*args)
+            self.pc = self.next_pc()
+
+    def resume(self, steps):
+        co_code = self.code.co_code
+        n = 0
+        while n < steps:
+            opnum = co_code[self.pc]
+            n += 1
+            if opnum == RETURN:
+                self.w_result = self.pop()
+                return n
+            elif opnum == CALL:
+                items_w = self.popn(co_code[self.pc+1])
+                w_callable = self.pop()
+                self.child = w_callable.make_frame(*items_w, fuel=self.fuel)
+                self.pc = self.next_pc()
+                return n
+            elif opnum == TAIL_CALL:
+                self.tail_frame = self.make_tail_frame(co_code[self.pc+1])
+                return n
+            name, args, size = self.code.decode(self.pc)
+            getattr(self, f'op_{name}')(*args)
+            self.pc = self.next_pc()
+        return n
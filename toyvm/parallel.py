@@ -0,0 +1,209 @@
+"""
+Partial evaluation of whole modules, using a pool of processes.
+
+peval() of a function can read other globals of the module: the green
+functions referenced by load_nonlocal_green are called at peval time, and
+they can in turn load other globals, whose values end up folded into the
+output. If one of those globals is a function which is also being pevaled,
+we want to fold the specialized version, so it must be pevaled first.
+Calls through load_nonlocal are resolved at runtime and don't create a
+dependency.
+
+The functions are grouped in waves: each wave contains the functions whose
+dependencies have been pevaled by the previous waves, and the functions of
+a wave are pevaled in parallel.
+
+Each worker process receives a pickled copy of the module. Objects are
+sent back and forth with pickle, but references to the globals dict and to
+the global functions are sent by name (see _Pickler), so that the results
+are wired to the live objects of the receiving side.
+"""
+
+import io
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from toyvm.objects import W_Function
+from toyvm.opcode import CodeObject
+from toyvm.rainbow import peval_with_stats, PevalStats
+
+
+def peval_module(w_mod, *, workers=None, budget=None):
+    """
+    Peval all the non-green functions of the module, and replace them in
+    globals_w with their specialized version.
+
+    If workers is None or 1, everything is done in the current process.
+    Return the PevalStats of all the functions.
+    """
+    names = [name for name, w_obj in w_mod.globals_w.items()
+             if isinstance(w_obj, W_Function) and not w_obj.is_green]
+    deps = dependency_graph(w_mod, names)
+    stats = PevalStats()
+    if workers is None or workers == 1:
+        for wave in compute_waves(deps):
+            for name in wave:
+                w_func, fstats = peval_with_stats(w_mod.globals_w[name],
+                                                  budget=budget)
+                w_mod.globals_w[name] = w_func
+                stats.merge(fstats)
+                stats.time += fstats.time
+        return stats
+    #
+    data = _dumps(w_mod, None)
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(data,)) as pool:
+        for wave in compute_waves(deps):
+            # send the functions in a few batches per worker, to amortize
+            # the cost of the communication
+            n = max(1, len(wave) // (workers * 4))
+            futures = []
+            for i in range(0, len(wave), n):
+                batch = wave[i:i+n]
+                # the worker has the original version of the dependencies:
+                # send the specialized ones, by value
+                updates = {dep: w_mod.globals_w[dep]
+                           for name in batch
+                           for dep in transitive_deps(deps, name)
+                           if dep not in batch}
+                args = _dumps((batch, updates, budget), w_mod,
+                              by_value=updates)
+                futures.append(pool.submit(_peval_worker, args))
+            for fut in futures:
+                for name, w_func, fstats in _loads(fut.result(), w_mod):
+                    w_mod.globals_w[name] = w_func
+                    stats.merge(fstats)
+                    stats.time += fstats.time
+    return stats
+
+
+def dependency_graph(w_mod, names):
+    """
+    Return a dict {name: deps}, where deps is the set of functions among
+    names whose value can be folded into the output of peval(name)
+    """
+    names = set(names)
+    globals_w = w_mod.globals_w
+    return {name: find_deps(globals_w, globals_w[name].code) & names
+            for name in names}
+
+def find_deps(globals_w, code):
+    """
+    Return the names of all the globals which can be read at peval time by
+    the given code
+    """
+    seen = set()
+    result = set()
+    todo = [(code, False)]
+    while todo:
+        code, is_green = todo.pop()
+        if id(code) in seen:
+            continue
+        seen.add(id(code))
+        for op in code.body:
+            if op.name == 'load_nonlocal_green' or (
+                    op.name == 'load_nonlocal' and is_green):
+                name = op.args[0]
+                result.add(name)
+                w_obj = globals_w.get(name)
+                if isinstance(w_obj, W_Function) and w_obj.is_green:
+                    # it is called at peval time: everything it reads can
+                    # be folded
+                    todo.append((w_obj.code, True))
+                elif (isinstance(w_obj, W_Function) and
+                      isinstance(w_obj.code, CodeObject)):
+                    # the calls to it can be specialized on their constant
+                    # arguments, see RainbowInterpreter.specialize_call
+                    todo.append((w_obj.code, False))
+            elif op.name == 'make_function':
+                todo.append((op.args[0], is_green))
+    return result
+
+def transitive_deps(deps, name):
+    result = set()
+    todo = [name]
+    while todo:
+        for dep in deps[todo.pop()]:
+            if dep not in result:
+                result.add(dep)
+                todo.append(dep)
+    return result
+
+def compute_waves(deps):
+    """
+    Return a list of waves, i.e. lists of names which can be pevaled in
+    parallel, in dependency order. Functions which are part of a cycle are
+    pevaled together in the last wave.
+    """
+    waves = []
+    done = set()
+    todo = sorted(deps)
+    while todo:
+        wave = [name for name in todo if deps[name] - {name} <= done]
+        if not wave:
+            wave = todo
+        waves.append(wave)
+        done.update(wave)
+        todo = [name for name in todo if name not in done]
+    return waves
+
+
+# ======== pickling ========
+
+class _Pickler(pickle.Pickler):
+
+    def __init__(self, file, w_mod, by_value):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.w_mod = w_mod
+        self.by_value = by_value # names of the globals to send by value
+
+    def persistent_id(self, obj):
+        if self.w_mod is None:
+            return None
+        if obj is self.w_mod.globals_w:
+            return ('globals',)
+        if (isinstance(obj, W_Function) and
+            self.w_mod.globals_w.get(obj.name) is obj and
+            obj.name not in self.by_value):
+            return ('global', obj.name)
+        return None
+
+class _Unpickler(pickle.Unpickler):
+
+    def __init__(self, file, w_mod):
+        super().__init__(file)
+        self.w_mod = w_mod
+
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == 'globals':
+            return self.w_mod.globals_w
+        elif kind == 'global':
+            return self.w_mod.globals_w[pid[1]]
+        assert False, f'unknown persistent id: {pid}'
+
+def _dumps(obj, w_mod, by_value=()):
+    f = io.BytesIO()
+    _Pickler(f, w_mod, by_value).dump(obj)
+    return f.getvalue()
+
+def _loads(data, w_mod):
+    return _Unpickler(io.BytesIO(data), w_mod).load()
+
+
+# ======== worker side ========
+
+_worker_mod = None
+
+def _init_worker(data):
+    global _worker_mod
+    _worker_mod = _loads(data, None)
+
+def _peval_worker(args):
+    w_mod = _worker_mod
+    batch, updates, budget = _loads(args, w_mod)
+    w_mod.globals_w.update(updates)
+    results = []
+    for name in batch:
+        w_func, stats = peval_with_stats(w_mod.globals_w[name], budget=budget)
+        results.append((name, w_func, stats))
+    return _dumps(results, w_mod)
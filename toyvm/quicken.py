@@ -0,0 +1,89 @@
+"""
+Adaptive quickening of generic ops.
+
+Generic ops such as 'add' need to look at the types of their operands to
+decide what to do. After executing a generic op, the Frame calls
+specialize(), which rewrites the op in the quickened copy of the body with a
+type-specialized variant (e.g. 'add_int'). The specialized variant only does
+a cheap guard on the types: if the guard fails, it calls deoptimize() to put
+the generic op back.
+
+The quickened body is stored on the CodeObject, so that it is shared by all
+the frames which execute the same code. code.body is never modified.
+"""
+
+from dataclasses import dataclass
+from toyvm.opcode import OpCode
+
+# generic opname -> {(type_a, type_b): specialized opname}
+SPECIALIZATIONS = {
+    'add': {('int', 'int'): 'add_int', ('str', 'str'): 'add_str'},
+    'mul': {('int', 'int'): 'mul_int', ('str', 'int'): 'mul_str'},
+    'lt': {('int', 'int'): 'lt_int', ('str', 'str'): 'lt_str'},
+    'gt': {('int', 'int'): 'gt_int', ('str', 'str'): 'gt_str'},
+}
+
+# after this many deoptimizations, a site is considered megamorphic and
+# stays generic forever
+MAX_DEOPTS = 4
+
+@dataclass
+class SiteStats:
+    opname: str            # the generic op
+    current: str           # the op which is currently installed
+    specializations: int = 0
+    deopts: int = 0
+
+    def is_megamorphic(self):
+        return self.deopts >= MAX_DEOPTS
+
+
+def get_body(code):
+    """
+    Return the quickened copy of code.body, creating it if needed
+    """
+    if code.quickened is None:
+        code.quickened = list(code.body)
+        code.site_stats = {}
+    return code.quickened
+
+def specialize(code, pc, w_a, w_b):
+    op = code.body[pc]
+    stats = code.site_stats.get(pc)
+    if stats is None:
+        stats = code.site_stats[pc] = SiteStats(op.name, op.name)
+    if stats.is_megamorphic():
+        return
+    name = SPECIALIZATIONS[op.name].get((w_a.type, w_b.type))
+    if name is None:
+        return
+    code.quickened[pc] = OpCode(name)
+    stats.current = name
+    stats.specializations += 1
+
+def deoptimize(code, pc):
+    op = code.body[pc]
+    code.quickened[pc] = op
+    stats = code.site_stats[pc]
+    stats.current = op.name
+    stats.deopts += 1
+
+def get_stats(code):
+    """
+    Return a dict {pc: SiteStats} for all the sites which have been
+    specialized at least once, or which were executed generically
+    """
+    if code.site_stats is None:
+        return {}
+    return dict(sorted(code.site_stats.items()))
+
+def format_stats(code):
+    lines = [f'{code.name}:']
+    for pc, stats in get_stats(code).items():
+        line = (f'{pc:3d}: {stats.opname:<4} -> {stats.current:<8} '
+                f'specializations={stats.specializations} '
+                f'deopts={stats.deopts}')
+        if stats.is_megamorphic():
+            line += ' megamorphic'
+        lines.append(line)
+    return '\n'.join(lines)
@@ -1,36 +1,221 @@
-from dataclasses import dataclass
-from toyvm.objects import W_Object, W_Function
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields
+from toyvm.objects import (W_Object, W_Int, W_Str, W_Tuple, W_Function,
+                           W_TupleIterator)
 from toyvm.opcode import CodeObject, OpCode
 from toyvm.frame import Frame
+from toyvm.verifier import verify
+from toyvm.cfg import TERMINATORS
+from toyvm.licm import stored_locals
 
-def peval(w_func):
+
+class BudgetExceeded(Exception):
+    pass
+
+@dataclass
+class PevalBudget:
+    """
+    Limits to the work done by peval. None means unlimited.
+
+    If a function exceeds max_ops or max_unroll_depth, peval falls back to
+    the original, unspecialized function. If the green closures returned by
+    green calls would be pevaled deeper than max_peval_depth, they are left
+    unspecialized. In both cases, the reason is recorded in
+    PevalStats.fallbacks.
+    """
+    max_ops: int = None          # max number of ops emitted per function
+    max_unroll_depth: int = None # max nesting of unrolled loops
+    max_peval_depth: int = None  # max nesting of recursive peval
+
+@dataclass
+class PevalStats:
+    ops_folded: int = 0
+    ops_emitted: int = 0
+    loops_unrolled: int = 0
+    labels_created: int = 0
+    green_calls: int = 0
+    calls_specialized: int = 0
+    time: float = 0.0
+    fallbacks: list = field(default_factory=list)
+
+    def merge(self, other):
+        for f in fields(self):
+            if f.name != 'time':
+                setattr(self, f.name,
+                        getattr(self, f.name) + getattr(other, f.name))
+
+
+def peval(w_func, *, budget=None):
     """
     Perform partial evaluation on the given function object.
 
     Return a new function object where all green ops have been evaluated.
     This is the main entry point for the rainbow interpreter.
     """
-    interp = RainbowInterpreter(w_func)
-    interp.run()
+    w_func2, stats = peval_with_stats(w_func, budget=budget)
+    return w_func2
+
+def peval_with_stats(w_func, *, budget=None):
+    """
+    Same as peval, but return a tuple (w_func2, stats)
+    """
+    stats = PevalStats()
+    a = time.perf_counter()
+    w_func2 = _peval(w_func, budget, stats, depth=0)
+    b = time.perf_counter()
+    stats.time = b - a
+    return w_func2, stats
+
+def _peval(w_func, budget, stats, depth):
+    if (budget and budget.max_peval_depth is not None and
+        depth > budget.max_peval_depth):
+        stats.fallbacks.append(f'{w_func.name}: peval depth > '
+                               f'{budget.max_peval_depth}')
+        return w_func
+    # the stats of a failed attempt are thrown away, together with its
+    # output
+    mystats = PevalStats()
+    interp = RainbowInterpreter(w_func, budget=budget, stats=mystats,
+                                depth=depth)
+    try:
+        interp.run()
+    except BudgetExceeded as e:
+        stats.fallbacks.append(f'{w_func.name}: {e}')
+        return w_func
+    stats.merge(mystats)
     code2 = interp.out
+    code2.origin = w_func.code.origin or w_func.code
+    verify(code2)
     return W_Function(
         name = w_func.name,
         code = code2,
         closure = w_func.closure)
 
 
+def const_key(w_value):
+    """
+    Return a hashable key for the value of a constant argument, or None if
+    we don't specialize on it
+    """
+    if type(w_value) is W_Int:
+        return ('int', w_value.value)
+    elif type(w_value) is W_Str:
+        return ('str', w_value.value)
+    elif type(w_value) is W_Tuple:
+        items = tuple(const_key(w_item) for w_item in w_value.items_w)
+        if None in items:
+            return None
+        return ('tuple', items)
+    return None
+
+
+class SpecializationCache:
+    """
+    The versions of the functions specialized on the values of their
+    constant arguments, see RainbowInterpreter.specialize_call.
+
+    The variants are stored in code.spec_variants, where code is the
+    original code of the callee, before any peval: this way, they live as
+    long as the code, and they are shared by all the pevals of the callers.
+    They are dropped when one of the globals that they might have folded
+    changes (see toyvm.guards.DepsGuard), or when clear() is called.
+
+    The variants of each code object are kept in LRU order: when there are
+    more than max_variants, the least recently used one is evicted. If
+    max_variants is 0, calls are not specialized at all.
+    """
+
+    def __init__(self, max_variants=8):
+        self.max_variants = max_variants
+        self.pending = set() # the keys which are being specialized
+        self.evictions = 0
+        # code.spec_variants is (version, variants): the variants of
+        # another version belong to another cache, or have been cleared
+        self.version = object()
+
+    def get_variants(self, code):
+        """
+        Return an OrderedDict {(closure key, key): (closure, w_spec)}, or
+        None
+        """
+        if code.spec_variants is None:
+            return None
+        version, variants = code.spec_variants
+        if version is not self.version:
+            return None
+        return variants
+
+    def get(self, code, closure, key):
+        variants = self.get_variants(code)
+        if variants is None:
+            return None
+        entry = variants.get((closure_key(closure), key))
+        if entry is None:
+            return None
+        variants.move_to_end((closure_key(closure), key))
+        return entry[1]
+
+    def put(self, code, closure, key, w_spec):
+        from toyvm.guards import DepsGuard, can_watch
+        variants = self.get_variants(code)
+        if variants is None:
+            if not can_watch(closure.scopes):
+                return # we could not invalidate it
+            if code.spec_variants is None:
+                # else, the guard of the old version is still watching
+                DepsGuard(code, 'spec_variants', closure.scopes).watch()
+            variants = OrderedDict()
+            code.spec_variants = (self.version, variants)
+        # we keep the closure alive, so that the ids in its key are not
+        # reused
+        variants[(closure_key(closure), key)] = (closure, w_spec)
+        if len(variants) > self.max_variants:
+            variants.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        # called by toyvm.guards when a folded global changes
+        self.version = object()
+
+def closure_key(closure):
+    """
+    Closures are created anew by each call to the green function which
+    returns them: two closures are equivalent if they have the same scopes
+    and cells
+    """
+    return id(closure.scopes), tuple([id(w_cell) for w_cell in closure.cells])
+
+SPEC_CACHE = SpecializationCache()
+
+
 class RainbowInterpreter:
 
-    def __init__(self, w_func):
+    def __init__(self, w_func, *, budget=None, stats=None, depth=0):
         self.w_func = w_func
         self.code = w_func.code
         self.out = CodeObject(self.code.name + '<peval>',
-                              self.code.argnames, [])
+                              self.code.argnames, [],
+                              freevars=self.code.freevars,
+                              islots=self.code.islots)
         self.stack_length = 0
-        self.greenframe = Frame(w_func)
+        # for each slot of the red stack: (w_value, index in out.body) if it
+        # was pushed by a load_const, else None. See specialize_call
+        self.red_consts = []
+        self.greenframe = Frame(w_func, quickening=False, osr=False)
+        self.greenframe.tracer = None # its pcs are meaningless
+        # green locals which have been stored into red locals, because the
+        # arms of a red br_if assign different values to them. See
+        # merge_green_states
+        self.red_greens = set()
         #
         self.label_maps = []
         self.unique_id = 0
+        #
+        self.budget = budget or PevalBudget()
+        self.stats = stats or PevalStats()
+        self.depth = depth
+        self.unroll_depth = 0
 
     def push_label_map(self, pc_start, pc_end):
         """
@@ -47,14 +232,19 @@ class RainbowInterpreter:
                 label = op.args[0]
                 m[label] = f'{label}#{newid}'
         self.label_maps.append(m)
+        self.stats.labels_created += len(m)
 
     def pop_label_map(self):
         self.label_maps.pop()
 
     def emit(self, op):
+        max_ops = self.budget.max_ops
+        if max_ops is not None and len(self.out.body) >= max_ops:
+            raise BudgetExceeded(f'more than {max_ops} ops')
         if self.label_maps:
             op = op.relabel(self.label_maps[-1])
         self.out.emit(op)
+        self.stats.ops_emitted += 1
 
     def get_pc(self, label):
         """
@@ -103,7 +293,15 @@ class RainbowInterpreter:
 
     def flush(self):
         for w_value in self.greenframe.stack:
-            self.emit(OpCode('load_const', w_value))
+            if type(w_value) is int:
+                # an unboxed int, see toyvm.intops. i64_unbox gives back
+                # the same value also if it's an i32
+                self.red_consts.append(None)
+                self.emit(OpCode('load_const', W_Int(w_value)))
+                self.emit(OpCode('i64_unbox'))
+            else:
+                self.red_consts.append((w_value, len(self.out.body)))
+                self.emit(OpCode('load_const', w_value))
             self.stack_length += 1
         self.greenframe.stack = []
 
@@ -121,6 +319,7 @@ class RainbowInterpreter:
 
     def op_green(self, pc, op, *args):
         self.greenframe.run_op(op)
+        self.stats.ops_folded += 1
 
     def op_red(self, pc, op, *args):
         self.flush()
@@ -128,13 +327,22 @@ class RainbowInterpreter:
         assert self.stack_length >= pops # sanity check
         self.stack_length -= pops
         self.stack_length += op.num_pushes()
+        del self.red_consts[len(self.red_consts)-pops:]
+        self.red_consts += [None] * op.num_pushes()
         self.emit(op)
 
     def op_load_local_green(self, pc, op, varname):
+        if varname in self.red_greens:
+            return self.op_red(pc, OpCode('load_local', varname), varname)
         return self.op_green(pc, op, varname)
 
     def op_store_local_green(self, pc, op, varname):
-        assert self.n_greens() >= 1, 'store_local_green called on a red'
+        if self.n_greens() < 1:
+            # the value depends on a green local which a merge made red
+            self.greenframe.locals.pop(varname, None)
+            self.red_greens.add(varname)
+            return self.op_red(pc, OpCode('store_local', varname), varname)
+        self.red_greens.discard(varname)
         return self.op_green(pc, op, varname)
 
     def op_br_if(self, pc, op, then, else_, endif):
@@ -149,11 +357,160 @@ class RainbowInterpreter:
             return pc_endif
         else:
             self.op_red(pc, op, *op.args) # emit br_if
-            self.run_range(pc_then, pc_endif)
+            if pc_else == pc_endif:
+                self.red_if_then(pc_then, pc_endif, endif)
+            else:
+                self.red_if_then_else(pc_then, pc_else, pc_endif, endif)
             return pc_endif
 
+    # green state of the arms of a red br_if: each arm starts from the state
+    # before the br_if, and the states are merged at endif
+
+    def save_green_state(self):
+        return dict(self.greenframe.locals), set(self.red_greens)
+
+    def restore_green_state(self, state):
+        locals_w, red_greens = state
+        self.greenframe.locals = dict(locals_w)
+        self.red_greens = set(red_greens)
+
+    def reaches_endif(self, pc_last, endif):
+        """
+        Can the last op of an arm continue at endif?
+        """
+        info = self.code.verified or verify(self.code)
+        if info.depths[pc_last] is None:
+            return False
+        op = self.code.body[pc_last]
+        if op.name == 'br':
+            return op.args[0] == endif
+        return op.name not in TERMINATORS
+
+    def red_if_then(self, pc_then, pc_endif, endif):
+        """
+        'br_if then endif endif': the else arm is the edge from br_if to
+        endif. If a green local must be stored there, we add an else block
+        """
+        pc_br_if = len(self.out.body) - 1
+        state0 = self.save_green_state()
+        self.run_range(pc_then, pc_endif)
+        then_state = None
+        if self.reaches_endif(pc_endif - 1, endif):
+            then_state = self.save_green_state()
+        states = [state for state in (then_state, state0) if state is not None]
+        merged = self.merge_green_states(states)
+        if then_state is not None:
+            for op in self.store_red_greens(then_state, merged):
+                self.emit(op)
+        else_ops = self.store_red_greens(state0, merged)
+        if else_ops:
+            # the labels of out.body are already relabeled
+            then_label, _, endif_label = self.out.body[pc_br_if].args
+            else_label = f'{endif_label}_else'
+            self.out.body[pc_br_if] = OpCode('br_if', then_label, else_label,
+                                             endif_label)
+            if then_state is not None:
+                self.emit(OpCode('br', endif))
+            self.out.emit(OpCode('label', else_label))
+            self.stats.ops_emitted += 1
+            for op in else_ops:
+                self.emit(op)
+        self.restore_green_state(merged)
+
+    def red_if_then_else(self, pc_then, pc_else, pc_endif, endif):
+        """
+        'br_if then else endif': the stores of the then arm are inserted
+        before its 'br endif', once we know the state of the else arm
+        """
+        state0 = self.save_green_state()
+        pc_then_end = pc_else
+        if self.code.body[pc_else - 1].name == 'br':
+            pc_then_end -= 1 # the 'br endif' which ends the then arm
+        self.run_range(pc_then, pc_then_end)
+        then_state = None
+        if self.reaches_endif(pc_else - 1, endif):
+            then_state = self.save_green_state()
+        then_pos = len(self.out.body)
+        self.run_range(pc_then_end, pc_else)
+        #
+        self.restore_green_state(state0)
+        self.run_range(pc_else, pc_endif)
+        else_state = None
+        if self.reaches_endif(pc_endif - 1, endif):
+            else_state = self.save_green_state()
+        #
+        states = [state for state in (then_state, else_state)
+                  if state is not None]
+        merged = self.merge_green_states(states or [state0])
+        if else_state is not None:
+            for op in self.store_red_greens(else_state, merged):
+                self.emit(op)
+        if then_state is not None:
+            self.insert_ops(then_pos,
+                            self.store_red_greens(then_state, merged))
+        self.restore_green_state(merged)
+
+    def merge_green_states(self, states):
+        """
+        Merge the green states of the arms which reach endif. A green local
+        stays green if it has the same value in all of them, else it becomes
+        red: store_red_greens() stores it at the end of the arms where it is
+        still green. The iterators of UNROLL() loops are never used after
+        their loop, so we just drop them.
+        """
+        names = set()
+        for locals_w, red_greens in states:
+            names |= locals_w.keys() | red_greens
+        merged_w = {}
+        merged_red = set()
+        for name in names:
+            values_w = [locals_w.get(name) for locals_w, _ in states]
+            w_first = values_w[0]
+            if w_first is not None and all(
+                    self.same_green(w_first, w_value) for w_value in values_w):
+                merged_w[name] = w_first
+            elif not name.startswith('@'):
+                merged_red.add(name)
+        return merged_w, merged_red
+
+    def same_green(self, w_a, w_b):
+        if w_a is w_b:
+            return True
+        key = const_key(w_a)
+        return key is not None and key == const_key(w_b)
+
+    def store_red_greens(self, state, merged):
+        locals_w, _ = state
+        _, merged_red = merged
+        ops = []
+        for name in sorted(merged_red):
+            if name in locals_w:
+                ops.append(OpCode('load_const', locals_w[name]))
+                ops.append(OpCode('store_local', name))
+        return ops
+
+    def insert_ops(self, pos, ops):
+        """
+        Insert ops at the given position of out.body, which is not the end
+        """
+        if not ops:
+            return
+        self.out.body[pos:pos] = ops
+        self.out.verified = None
+        self.stats.ops_emitted += len(ops)
+        red_consts = []
+        for slot in self.red_consts:
+            if slot is not None and slot[1] >= pos:
+                slot = (slot[0], slot[1] + len(ops))
+            red_consts.append(slot)
+        self.red_consts = red_consts
+
     def op_get_iter(self, pc, op, itername):
-        is_red = self.n_greens() < 1 or not self.greenframe.stack[-1].unroll
+        # only UNROLL() iterators are green: a green tuple is iterated at
+        # runtime
+        is_red = (self.n_greens() < 1 or
+                  not isinstance(self.greenframe.stack[-1], W_TupleIterator)
+                  or not self.greenframe.stack[-1].unroll)
         if is_red:
             return self.op_red(pc, op, itername)
         else:
@@ -181,12 +538,19 @@ class RainbowInterpreter:
         assert targetname.isupper()
         pc_br = pc_endfor - 1
         assert self.code.body[pc_br].name == 'br' # op to loop back
+        max_depth = self.budget.max_unroll_depth
+        if max_depth is not None and self.unroll_depth >= max_depth:
+            raise BudgetExceeded(f'unroll depth > {max_depth}')
+        self.stats.loops_unrolled += 1
         #
+        self.unroll_depth += 1
         for w_item in w_iter._iter:
             self.greenframe.locals[targetname] = w_item
+            self.red_greens.discard(targetname)
             self.push_label_map(pc+1, pc_br)
             self.run_range(pc+1, pc_br)
             self.pop_label_map()
+        self.unroll_depth -= 1
         #
         return pc_endfor+1
 
@@ -194,18 +558,109 @@ class RainbowInterpreter:
         assert False, 'make_function can be used only inside a @green function'
 
     def op_call(self, pc, op, nargs):
+        if self.is_green_call(nargs):
+            self.green_call(pc, nargs)
+        else:
+            self.specialize_call(nargs)
+            self.op_red(pc, op, *op.args)
+
+    def op_tail_call(self, pc, op, nargs):
+        if self.is_green_call(nargs):
+            # the call is done at peval time: what remains is a return of
+            # the result
+            self.green_call(pc, nargs)
+            self.op_red(pc, OpCode('return'))
+        else:
+            self.specialize_call(nargs)
+            self.op_red(pc, op, *op.args)
+
+    def specialize_call(self, nargs):
+        """
+        A red call whose callee is known, and some of its arguments are
+        constants: replace the callee with a version specialized on the
+        values of those arguments. The call still passes all the arguments,
+        but the specialized version ignores the constant ones.
+        """
+        self.flush()
+        slots = self.red_consts[len(self.red_consts)-nargs-1:]
+        if slots[0] is None:
+            return
+        w_func, index = slots[0]
+        if not isinstance(w_func, W_Function):
+            return
+        code = w_func.code
+        if not isinstance(code, CodeObject) or len(code.argnames) != nargs:
+            return
+        # specialize the original code, not the output of peval: it would
+        # be pevaled twice, and each peval of the caller would get its own
+        # variants
+        code = code.origin or code
+        if any(op.name == 'make_function' for op in code.body):
+            return # it cannot be pevaled
+        consts = {}
+        stored = stored_locals(code.body)
+        for argname, slot in zip(code.argnames, slots[1:]):
+            # we can make an argument green only if it's never reassigned
+            if slot is not None and argname not in stored:
+                w_value = slot[0]
+                key = const_key(w_value)
+                if key is not None:
+                    consts[argname] = (w_value, key)
+        cache = SPEC_CACHE
+        if not consts or cache.max_variants == 0:
+            return
+        key = tuple((name, k) for name, (_, k) in consts.items())
+        w_spec = cache.get(code, w_func.closure, key)
+        if w_spec is None:
+            if (code, key) in cache.pending:
+                return # recursive specialization
+            cache.pending.add((code, key))
+            try:
+                w_spec = self.make_specialization(w_func, code, consts)
+            finally:
+                cache.pending.discard((code, key))
+            cache.put(code, w_func.closure, key, w_spec)
+        if w_spec is not w_func:
+            assert self.out.body[index].args[0] is w_func
+            self.out.body[index] = OpCode('load_const', w_spec)
+            self.stats.calls_specialized += 1
+
+    def make_specialization(self, w_func, code, consts):
+        body = []
+        for argname, (w_value, _) in consts.items():
+            body.append(OpCode('load_const', w_value))
+            body.append(OpCode('store_local_green', argname))
+        for op in code.body:
+            if op.name == 'load_local' and op.args[0] in consts:
+                op = OpCode('load_local_green', op.args[0])
+            body.append(op)
+        suffix = ','.join(f'{name}={w_value.str()}'
+                          for name, (w_value, _) in consts.items())
+        code2 = CodeObject(f'{code.name}<{suffix}>', code.argnames, body,
+                           freevars=code.freevars, islots=code.islots)
+        code2.origin = code
+        w_func2 = W_Function(w_func.name, code2, w_func.closure)
+        w_spec = _peval(w_func2, self.budget, self.stats, self.depth + 1)
+        if w_spec is w_func2:
+            # peval gave up: keep calling the original function
+            return w_func
+        return w_spec
+
+    def is_green_call(self, nargs):
         if self.n_greens() >= nargs + 1:
             w_func = self.greenframe.stack[-nargs-1]
-            if w_func.is_green:
-                self.op_green(pc, op, *op.args)
-                w_result = self.greenframe.stack[-1]
-                if isinstance(w_result, W_Function):
-                    self.recursive_peval()
-                return
-        self.op_red(pc, op, *op.args)
+            return w_func.is_green
+        return False
+
+    def green_call(self, pc, nargs):
+        self.op_green(pc, OpCode('call', nargs))
+        self.stats.green_calls += 1
+        w_result = self.greenframe.stack[-1]
+        if isinstance(w_result, W_Function):
+            self.recursive_peval()
 
     def recursive_peval(self):
         w_func = self.greenframe.pop()
         assert isinstance(w_func, W_Function)
-        w_func2 = peval(w_func)
+        w_func2 = _peval(w_func, self.budget, self.stats, self.depth + 1)
         self.greenframe.push(w_func2)
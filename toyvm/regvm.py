@@ -0,0 +1,620 @@
+"""
+A register-based executor.
+
+translate() converts a stack-based CodeObject (the output of the compiler
+or of peval) into a RegCode, where the operands of each instruction are
+explicit registers: the locals, the temporaries and the constants are all
+stored in a flat list of registers, regs. For example:
+
+    load_local a                    add a, a, W_Int(1)
+    load_const W_Int(1)      ==>
+    add
+    store_local a
+
+The translation keeps a symbolic stack, which contains the register
+holding the value of each stack slot. load_local and load_const just push
+the register of the local or of the constant, without emitting anything.
+Other ops emit an instruction which writes to the temporary of their stack
+slot: the i-th slot of the stack always uses the temporary t<i>. An
+instruction whose result is immediately stored in a local writes directly
+to the local, so the temporary is never used. At the boundaries of basic
+blocks, the stack is materialized in the temporaries, so that all the
+predecessors of a label agree on where the values are.
+
+Each instruction is a tuple (handler, a, b, c): the handler executes the
+instruction and returns the index of the next one. Quickening, tracing and
+OSR are not supported.
+
+Fuel is charged per basic block as in Frame, and in the same units: each
+block of instructions costs as much as the block of stack ops it was
+translated from (see RegCode.block_costs).
+"""
+
+from toyvm.objects import W_Int, W_Tuple, W_Function, w_None
+from toyvm.verifier import verify
+from toyvm.fuel import get_block_costs
+from toyvm import intops
+
+# counts the instructions dispatched by RegFrame.run, when it's not None:
+# this is meant only for benchmarks and tests, see count_insns()
+counter = None
+
+
+class RegCode:
+    __slots__ = ('name', 'argnames', 'freevars', 'insns', 'regnames',
+                 'template', 'entry_cost', 'block_costs')
+
+    def __init__(self, name, argnames, freevars):
+        self.name = name
+        self.argnames = argnames
+        self.freevars = freevars
+        self.insns = []    # list of (handler, a, b, c)
+        self.regnames = [] # for dump()
+        self.template = [] # the initial value of the registers
+        # the fuel cost of the ops before the first label, and {index of
+        # an instruction: cost of the block which starts there}. When
+        # several labels start at the same instruction, their costs are
+        # added: it's conservative, as in toyvm.fuel
+        self.entry_cost = 0
+        self.block_costs = {}
+
+    def __repr__(self):
+        return f'<RegCode {self.name!r}>'
+
+    def dump(self):
+        lines = []
+        for i, insn in enumerate(self.insns):
+            handler = insn[0]
+            opname = handler.__name__[3:] # strip 'op_'
+            args = []
+            for kind, arg in zip(KINDS[opname], insn[1:]):
+                if kind == 'reg':
+                    arg = self.regnames[arg]
+                elif kind == 'regs':
+                    arg = '(%s)' % ', '.join(self.regnames[r] for r in arg)
+                elif kind == 'pc':
+                    arg = f'@{arg}'
+                args.append(str(arg))
+            lines.append(f'{i:3d}: {opname} {", ".join(args)}'.rstrip())
+        return '\n'.join(lines)
+
+
+def translate(code):
+    """
+    Convert a CodeObject into a RegCode
+    """
+    return Translator(code).translate()
+
+
+class Translator:
+
+    def __init__(self, code):
+        self.code = code
+        info = code.verified or verify(code)
+        self.depths = info.depths
+        self.out = RegCode(code.name, code.argnames, code.freevars)
+        self.costs = get_block_costs(code)
+        self.out.entry_cost = self.costs.entry
+        self.regs = {} # key -> index
+        self.stack = [] # symbolic stack of registers
+        self.label_pcs = {} # label -> index of the instruction
+        self.retarget = None # see store()
+        for name in code.argnames:
+            self.local(name)
+
+    def reg(self, key, name, w_value=None):
+        r = self.regs.get(key)
+        if r is None:
+            r = self.regs[key] = len(self.out.template)
+            self.out.template.append(w_value)
+            self.out.regnames.append(name)
+        return r
+
+    def local(self, name):
+        return self.reg(('local', name), name)
+
+    def temp(self, i):
+        return self.reg(('temp', i), f't{i}')
+
+    def const(self, w_value):
+        # W_ objects are not hashable
+        return self.reg(('const', id(w_value)), repr(w_value), w_value)
+
+    def emit(self, opname, *args):
+        handler = HANDLERS[opname]
+        args = args + (None,) * (3 - len(args))
+        self.out.insns.append((handler,) + args)
+        self.retarget = None
+
+    def emit_result(self, opname, *args):
+        """
+        Emit an instruction which computes a new value, and push it
+        """
+        dst = self.temp(len(self.stack))
+        self.emit(opname, dst, *args)
+        self.stack.append(dst)
+        self.retarget = len(self.out.insns) - 1
+
+    def pop(self):
+        return self.stack.pop()
+
+    def popn(self, n):
+        i = len(self.stack) - n
+        res = tuple(self.stack[i:])
+        del self.stack[i:]
+        return res
+
+    def materialize(self, i):
+        t = self.temp(i)
+        if self.stack[i] != t:
+            self.emit('move', t, self.stack[i])
+            self.stack[i] = t
+
+    def flush(self):
+        for i in range(len(self.stack)):
+            self.materialize(i)
+
+    def store(self, r):
+        """
+        Pop the top of the stack and store it in the register r
+        """
+        retarget = self.retarget
+        src = self.pop()
+        # the stack might contain the old value of r
+        for i, r2 in enumerate(self.stack):
+            if r2 == r:
+                self.materialize(i)
+                retarget = None
+        if retarget is not None and self.out.insns[retarget][1] == src:
+            # the value was computed by the last instruction: write it
+            # directly to r
+            insn = self.out.insns[retarget]
+            self.out.insns[retarget] = (insn[0], r) + insn[2:]
+            self.retarget = None
+        else:
+            self.emit('move', r, src)
+
+    def translate(self):
+        for pc, op in enumerate(self.code.body):
+            if self.depths[pc] is None:
+                continue # unreachable
+            meth = getattr(self, f'op_{op.name}', None)
+            if meth is None:
+                raise NotImplementedError(f'regvm: {op.name}')
+            meth(pc, *op.args)
+        # resolve the labels
+        insns = self.out.insns
+        for i, (handler, a, b, c) in enumerate(insns):
+            kinds = KINDS[handler.__name__[3:]]
+            args = [self.label_pcs[arg] if kind == 'pc' else arg
+                    for kind, arg in zip(kinds, (a, b, c))]
+            args += [None] * (3 - len(args))
+            insns[i] = (handler, *args)
+        return self.out
+
+    def end_block(self):
+        # the next reachable op is a label, which sets the stack
+        self.stack = []
+
+    def op_load_const(self, pc, w_value):
+        self.stack.append(self.const(w_value))
+
+    def op_load_local(self, pc, name):
+        self.stack.append(self.local(name))
+
+    op_load_local_green = op_load_local
+
+    def op_store_local(self, pc, name):
+        self.store(self.local(name))
+
+    op_store_local_green = op_store_local
+
+    def op_load_nonlocal(self, pc, name):
+        self.emit_result('load_nonlocal', name)
+
+    op_load_nonlocal_green = op_load_nonlocal
+
+    def op_load_cell(self, pc, i):
+        self.emit_result('load_cell', i)
+
+    op_load_cell_green = op_load_cell
+
+    # the islots are registers like the other locals, which happen to
+    # contain unboxed ints
+
+    def op_load_islot(self, pc, i):
+        self.stack.append(self.local(self.code.islots[i]))
+
+    def op_store_islot(self, pc, i):
+        self.store(self.local(self.code.islots[i]))
+
+    def binop(self, opname):
+        b = self.pop()
+        a = self.pop()
+        self.emit_result(opname, a, b)
+
+    def op_add(self, pc):
+        self.binop('add')
+
+    def op_mul(self, pc):
+        self.binop('mul')
+
+    def op_lt(self, pc):
+        self.binop('lt')
+
+    def op_gt(self, pc):
+        self.binop('gt')
+
+    def unop(self, opname):
+        self.emit_result(opname, self.pop())
+
+    def op_make_tuple(self, pc, n):
+        self.emit_result('make_tuple', self.popn(n))
+
+    def op_print(self, pc, n):
+        self.emit_result('print', self.popn(n))
+
+    def op_call(self, pc, n):
+        args = self.popn(n)
+        w_func = self.pop()
+        self.emit_result('call', w_func, args)
+
+    def op_tail_call(self, pc, n):
+        args = self.popn(n)
+        w_func = self.pop()
+        self.emit('tail_call', w_func, args)
+        self.end_block()
+
+    def op_return(self, pc):
+        self.emit('return', self.pop())
+        self.end_block()
+
+    def op_abort(self, pc, msg):
+        self.emit('abort', msg)
+        self.end_block()
+
+    def op_pop(self, pc):
+        self.pop()
+
+    def op_get_iter(self, pc, itername):
+        src = self.pop()
+        self.emit('get_iter', self.local(itername), src)
+
+    def op_for_iter(self, pc, itername, targetname, endfor):
+        self.flush()
+        self.emit('for_iter', self.local(itername), self.local(targetname),
+                  endfor)
+
+    def op_unroll(self, pc):
+        self.emit_result('unroll', self.pop())
+
+    def op_make_function(self, pc, code):
+        cells = tuple(self.local(name) for name in code.freevars)
+        self.emit_result('make_function', code, cells)
+
+    def op_label(self, pc, label):
+        self.flush() # for the fallthrough
+        i = len(self.out.insns)
+        self.label_pcs[label] = i
+        block_costs = self.out.block_costs
+        block_costs[i] = block_costs.get(i, 0) + self.costs.at_label[pc]
+        self.stack = [self.temp(i) for i in range(self.depths[pc])]
+        self.retarget = None
+
+    def op_br(self, pc, label):
+        self.flush()
+        self.emit('br', label)
+        self.end_block()
+
+    def op_br_if(self, pc, then, else_, endif):
+        cond = self.pop()
+        self.flush()
+        self.emit('br_if', cond, then, else_)
+
+
+class RegFrame:
+    __slots__ = ('w_func', 'code', 'regs', 'pc', 'fuel', 'w_result',
+                 'child', 'result_reg', 'tail_frame')
+
+    def __init__(self, w_func, args_w):
+        assert isinstance(w_func.code, RegCode)
+        self.w_func = w_func
+        self.code = w_func.code
+        assert len(args_w) == len(self.code.argnames)
+        self.regs = list(self.code.template)
+        self.regs[:len(args_w)] = args_w
+        self.pc = 0 # used only by resume()
+        self.fuel = None
+        self.w_result = None # set by resume() upon return
+        self.child = None    # set by resume() upon call
+        self.result_reg = None # where push() stores the result of child
+        self.tail_frame = None
+
+    def set_fuel(self, fuel):
+        """
+        Start metering: charge the entry block immediately, and the other
+        blocks when we enter them
+        """
+        self.fuel = fuel
+        fuel.consume(self.code.entry_cost +
+                     self.code.block_costs.get(0, 0))
+
+    def run(self):
+        if self.fuel is not None:
+            return self.run_metered()
+        if counter is not None:
+            return self.run_counting()
+        regs = self.regs
+        insns = self.code.insns
+        pc = 0
+        while True:
+            handler, a, b, c = insns[pc]
+            if handler is op_return:
+                return regs[a]
+            elif handler is op_tail_call:
+                self.tail_frame = self.make_tail_frame(a, b)
+                return None
+            pc = handler(self, regs, pc, a, b, c)
+
+    def run_counting(self):
+        # same as run(), but count the instructions
+        global counter
+        regs = self.regs
+        insns = self.code.insns
+        pc = 0
+        while True:
+            counter += 1
+            handler, a, b, c = insns[pc]
+            if handler is op_return:
+                return regs[a]
+            elif handler is op_tail_call:
+                self.tail_frame = self.make_tail_frame(a, b)
+                return None
+            pc = handler(self, regs, pc, a, b, c)
+
+    def run_metered(self):
+        # same as run(), but charge the fuel for each block we enter
+        regs = self.regs
+        insns = self.code.insns
+        block_costs = self.code.block_costs
+        fuel = self.fuel
+        pc = 0
+        while True:
+            handler, a, b, c = insns[pc]
+            if handler is op_return:
+                return regs[a]
+            elif handler is op_tail_call:
+                self.tail_frame = self.make_tail_frame(a, b)
+                return None
+            pc = handler(self, regs, pc, a, b, c)
+            cost = block_costs.get(pc)
+            if cost is not None:
+                fuel.consume(cost)
+
+    def resume(self, steps):
+        """
+        Resumable version of run(), with the same protocol as
+        Frame.resume(): calls are not executed recursively, but stored in
+        self.child, and the scheduler pushes their result
+        """
+        regs = self.regs
+        insns = self.code.insns
+        pc = self.pc
+        n = 0
+        while n < steps:
+            handler, a, b, c = insns[pc]
+            n += 1
+            if handler is op_return:
+                self.w_result = regs[a]
+                break
+            elif handler is op_tail_call:
+                self.tail_frame = self.make_tail_frame(a, b)
+                break
+            elif handler is op_call:
+                args_w = [regs[r] for r in c]
+                self.child = regs[b].make_frame(*args_w, fuel=self.fuel)
+                self.result_reg = a
+                pc += 1
+            else:
+                pc = handler(self, regs, pc, a, b, c)
+            if self.fuel is not None:
+                cost = self.code.block_costs.get(pc)
+                if cost is not None:
+                    self.fuel.consume(cost)
+            if self.child is not None:
+                break
+        self.pc = pc
+        return n
+
+    def push(self, w_value):
+        # the result of self.child
+        self.regs[self.result_reg] = w_value
+        self.result_reg = None
+
+    def make_tail_frame(self, r_func, r_args):
+        regs = self.regs
+        args_w = [regs[r] for r in r_args]
+        return regs[r_func].make_frame(*args_w, fuel=self.fuel)
+
+
+class count_insns:
+    """
+    Context manager to count the instructions executed by RegFrames:
+
+        with count_insns() as c:
+            ...
+        print(c.count)
+    """
+
+    def __enter__(self):
+        global counter
+        self.prev = counter
+        counter = 0
+        self.count = None
+        return self
+
+    def __exit__(self, etype, evalue, tb):
+        global counter
+        self.count = counter
+        counter = self.prev
+
+
+# ======== instruction handlers ========
+# handler(frame, regs, pc, a, b, c) -> index of the next instruction
+
+def op_move(frame, regs, pc, dst, src, _):
+    regs[dst] = regs[src]
+    return pc + 1
+
+def op_load_nonlocal(frame, regs, pc, dst, name, _):
+    regs[dst] = frame.w_func.closure.lookup(name)
+    return pc + 1
+
+def op_load_cell(frame, regs, pc, dst, i, _):
+    regs[dst] = frame.w_func.closure.cells[i]
+    return pc + 1
+
+def op_add(frame, regs, pc, dst, a, b):
+    w_a = regs[a]
+    w_b = regs[b]
+    if w_a.type == w_b.type == 'int':
+        regs[dst] = W_Int(w_a.value + w_b.value)
+    elif w_a.type == w_b.type == 'str':
+        regs[dst] = w_a.concat(w_b)
+    else:
+        assert False
+    return pc + 1
+
+def op_mul(frame, regs, pc, dst, a, b):
+    w_a = regs[a]
+    w_b = regs[b]
+    if w_a.type == w_b.type == 'int':
+        regs[dst] = W_Int(w_a.value * w_b.value)
+    elif w_a.type == 'str' and w_b.type == 'int':
+        regs[dst] = w_a.repeat(w_b.value)
+    else:
+        assert False
+    return pc + 1
+
+def op_lt(frame, regs, pc, dst, a, b):
+    w_a = regs[a]
+    w_b = regs[b]
+    assert w_a.type == w_b.type
+    regs[dst] = W_Int(w_a.value < w_b.value)
+    return pc + 1
+
+def op_gt(frame, regs, pc, dst, a, b):
+    w_a = regs[a]
+    w_b = regs[b]
+    assert w_a.type == w_b.type
+    regs[dst] = W_Int(w_a.value > w_b.value)
+    return pc + 1
+
+def op_make_tuple(frame, regs, pc, dst, srcs, _):
+    regs[dst] = W_Tuple([regs[r] for r in srcs])
+    return pc + 1
+
+def op_print(frame, regs, pc, dst, srcs, _):
+    print(*[regs[r].str() for r in srcs])
+    regs[dst] = w_None
+    return pc + 1
+
+def op_call(frame, regs, pc, dst, r_func, r_args):
+    args_w = [regs[r] for r in r_args]
+    regs[dst] = regs[r_func].call(*args_w, fuel=frame.fuel)
+    return pc + 1
+
+def op_tail_call(frame, regs, pc, r_func, r_args, _):
+    assert False, 'handled by RegFrame.run'
+
+def op_return(frame, regs, pc, src, _, __):
+    assert False, 'handled by RegFrame.run'
+
+def op_abort(frame, regs, pc, msg, _, __):
+    raise Exception(f"ABORT: {msg}")
+
+def op_get_iter(frame, regs, pc, dst, src, _):
+    regs[dst] = regs[src].get_iter()
+    return pc + 1
+
+def op_for_iter(frame, regs, pc, r_iter, r_target, pc_endfor):
+    w_value = regs[r_iter].iter_next()
+    if w_value == 'STOP':
+        regs[r_iter] = None
+        return pc_endfor
+    regs[r_target] = w_value
+    return pc + 1
+
+def op_unroll(frame, regs, pc, dst, src, _):
+    regs[dst] = regs[src].unroll()
+    return pc + 1
+
+def op_make_function(frame, regs, pc, dst, code, cells):
+    w_func = frame.w_func
+    closure = w_func.closure.with_cells(f'{w_func.name}:locals',
+                                        tuple([regs[r] for r in cells]))
+    regs[dst] = W_Function(code.name, code, closure)
+    return pc + 1
+
+def op_br(frame, regs, pc, target, _, __):
+    return target
+
+def op_br_if(frame, regs, pc, cond, then, else_):
+    w_cond = regs[cond]
+    assert w_cond.type == "int"
+    if w_cond.value:
+        return then
+    return else_
+
+# opname -> kinds of its operands: 'reg', 'regs' (a tuple of registers),
+# 'pc' (a label before translate() resolves it), or anything else which
+# is used as it is
+KINDS = {
+    'move': ('reg', 'reg'),
+    'load_nonlocal': ('reg', 'name'),
+    'load_cell': ('reg', 'int'),
+    'add': ('reg', 'reg', 'reg'),
+    'mul': ('reg', 'reg', 'reg'),
+    'lt': ('reg', 'reg', 'reg'),
+    'gt': ('reg', 'reg', 'reg'),
+    'make_tuple': ('reg', 'regs'),
+    'print': ('reg', 'regs'),
+    'call': ('reg', 'reg', 'regs'),
+    'tail_call': ('reg', 'regs'),
+    'return': ('reg',),
+    'abort': ('const',),
+    'get_iter': ('reg', 'reg'),
+    'for_iter': ('reg', 'reg', 'pc'),
+    'unroll': ('reg', 'reg'),
+    'make_function': ('reg', 'code', 'regs'),
+    'br': ('pc',),
+    'br_if': ('reg', 'pc', 'pc'),
+}
+HANDLERS = {opname: globals()[f'op_{opname}'] for opname in KINDS}
+
+# the fixed-width integer ops, see toyvm.intops
+
+def _make_int_binop(opname, func):
+    def handler(frame, regs, pc, dst, a, b):
+        regs[dst] = func(regs[a], regs[b])
+        return pc + 1
+    handler.__name__ = f'op_{opname}'
+    translate = lambda self, pc: self.binop(opname)
+    return handler, translate
+
+def _make_int_unop(opname, func):
+    def handler(frame, regs, pc, dst, src, _):
+        regs[dst] = func(regs[src])
+        return pc + 1
+    handler.__name__ = f'op_{opname}'
+    translate = lambda self, pc: self.unop(opname)
+    return handler, translate
+
+for _opname, _func in intops.BINOPS.items():
+    KINDS[_opname] = ('reg', 'reg', 'reg')
+    HANDLERS[_opname], _translate = _make_int_binop(_opname, _func)
+    setattr(Translator, f'op_{_opname}', _translate)
+for _opname, _func in intops.UNOPS.items():
+    KINDS[_opname] = ('reg', 'reg')
+    HANDLERS[_opname], _translate = _make_int_unop(_opname, _func)
+    setattr(Translator, f'op_{_opname}', _translate)
@@ -0,0 +1,142 @@
+"""
+Cooperative scheduling of toy frames.
+
+A Task is a green thread: it owns a stack of frames and runs them using
+Frame.resume(), so that it can be suspended after any instruction. The
+Scheduler runs many tasks in round-robin, giving each of them a fixed
+budget of instructions per time slice. VM integrates the same mechanism
+with asyncio.
+"""
+
+import time
+import asyncio
+from collections import deque
+
+
+class Task:
+
+    def __init__(self, w_func, args_w, *, fuel=None):
+        self.name = w_func.name
+        self.frames = [w_func.make_frame(*args_w, fuel=fuel)]
+        self.w_result = None
+        # statistics
+        self.steps = 0
+        self.slices = 0
+        self.cpu_time = 0.0
+        self.t_spawn = time.perf_counter()
+        self.t_done = None
+
+    def __repr__(self):
+        return f'<Task {self.name!r}>'
+
+    @property
+    def done(self):
+        return not self.frames
+
+    @property
+    def latency(self):
+        assert self.done
+        return self.t_done - self.t_spawn
+
+    def run_slice(self, budget):
+        """
+        Execute at most 'budget' instructions. Return True if the task
+        finished.
+        """
+        t0 = time.perf_counter()
+        while budget > 0 and self.frames:
+            frame = self.frames[-1]
+            n = frame.resume(budget)
+            budget -= n
+            self.steps += n
+            if frame.child is not None:
+                self.frames.append(frame.child)
+                frame.child = None
+            elif frame.tail_frame is not None:
+                self.frames[-1] = frame.tail_frame
+            elif frame.w_result is not None:
+                self.frames.pop()
+                if self.frames:
+                    self.frames[-1].push(frame.w_result)
+                else:
+                    self.w_result = frame.w_result
+        t1 = time.perf_counter()
+        self.slices += 1
+        self.cpu_time += t1 - t0
+        if self.done:
+            self.t_done = t1
+        return self.done
+
+
+class Scheduler:
+
+    def __init__(self, slice_steps=100):
+        self.slice_steps = slice_steps
+        self.ready = deque()
+        self.finished = []
+
+    def spawn(self, w_func, *args_w, fuel=None):
+        task = Task(w_func, args_w, fuel=fuel)
+        self.ready.append(task)
+        return task
+
+    def run(self):
+        """
+        Run all the tasks in round-robin, until all of them are done
+        """
+        while self.ready:
+            task = self.ready.popleft()
+            if task.run_slice(self.slice_steps):
+                self.finished.append(task)
+            else:
+                self.ready.append(task)
+
+    def stats(self):
+        return compute_stats(self.finished)
+
+
+def compute_stats(tasks):
+    """
+    Compute latency and fairness statistics for the given finished tasks.
+
+    Fairness is Jain's index of the CPU time that each task received per
+    time slice: 1.0 means that all tasks got exactly the same share.
+    """
+    if not tasks:
+        return {}
+    latencies = sorted(task.latency for task in tasks)
+    shares = [task.cpu_time / task.slices for task in tasks]
+    fairness = sum(shares)**2 / (len(shares) * sum(x*x for x in shares))
+    return {
+        'tasks': len(tasks),
+        'latency_mean': sum(latencies) / len(latencies),
+        'latency_p50': latencies[len(latencies) // 2],
+        'latency_max': latencies[-1],
+        'fairness': fairness,
+    }
+
+
+class VM:
+    """
+    Run toy functions inside an asyncio event loop:
+
+        vm = VM()
+        w_res = await vm.call(w_func, *args_w)
+
+    The frames are executed in slices of 'slice_steps' instructions, and we
+    yield to the event loop between two slices.
+    """
+
+    def __init__(self, slice_steps=1000):
+        self.slice_steps = slice_steps
+        self.finished = []
+
+    async def call(self, w_func, *args_w):
+        task = Task(w_func, args_w)
+        while not task.run_slice(self.slice_steps):
+            await asyncio.sleep(0)
+        self.finished.append(task)
+        return task.w_result
+
+    def stats(self):
+        return compute_stats(self.finished)
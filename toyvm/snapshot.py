@@ -0,0 +1,80 @@
+"""
+Heap images: save a live heap to a file, and restore it at startup without
+compiling and pevaling again.
+
+An image contains an arbitrary graph of objects reachable from a root,
+typically a dict of W_Modules: functions (including the ones produced by
+peval and by toyvm.guards), code objects, closures and their scopes,
+tuples, strings, etc. The graph is serialized with pickle, so sharing and
+cycles are preserved, and w_None stays a singleton. Frames and iterators
+cannot be saved.
+
+The caches which are valid only in the current process are not saved: the
+quickened bodies, site stats, OSR targets and specialization variants of
+the code objects (see CodeObject.PROCESS_CACHES), and the DepsGuards which
+watch the globals on their behalf. They are rebuilt on demand after
+loading.
+
+Since images are pickles, loading an image can execute arbitrary code:
+never load an image from an untrusted source.
+
+The file format is:
+
+    HEADER: magic, format version, length of the payload
+    PAYLOAD: the pickled root
+
+The whole file is read with a single read(), or mapped with mmap, and the
+payload is unpickled directly from the buffer.
+"""
+
+import mmap
+import pickle
+import struct
+
+MAGIC = b'TOYVMIMG'
+VERSION = 1
+HEADER = struct.Struct('<8sIQ') # magic, version, payload length
+
+
+class ImageError(Exception):
+    pass
+
+
+def dumps_image(root):
+    payload = pickle.dumps(root, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(MAGIC, VERSION, len(payload)) + payload
+
+def loads_image(buf):
+    """
+    Restore an image from a bytes-like object
+    """
+    buf = memoryview(buf)
+    if len(buf) < HEADER.size:
+        raise ImageError('truncated image header')
+    magic, version, length = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ImageError('not a toyvm image')
+    if version != VERSION:
+        raise ImageError(f'unsupported image version: {version}')
+    payload = buf[HEADER.size:]
+    if len(payload) != length:
+        raise ImageError(f'wrong payload size: expected {length}, '
+                         f'got {len(payload)}')
+    return pickle.loads(payload)
+
+def save_image(filename, root):
+    with open(filename, 'wb') as f:
+        f.write(dumps_image(root))
+
+def load_image(filename, *, use_mmap=False):
+    with open(filename, 'rb') as f:
+        if not use_mmap:
+            return loads_image(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = memoryview(mm)
+            try:
+                return loads_image(buf)
+            finally:
+                # the mmap cannot be closed while there are exported
+                # buffers
+                buf.release()
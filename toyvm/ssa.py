@@ -0,0 +1,956 @@
+"""
+SSA form of a CodeObject, and lowering back to bytecode.
+
+build_ssa() turns the body into a graph of values, with the algorithm by
+Braun et al. ("Simple and Efficient Construction of Static Single
+Assignment Form"): the stack and the locals disappear, and each op which
+computes something becomes an Insn whose args are other values:
+
+  - Const: the argument of a load_const;
+  - Param: the value of an argument, when the function starts;
+  - Home: the value stored in the target of a for loop by for_iter;
+  - Undef: the value of a local which has not been assigned yet;
+  - Phi: the value of a local at the start of a block with many
+    predecessors.
+
+The passes work on the SSA form. cse() and gvn() remove the Insns which
+recompute the value of a previous Insn: cse() looks only inside each basic
+block, gvn() also in the blocks which dominate it. Only MOVABLE_OPS are
+considered: the others are executed exactly once, in the original order.
+
+lower() goes back to bytecode. Each Phi gets a local, shared with the
+other Phis, Params and Homes which it can be coalesced with, so that in
+the common case the locals are the same as in the original code. Insns
+used only once are inlined into the expression which uses them, the
+others are stored into new locals @vN. The Insns whose value is not used
+are removed, even if they might fail because of a type error, as
+toyvm.licm does when it hoists them. Similarly, reading a local which was
+never assigned fails only if the value is used, and possibly after some of
+the effects which follow it in the original code.
+
+The code which uses green ops, unroll, make_function or the fixed-width
+integer ops, or which leaves values on the stack across blocks, is not
+supported: optimize() returns it unchanged.
+
+    code2 = optimize(code)             # = lower(gvn(build_ssa(code)))
+"""
+
+from toyvm.opcode import (CodeObject, OpCode, PURE_OPS, INT_OPS,
+                          STACK_EFFECT)
+from toyvm.verifier import verify
+from toyvm.cfg import CFG, TERMINATORS
+from toyvm.rainbow import const_key
+
+# ops which can be removed, duplicated or moved around: their result
+# depends only on their args. lt, gt and load_cell are not in PURE_OPS
+# because peval doesn't fold them, but they have no side effects. The
+# fixed-width integer ops are not supported, because lower() can't store
+# their unboxed results in a local
+MOVABLE_OPS = ((PURE_OPS | {'lt', 'gt', 'load_cell'}) - INT_OPS -
+               {'unroll', 'load_const', 'load_nonlocal_green',
+                'load_cell_green'})
+
+# ops which are executed exactly once and in order. load_nonlocal is here
+# because a call can change the globals
+EFFECT_OPS = {'load_nonlocal', 'call', 'print', 'get_iter'}
+
+SUPPORTED_OPS = ({'label', 'load_const', 'load_local', 'store_local', 'pop'} |
+                 MOVABLE_OPS | EFFECT_OPS | set(TERMINATORS))
+
+
+class Unsupported(Exception):
+    pass
+
+
+class Value:
+    replaced = None # set by the passes which remove the value
+
+    def resolve(self):
+        value = self
+        while value.replaced is not None:
+            value = value.replaced
+        return value
+
+
+class Const(Value):
+
+    def __init__(self, w_value):
+        self.w_value = w_value
+
+    def __str__(self):
+        return str(self.w_value)
+
+
+class Param(Value):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Home(Value):
+
+    def __init__(self, name, block):
+        self.name = name
+        self.block = block
+
+    def __str__(self):
+        return self.name
+
+
+class Undef(Value):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return f'undef({self.name})'
+
+
+class Phi(Value):
+
+    def __init__(self, n, block, var):
+        self.n = n
+        self.block = block
+        self.var = var
+        self.args = [] # one for each block.preds
+
+    def __str__(self):
+        return f'p{self.n}'
+
+
+class Insn(Value):
+
+    def __init__(self, n, opname, imm, args, block):
+        self.n = n
+        self.opname = opname
+        self.imm = imm # the args of the OpCode
+        self.args = args # the values popped from the stack
+        self.block = block
+
+    def __str__(self):
+        return f'v{self.n}'
+
+    def is_movable(self):
+        return self.opname in MOVABLE_OPS
+
+    def has_result(self):
+        return STACK_EFFECT[self.opname][1] == 1
+
+
+def format_call(name, imm, args):
+    s = name
+    if imm:
+        s += '[%s]' % ', '.join(map(str, imm))
+    if args:
+        s += '(%s)' % ', '.join(map(str, args))
+    return s
+
+
+class SSAFunction:
+
+    def __init__(self, code, cfg):
+        self.code = code
+        self.cfg = cfg
+        self.params = {name: Param(name) for name in code.argnames}
+        self.phis = {} # block -> [Phi]
+        self.insns = {} # block -> [Insn], in execution order
+        self.exits = {} # block -> (terminator OpCode or None, [Value])
+        self.homes = {} # block -> Home, for the bodies of the for loops
+        self.counter = 0
+
+    def new_insn(self, opname, imm, args, block):
+        insn = Insn(self.counter, opname, imm, args, block)
+        self.counter += 1
+        self.insns[block].append(insn)
+        return insn
+
+    def new_phi(self, block, var):
+        phi = Phi(self.counter, block, var)
+        self.counter += 1
+        self.phis.setdefault(block, []).append(phi)
+        return phi
+
+    def count_insns(self):
+        return sum(len(self.insns[block]) for block in self.cfg.rpo)
+
+    def resolve(self):
+        """
+        Make all the args point to the values which replaced them
+        """
+        for block in self.cfg.rpo:
+            for phi in self.phis.get(block, []):
+                phi.args = [arg.resolve() for arg in phi.args]
+            for insn in self.insns[block]:
+                insn.args = [arg.resolve() for arg in insn.args]
+            op, args = self.exits[block]
+            self.exits[block] = (op, [arg.resolve() for arg in args])
+
+    def dump(self):
+        self.resolve()
+        lines = []
+        for block in self.cfg.rpo:
+            preds = ', '.join(pred.name for pred in block.preds)
+            lines.append(f'{block.name}: <- {preds}' if preds else
+                         f'{block.name}:')
+            for phi in self.phis.get(block, []):
+                lines.append(f'    {phi} = ' +
+                             format_call('phi', [phi.var], phi.args))
+            for insn in self.insns[block]:
+                call = format_call(insn.opname, insn.imm, insn.args)
+                if insn.has_result():
+                    lines.append(f'    {insn} = {call}')
+                else:
+                    lines.append(f'    {call}')
+            op, args = self.exits[block]
+            if op is not None:
+                lines.append('    ' + format_call(op.name, op.args, args))
+        return '\n'.join(lines)
+
+
+# ======== construction ========
+
+def build_ssa(code):
+    """
+    Return the SSAFunction of code, or raise Unsupported
+    """
+    return SSABuilder(code).build()
+
+
+class SSABuilder:
+
+    def __init__(self, code):
+        self.func = SSAFunction(code, CFG(code))
+        self.current_def = {} # var -> {block: Value}
+        self.sealed = set() # blocks whose preds are all filled
+        self.filled = set()
+        self.incomplete = {} # block -> [Phi] created before sealing
+        self.undefs = {}
+
+    def build(self):
+        self.check()
+        cfg = self.func.cfg
+        for block in cfg.rpo:
+            self.maybe_seal(block)
+            self.fill(block)
+            self.filled.add(block)
+            for succ in block.succs:
+                self.maybe_seal(succ)
+        self.remove_trivial_phis()
+        self.func.resolve()
+        return self.func
+
+    def check(self):
+        code = self.func.code
+        for block in self.func.cfg.rpo:
+            if block.depth not in (0, None):
+                raise Unsupported(f'{code.name}: values on the stack at the '
+                                  f'start of {block.name}')
+            for op in block.ops:
+                if op.name not in SUPPORTED_OPS:
+                    raise Unsupported(f'{code.name}: unsupported op '
+                                      f'{op.name}')
+                if op.name == 'for_iter':
+                    body = block.succs[0]
+                    if len(block.succs) != 2 or len(body.preds) != 1:
+                        raise Unsupported(f'{code.name}: unexpected loop '
+                                          f'structure at {block.name}')
+
+    def maybe_seal(self, block):
+        if block in self.sealed:
+            return
+        if all(pred in self.filled for pred in block.preds):
+            for phi in self.incomplete.pop(block, []):
+                self.add_phi_operands(phi)
+            self.sealed.add(block)
+
+    def fill(self, block):
+        func = self.func
+        func.insns[block] = []
+        if len(block.preds) == 1:
+            pred = block.preds[0]
+            op = pred.terminator
+            if op is not None and op.name == 'for_iter' and \
+               pred.succs[0] is block:
+                home = Home(op.args[1], block)
+                func.homes[block] = home
+                self.write_var(home.name, block, home)
+        #
+        stack = []
+        for op in block.ops:
+            name = op.name
+            if name == 'label':
+                pass
+            elif name == 'load_const':
+                stack.append(Const(op.args[0]))
+            elif name == 'load_local':
+                stack.append(self.read_var(op.args[0], block))
+            elif name == 'store_local':
+                self.write_var(op.args[0], block, stack.pop())
+            elif name == 'pop':
+                stack.pop()
+            else:
+                n = op.num_pops()
+                args = stack[len(stack)-n:]
+                del stack[len(stack)-n:]
+                if name in TERMINATORS:
+                    func.exits[block] = (op, args)
+                else:
+                    insn = func.new_insn(name, op.args, args, block)
+                    if insn.has_result():
+                        stack.append(insn)
+        assert not stack
+        if block not in func.exits:
+            func.exits[block] = (None, []) # fallthrough
+
+    def undef(self, var):
+        if var not in self.undefs:
+            self.undefs[var] = Undef(var)
+        return self.undefs[var]
+
+    def write_var(self, var, block, value):
+        self.current_def.setdefault(var, {})[block] = value
+
+    def read_var(self, var, block):
+        defs = self.current_def.get(var, {})
+        if block in defs:
+            return defs[block]
+        return self.read_var_recursive(var, block)
+
+    def read_var_recursive(self, var, block):
+        if block not in self.sealed:
+            value = self.func.new_phi(block, var)
+            self.incomplete.setdefault(block, []).append(value)
+        elif not block.preds:
+            value = self.func.params.get(var) or self.undef(var)
+        elif len(block.preds) == 1:
+            value = self.read_var(var, block.preds[0])
+        else:
+            value = self.func.new_phi(block, var)
+            self.write_var(var, block, value) # to break the cycles
+            self.add_phi_operands(value)
+        self.write_var(var, block, value)
+        return value
+
+    def add_phi_operands(self, phi):
+        for pred in phi.block.preds:
+            phi.args.append(self.read_var(phi.var, pred))
+
+    def remove_trivial_phis(self):
+        """
+        Remove the Phis whose args are all the same value (or the Phi
+        itself), until nothing changes
+        """
+        changed = True
+        while changed:
+            changed = False
+            for phis in self.func.phis.values():
+                for phi in list(phis):
+                    same = None
+                    for arg in phi.args:
+                        arg = arg.resolve()
+                        if arg is phi or arg is same:
+                            continue
+                        if same is not None:
+                            break
+                        same = arg
+                    else:
+                        phi.replaced = same or self.undef(phi.var)
+                        phis.remove(phi)
+                        changed = True
+
+
+# ======== passes ========
+
+def value_key(value):
+    if isinstance(value, Const):
+        key = const_key(value.w_value)
+        if key is None:
+            return ('id', id(value.w_value))
+        return key
+    return value
+
+def insn_key(insn):
+    args = tuple(value_key(arg.resolve()) for arg in insn.args)
+    return (insn.opname, insn.imm, args)
+
+def number_block(func, block, table):
+    """
+    Replace the Insns of block which are already in the table, and add the
+    others. Return (number of replaced insns, keys added to the table)
+    """
+    count = 0
+    added = []
+    insns = []
+    for insn in func.insns[block]:
+        if insn.is_movable():
+            key = insn_key(insn)
+            leader = table.get(key)
+            if leader is not None:
+                insn.replaced = leader
+                count += 1
+                continue
+            table[key] = insn
+            added.append(key)
+        insns.append(insn)
+    func.insns[block] = insns
+    return count, added
+
+def cse(func):
+    """
+    Common subexpression elimination inside each basic block. Return the
+    number of removed insns.
+    """
+    count = 0
+    for block in func.cfg.rpo:
+        n, added = number_block(func, block, {})
+        count += n
+    func.resolve()
+    return count
+
+def gvn(func):
+    """
+    Global value numbering: an Insn is replaced by an equivalent one in the
+    same block or in a block which dominates it. Return the number of
+    removed insns.
+    """
+    children = func.cfg.dominator_tree()
+    table = {}
+    count = 0
+    # walk the dominator tree: (block, None) means that we enter the block,
+    # (block, keys) that we leave it and the keys go out of scope
+    todo = [(func.cfg.entry, None)]
+    while todo:
+        block, added = todo.pop()
+        if added is not None:
+            for key in added:
+                del table[key]
+            continue
+        n, added = number_block(func, block, table)
+        count += n
+        todo.append((block, added))
+        for child in reversed(children[block]):
+            todo.append((child, None))
+    func.resolve()
+    return count
+
+
+# ======== lowering ========
+
+def lower(func):
+    """
+    Return a new verified CodeObject which computes the same as func
+    """
+    return Lowering(func).lower()
+
+
+class Lowering:
+
+    def __init__(self, func):
+        self.func = func
+        self.cfg = func.cfg
+        self.body = []
+        self.edges = [] # the blocks which split the critical edges
+        self.live = set()
+        self.uses = {} # Insn -> [(block, on_edge)]
+        self.kinds = {} # Insn -> how to lower it, see classify
+        self.sizes = {} # Insn -> number of ops, if it's inlined
+        self.effects = {} # Insn -> True if its expression has effects
+        self.locations = {} # Value -> name of the local which contains it
+        self.deferred = [] # the 'tree' Insns which are not emitted yet
+        self.users = {} # Insn -> the Insn which uses it, if any
+        self.positions = {} # Insn -> see compute_positions
+        self.live_out = {}
+        self.last_use = {} # (block, value) -> position
+        self.n_edges = 0
+
+    def lower(self):
+        func = self.func
+        func.resolve()
+        self.mark_live()
+        self.classify()
+        self.compute_liveness()
+        self.coalesce()
+        for block in self.cfg.blocks:
+            if block.label is not None:
+                self.emit(OpCode('label', block.label))
+            if block.reachable:
+                self.lower_block(block)
+        code = func.code
+        code2 = CodeObject(code.name, code.argnames, self.body + self.edges,
+                           freevars=code.freevars, islots=code.islots)
+        verify(code2)
+        return code2
+
+    def emit(self, op):
+        self.body.append(op)
+
+    def live_phis(self, block):
+        return [phi for phi in self.func.phis.get(block, [])
+                if phi in self.live]
+
+    def mark_live(self):
+        todo = []
+        for block in self.cfg.rpo:
+            for insn in self.func.insns[block]:
+                if not insn.is_movable():
+                    todo.append(insn)
+            todo += self.func.exits[block][1]
+        while todo:
+            value = todo.pop()
+            if value in self.live:
+                continue
+            self.live.add(value)
+            if isinstance(value, (Insn, Phi)):
+                todo += value.args
+
+    # ---- coalescing ----
+
+    def is_located(self, value):
+        """
+        Is value stored in a local which might be shared with other values?
+        """
+        return (isinstance(value, (Param, Home, Phi)) or
+                self.kinds.get(value) == 'store')
+
+    def def_point(self, value):
+        """
+        Return (block, index of the insn which stores it, or -1 if it's
+        stored before the start of the block)
+        """
+        if isinstance(value, Param):
+            return self.cfg.entry, -1
+        elif isinstance(value, Insn):
+            return value.block, self.positions[value]
+        return value.block, -1
+
+    def compute_positions(self):
+        """
+        Compute positions[insn], the index in its block of the insn which is
+        emitted when insn is evaluated: the insn itself if it's emitted in
+        place, else the one which uses it (at most). The exit of the block
+        is at len(insns).
+        """
+        for block in self.cfg.rpo:
+            insns = self.func.insns[block]
+            end = len(insns)
+            users = {}
+            for insn in insns:
+                if insn in self.live:
+                    for arg in insn.args:
+                        users.setdefault(arg, []).append(insn)
+            for i in range(end - 1, -1, -1):
+                insn = insns[i]
+                kind = self.kinds.get(insn)
+                if kind is None:
+                    continue
+                elif kind in ('inline', 'tree'):
+                    pos = end if len(users.get(insn, [])) < len(
+                        self.uses.get(insn, [])) else -1
+                    for user in users.get(insn, []):
+                        pos = max(pos, self.positions[user])
+                    self.positions[insn] = pos
+                else:
+                    self.positions[insn] = i
+
+    def compute_liveness(self):
+        """
+        Compute live_out[block], the located values which are live at the
+        end of block, and last_use[block, value], the position of the last
+        use of value inside block
+        """
+        self.compute_positions()
+        rpo = self.cfg.rpo
+        startdefs = {block: set() for block in rpo}
+        middefs = {block: set() for block in rpo}
+        phi_uses = {block: set() for block in rpo} # at the end of block
+        upward = {block: set() for block in rpo}
+        startdefs[self.cfg.entry].update(self.func.params.values())
+        for block in rpo:
+            if block in self.func.homes:
+                startdefs[block].add(self.func.homes[block])
+            for phi in self.live_phis(block):
+                startdefs[block].add(phi)
+                for pred, arg in zip(block.preds, phi.args):
+                    if self.is_located(arg):
+                        phi_uses[pred].add(arg)
+            insns = self.func.insns[block]
+            uses = [(len(insns), arg) for arg in self.func.exits[block][1]]
+            for insn in insns:
+                if insn in self.live:
+                    if self.is_located(insn):
+                        middefs[block].add(insn)
+                    uses += [(self.positions[insn], arg) for arg in insn.args]
+            for pos, arg in uses:
+                if self.is_located(arg):
+                    key = block, arg
+                    self.last_use[key] = max(self.last_use.get(key, -1), pos)
+                    if arg not in middefs[block]:
+                        upward[block].add(arg)
+        #
+        live_in = {block: set() for block in rpo}
+        live_out = {block: set() for block in rpo}
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(rpo):
+                out = set(phi_uses[block])
+                for succ in block.succs:
+                    out |= live_in[succ] - startdefs[succ]
+                live_out[block] = out
+                live = upward[block] | (out - middefs[block])
+                if live != live_in[block]:
+                    live_in[block] = live
+                    changed = True
+        self.live_out = live_out
+
+    def is_live_at(self, value, point):
+        block, i = point
+        def_block, j = self.def_point(value)
+        if def_block is block:
+            if j > i:
+                return False
+            elif j == i:
+                # both are defined at the start of the block
+                return (value in self.live_out[block] or
+                        (block, value) in self.last_use)
+        elif not self.cfg.dominates(def_block, block):
+            return False
+        return (value in self.live_out[block] or
+                self.last_use.get((block, value), -1) > i)
+
+    def interferes(self, a, b):
+        """
+        Two values interfere if one is live where the other is defined
+        """
+        return (self.is_live_at(a, self.def_point(b)) or
+                self.is_live_at(b, self.def_point(a)))
+
+    def coalesce(self):
+        """
+        Assign a local to each Param, Home and live Phi. A Phi shares the
+        local of its args when they don't interfere, so that no copy is
+        needed: this includes the args which are Insns stored in place.
+        """
+        values = list(self.func.params.values())
+        for block in self.cfg.rpo:
+            if block in self.func.homes:
+                values.append(self.func.homes[block])
+            values += self.live_phis(block)
+        stored = set()
+        for block in self.cfg.rpo:
+            for phi in self.live_phis(block):
+                for arg in phi.args:
+                    if self.kinds.get(arg) == 'store' and arg not in stored:
+                        stored.add(arg)
+                        values.append(arg)
+        # the Params and Homes are already stored in the local with their
+        # name, so the ones with the same name must share it
+        classes = {}
+        fixed = {}
+        for value in values:
+            if isinstance(value, (Param, Home)):
+                cls = fixed.setdefault(value.name, [])
+                for other in cls:
+                    if self.interferes(value, other):
+                        raise Unsupported(f'{self.func.code.name}: the '
+                                          f'local {value.name} is reused')
+                cls.append(value)
+                classes[value] = cls
+            else:
+                classes[value] = [value]
+        for value in values:
+            if isinstance(value, Phi):
+                for arg in value.args:
+                    if arg in classes:
+                        self.try_coalesce(classes, value, arg)
+        #
+        # the names which are already used by the code
+        taken = {value.name for value in values
+                 if isinstance(value, (Param, Home))}
+        taken.update(value.name for value in self.live
+                     if isinstance(value, Undef))
+        for block in self.cfg.rpo:
+            for op in block.ops:
+                if op.name in ('get_iter', 'for_iter'):
+                    taken.add(op.args[0])
+        counter = 0
+        for value in values:
+            if value in self.locations:
+                continue
+            cls = classes[value]
+            name = self.fixed_name(cls)
+            if name is None:
+                phis = [phi for phi in cls if isinstance(phi, Phi)]
+                if not phis:
+                    continue # an Insn stored into @vN, see store()
+                var = phis[0].var
+                name = var
+                while name in taken:
+                    name = f'@{var}_{counter}'
+                    counter += 1
+                taken.add(name)
+            for member in cls:
+                self.locations[member] = name
+
+    def fixed_name(self, cls):
+        for value in cls:
+            if isinstance(value, (Param, Home)):
+                return value.name
+        return None
+
+    def try_coalesce(self, classes, a, b):
+        cls_a = classes[a]
+        cls_b = classes[b]
+        if cls_a is cls_b:
+            return
+        if self.fixed_name(cls_a) and self.fixed_name(cls_b):
+            return
+        for x in cls_a:
+            for y in cls_b:
+                if self.interferes(x, y):
+                    return
+        cls_a += cls_b
+        for y in cls_b:
+            classes[y] = cls_a
+
+    # ---- instruction selection ----
+
+    def classify(self):
+        """
+        Decide how to lower each live Insn:
+
+          - 'inline': it's computed where it's used, once for each use;
+          - 'tree': it's an effect, or an expression which contains
+            effects, which is used only once: it's computed as part of the
+            expression which uses it, if the effects stay in the original
+            order (see emit_tree);
+          - 'store': it's computed in place, and stored into a local;
+          - 'pop': it's computed in place, and the result is unused;
+          - 'effect': it's computed in place, and it has no result.
+        """
+        for block in self.cfg.rpo:
+            for phi in self.live_phis(block):
+                for pred, arg in zip(block.preds, phi.args):
+                    # the copies of a critical edge are done in a new
+                    # block, see split_edges
+                    on_edge = len(pred.succs) > 1
+                    self.uses.setdefault(arg, []).append((pred, on_edge))
+            for arg in self.func.exits[block][1]:
+                self.uses.setdefault(arg, []).append((block, False))
+            for insn in self.func.insns[block]:
+                if insn in self.live:
+                    for arg in insn.args:
+                        self.uses.setdefault(arg, []).append((block, False))
+                        self.users[arg] = insn
+        #
+        for block in self.cfg.rpo:
+            for insn in self.func.insns[block]:
+                if insn in self.live:
+                    self.kinds[insn] = self.classify_insn(insn)
+
+    def classify_insn(self, insn):
+        uses = self.uses.get(insn, [])
+        local = all(block is insn.block for block, on_edge in uses)
+        size = 1
+        has_effects = not insn.is_movable()
+        for arg in insn.args:
+            if self.kinds.get(arg) in ('inline', 'tree'):
+                size += self.sizes[arg]
+                has_effects = has_effects or self.effects[arg]
+            else:
+                size += 1
+        self.sizes[insn] = size
+        self.effects[insn] = has_effects
+        if not insn.has_result():
+            return 'effect'
+        elif not insn.is_movable():
+            if not uses:
+                return 'pop'
+            elif len(uses) == 1 and local and not uses[0][1]:
+                return 'tree'
+            return 'store'
+        elif not insn.args:
+            return 'inline'
+        elif local and not has_effects:
+            # recompute it for each use, if it's not more expensive than
+            # storing and loading it
+            n = len(uses)
+            if n == 1 or size * n < size + 1 + n:
+                return 'inline'
+        elif len(uses) == 1 and local and not uses[0][1]:
+            # it contains effects, so it must be computed once and in order
+            return 'tree'
+        return 'store'
+
+    def lower_block(self, block):
+        for insn in self.func.insns[block]:
+            kind = self.kinds.get(insn)
+            if kind is None or kind == 'inline':
+                continue
+            elif kind == 'tree':
+                self.deferred.append(insn)
+                continue
+            # a pure insn can be computed before the deferred effects
+            self.emit_tree(insn.args, partial=insn.is_movable())
+            self.emit(OpCode(insn.opname, *insn.imm))
+            if kind == 'pop':
+                self.emit(OpCode('pop'))
+            elif kind == 'store':
+                self.store(insn)
+        self.lower_exit(block)
+
+    def store(self, insn):
+        if insn not in self.locations:
+            self.locations[insn] = f'@v{insn.n}'
+        self.emit(OpCode('store_local', self.locations[insn]))
+
+    def emit_tree(self, values, partial=False):
+        """
+        Push the given values. The deferred insns are computed as part of
+        the expression only if they are in their original order, and if no
+        other effect must be executed in between: else, they are computed
+        first and stored into locals. If partial is True, the expression can
+        consume only the first deferred insns.
+        """
+        while True:
+            ops, effects = self.walk_all(values)
+            n = len(effects)
+            if effects == self.deferred[:n] and (
+                    partial or n == len(self.deferred)):
+                break
+            self.flush_first()
+        del self.deferred[:n]
+        self.body += ops
+
+    def flush_first(self):
+        """
+        Emit the first deferred insn, as part of the biggest deferred
+        expression which contains it and is still in order
+        """
+        insn = self.deferred[0]
+        while self.users.get(insn) in self.deferred:
+            insn = self.users[insn]
+        ops, effects = self.walk_all(insn.args)
+        n = len(effects)
+        if effects != self.deferred[:n] or self.deferred[n] is not insn:
+            insn = self.deferred[0]
+            ops, effects = self.walk_all(insn.args)
+            n = 0
+        del self.deferred[:n+1]
+        self.body += ops
+        self.emit(OpCode(insn.opname, *insn.imm))
+        self.store(insn)
+
+    def walk_all(self, values):
+        ops = []
+        effects = []
+        for value in values:
+            self.walk(value, ops, effects)
+        return ops, effects
+
+    def walk(self, value, ops, effects):
+        if value in self.locations:
+            ops.append(OpCode('load_local', self.locations[value]))
+        elif isinstance(value, Const):
+            ops.append(OpCode('load_const', value.w_value))
+        elif isinstance(value, Undef):
+            ops.append(OpCode('load_local', value.name))
+        else:
+            kind = self.kinds[value]
+            assert kind in ('inline', 'tree')
+            for arg in value.args:
+                self.walk(arg, ops, effects)
+            ops.append(OpCode(value.opname, *value.imm))
+            if kind == 'tree':
+                effects.append(value)
+
+    # ---- end of the blocks ----
+
+    def copies(self, pred, succ):
+        """
+        Return the list of (local, value) to store when going from pred to
+        succ
+        """
+        i = succ.preds.index(pred)
+        result = []
+        for phi in self.live_phis(succ):
+            value = phi.args[i]
+            name = self.locations[phi]
+            if isinstance(value, Undef) or self.locations.get(value) == name:
+                continue
+            result.append((name, value))
+        return result
+
+    def emit_copies(self, copies):
+        # parallel copy: the sources might be read from the same locals
+        for name, value in reversed(copies):
+            self.emit(OpCode('store_local', name))
+
+    def lower_exit(self, block):
+        op, args = self.func.exits[block]
+        copies = []
+        split = {} # succ -> copies, for the critical edges
+        for succ in block.succs:
+            edge_copies = self.copies(block, succ)
+            if not edge_copies:
+                continue
+            if len(block.succs) == 1:
+                copies = edge_copies
+            else:
+                split[succ] = edge_copies
+        self.emit_tree(list(args) + [value for name, value in copies])
+        self.emit_copies(copies)
+        if split:
+            op = self.split_edges(op, split)
+        if op is not None:
+            self.emit(op)
+
+    def split_edges(self, op, split):
+        """
+        Move the copies of the critical edges to new blocks at the end of
+        the code, and return op retargeted to them
+        """
+        labels = {}
+        for succ, copies in split.items():
+            assert succ.label is not None
+            label = self.new_label()
+            labels[succ.label] = label
+            body = self.body
+            self.body = self.edges
+            self.emit(OpCode('label', label))
+            self.emit_tree([value for name, value in copies])
+            self.emit_copies(copies)
+            self.emit(OpCode('br', succ.label))
+            self.body = body
+        if op.name == 'br_if':
+            then, else_, endif = op.args
+            return OpCode('br_if', labels.get(then, then),
+                          labels.get(else_, else_), endif)
+        assert op.name == 'for_iter'
+        itername, targetname, endfor = op.args
+        return OpCode('for_iter', itername, targetname,
+                      labels.get(endfor, endfor))
+
+    def new_label(self):
+        while True:
+            label = f'edge_{self.n_edges}'
+            self.n_edges += 1
+            if label not in self.cfg.by_label:
+                return label
+
+
+def optimize(code, passes=(gvn,)):
+    """
+    Run the given passes on the SSA form of code. Return a new CodeObject,
+    or code itself if it's not supported.
+    """
+    try:
+        func = build_ssa(code)
+        for p in passes:
+            p(func)
+        return lower(func)
+    except Unsupported:
+        return code
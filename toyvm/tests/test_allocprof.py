@@ -0,0 +1,127 @@
+from toyvm import allocprof
+from toyvm.allocprof import AllocProfiler, diff, sizeof
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Int, W_Str, W_Tuple, W_Function
+from toyvm.regvm import translate
+from toyvm.fuel import Fuel
+from toyvm.scheduler import Task
+
+SRC = """
+def foo(a, b):
+    c = a + b
+    return (c, c)
+"""
+
+def pc_of(code, opname):
+    [pc] = [pc for pc, op in enumerate(code.body) if op.name == opname]
+    return pc
+
+
+class TestAllocProfiler:
+
+    def setup_method(self, meth):
+        self.w_foo = toy_compile(SRC).globals_w['foo']
+
+    def test_off(self):
+        init = W_Int.__init__
+        with AllocProfiler():
+            assert W_Int.__init__ is not init
+        assert W_Int.__init__ is init
+        assert allocprof.current is None
+
+    def test_frame(self):
+        code = self.w_foo.code
+        with AllocProfiler() as prof:
+            self.w_foo.call(W_Int(1), W_Int(2))
+        int_size = sizeof(W_Int(3))
+        tuple_size = sizeof(W_Tuple([W_Int(3), W_Int(3)]))
+        assert prof.stats() == {
+            ('<host>', -1, 'W_Int'): (2, 2 * int_size),
+            ('foo', pc_of(code, 'add'), 'W_Int'): (1, int_size),
+            ('foo', pc_of(code, 'make_tuple'), 'W_Tuple'): (1, tuple_size),
+        }
+
+    def test_str(self):
+        w_mod = toy_compile("""
+        def foo(s):
+            return s * 100
+        """)
+        w_s = W_Str('ab')
+        with AllocProfiler() as prof:
+            w_mod.globals_w['foo'].call(w_s)
+        [(key, count, _)] = prof.top()
+        assert key == ('foo', 2, 'W_Str') # allocated by _lazy
+        assert count == 1
+
+    def test_regvm(self):
+        w_foo = W_Function('foo', translate(self.w_foo.code), None)
+        with AllocProfiler() as prof:
+            w_foo.call(W_Int(1), W_Int(2))
+        types = {key[2] for key in prof.stats() if key[0] == 'foo'}
+        assert types == {'W_Int', 'W_Tuple'}
+
+    def test_regvm_metered(self):
+        code = translate(self.w_foo.code)
+        w_foo = W_Function('foo', code, None)
+        pc_tuple = [pc for pc, (handler, _, _, _) in enumerate(code.insns)
+                    if handler.__name__ == 'op_make_tuple']
+        for run in (self.run_metered, self.run_task):
+            with AllocProfiler() as prof:
+                run(w_foo)
+            sites = {(key[1], key[2]) for key in prof.stats()
+                     if key[0] == 'foo'}
+            assert (pc_tuple[0], 'W_Tuple') in sites
+            assert -1 not in {pc for pc, _ in sites}
+
+    def run_metered(self, w_foo):
+        frame = w_foo.make_frame(W_Int(1), W_Int(2), fuel=Fuel(10**6))
+        assert frame.run() == W_Tuple([W_Int(3), W_Int(3)])
+
+    def run_task(self, w_foo):
+        task = Task(w_foo, [W_Int(1), W_Int(2)], fuel=Fuel(10**6))
+        while not task.run_slice(1):
+            pass
+        assert task.w_result == W_Tuple([W_Int(3), W_Int(3)])
+
+    def test_peval(self):
+        w_mod = toy_compile("""
+        def foo(a):
+            return a + (1 + 2)
+        """, optimize=False)
+        w_foo = w_mod.globals_w['foo']
+        with AllocProfiler() as prof:
+            peval(w_foo)
+        stats = prof.stats()
+        # 1 + 2 is computed by peval
+        add_pcs = [pc for pc, op in enumerate(w_foo.code.body)
+                   if op.name == 'add']
+        assert stats[('foo', add_pcs[0], 'W_Int')][0] == 1
+        assert ('<host>', -1, 'W_Function') in stats
+
+    def test_nested(self):
+        with AllocProfiler() as outer:
+            with AllocProfiler() as inner:
+                W_Int(1)
+            W_Tuple([])
+        assert allocprof.current is None
+        assert inner.total()[0] == 1
+        assert outer.total()[0] == 1
+
+    def test_diff(self):
+        with AllocProfiler() as prof1:
+            self.w_foo.call(W_Int(1), W_Int(2))
+        w_foo = toy_compile(SRC).globals_w['foo']
+        with AllocProfiler() as prof2:
+            for i in range(3):
+                w_foo.call(W_Int(1), W_Int(2))
+        code = w_foo.code
+        int_size = sizeof(W_Int(3))
+        tuple_size = sizeof(W_Tuple([W_Int(3), W_Int(3)]))
+        assert diff(prof1, prof2) == [
+            (('foo', pc_of(code, 'make_tuple'), 'W_Tuple'), 2, 2*tuple_size),
+            (('<host>', -1, 'W_Int'), 4, 4 * int_size),
+            (('foo', pc_of(code, 'add'), 'W_Int'), 2, 2 * int_size),
+        ]
+        assert diff(prof1, prof1) == []
+        assert 'W_Tuple' in allocprof.diff_report(prof1, prof2)
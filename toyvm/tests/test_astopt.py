@@ -0,0 +1,108 @@
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Str
+from toyvm.benchmarks.programs import BENCHMARKS
+
+def compile_foo(src, optimize=True):
+    w_mod = toy_compile(src, optimize=optimize)
+    return w_mod.globals_w['foo']
+
+
+class TestConstantFolder:
+
+    def test_str(self):
+        w_foo = compile_foo("""
+        def foo():
+            return ("ab" + "c") * 2
+        """)
+        assert w_foo.code.equals("""
+        load_const W_Str('abcabc')
+        return
+        load_const w_None
+        return
+        """)
+
+    def test_compare(self):
+        w_foo = compile_foo("""
+        def foo(a):
+            return (1 < 2, "b" < "a", a < 3 * 4)
+        """)
+        assert w_foo.code.equals("""
+        load_const W_Int(True)
+        load_const W_Int(False)
+        load_local a
+        load_const W_Int(12)
+        lt
+        make_tuple 3
+        return
+        load_const w_None
+        return
+        """)
+
+    def test_not_folded(self):
+        # unsupported by the runtime: they must fail as before
+        for expr in ['2 * "a"', '1 + "a"', '"a" < 1']:
+            w_foo = compile_foo(f"""
+            def foo():
+                return {expr}
+            """)
+            assert len(w_foo.code.body) == 6
+        # too large
+        w_foo = compile_foo("""
+        def foo():
+            return "abc" * 1000
+        """)
+        assert w_foo.code.body[1].name == 'load_const'
+        assert w_foo.code.body[1].args[0] == W_Int(1000)
+
+    def test_dead_if(self):
+        w_foo = compile_foo("""
+        def foo(a):
+            if 1 < 2:
+                a = a + 1
+            else:
+                a = a * 2
+            if 3 > 4:
+                print(a)
+            return a
+        """)
+        assert w_foo.code.equals("""
+        load_local a
+        load_const W_Int(1)
+        add
+        store_local a
+        load_local a
+        return
+        load_const w_None
+        return
+        """)
+        assert w_foo.call(W_Int(5)) == W_Int(6)
+
+    def test_str_condition(self):
+        # br_if accepts only ints: this must fail at runtime, as before
+        w_foo = compile_foo("""
+        def foo():
+            if "a":
+                return 1
+            return 2
+        """)
+        assert w_foo.code.body[1].name == 'br_if'
+        with pytest.raises(AssertionError):
+            w_foo.call()
+
+    @pytest.mark.parametrize('bench', BENCHMARKS,
+                             ids=[bench.name for bench in BENCHMARKS])
+    def test_benchmarks(self, bench):
+        src = bench.get_src(5)
+        def compile(optimize):
+            w_mod = toy_compile(src, optimize=optimize)
+            n = sum(len(w_obj.code.body) for w_obj in w_mod.globals_w.values())
+            w_res = w_mod.globals_w[bench.entry].call(*bench.make_args(5))
+            return n, w_res.str()
+        n0, res0 = compile(optimize=False)
+        n1, res1 = compile(optimize=True)
+        assert res0 == res1
+        if bench.name == 'const_exprs':
+            assert n1 < n0
+        else:
+            assert n1 <= n0
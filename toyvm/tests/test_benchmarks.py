@@ -0,0 +1,152 @@
+import json
+import pytest
+from toyvm.benchmarks.programs import BENCHMARKS
+from toyvm.benchmarks.runner import (MODES, measure, run_all, compare, main,
+                                     format_results)
+
+BENCH_IDS = [bench.name for bench in BENCHMARKS]
+
+class TestBenchmarks:
+
+    @pytest.mark.parametrize('bench', BENCHMARKS, ids=BENCH_IDS)
+    def test_all_modes_agree(self, bench):
+        results = [measure(bench, mode, size=5, repeat=1)['result']
+                   for mode in MODES]
+        assert len(set(results)) == 1
+
+    def test_fib(self):
+        fib = BENCHMARKS[0]
+        assert fib.name == 'fib'
+        res = measure(fib, 'interp', size=10, repeat=1)
+        assert res['result'] == '89'
+
+    def test_compare(self):
+        results = run_all(size_factor=0.01, repeat=1)
+        assert compare(results, results) == []
+        #
+        baseline = json.loads(json.dumps(results))
+        baseline['benchmarks']['fib']['interp']['exec_time'] /= 2
+        regressions = compare(results, baseline, min_time=0)
+        assert len(regressions) == 1
+        assert regressions[0].startswith('fib [interp] exec_time:')
+
+    def test_main(self, tmpdir, capsys):
+        out = tmpdir.join('results.json')
+        argv = ['--size-factor', '0.01', '--repeat', '1', '-k', 'fib']
+        assert main(argv + ['-o', str(out)]) == 0
+        results = json.loads(out.read())
+        assert set(results['benchmarks']['fib']) == set(MODES)
+        assert main(argv + ['-b', str(out), '--threshold', '1000']) == 0
+        stdout, _ = capsys.readouterr()
+        assert 'No regressions' in stdout
+
+
+    def test_format_results(self):
+        results = run_all(size_factor=0.01, repeat=1)
+        lines = format_results(results).splitlines()
+        # the columns are aligned also with long mode names
+        assert len({len(line) for line in lines}) == 1
+
+
+class TestMemory:
+
+    def test_no_dict(self):
+        from toyvm.opcode import OpCode, CodeObject
+        from toyvm.objects import W_Int, W_Str, W_Tuple, W_Function, Closure
+        from toyvm.frame import Frame
+        code = CodeObject('fn', [], [OpCode('load_const', W_Int(1)),
+                                     OpCode('return')])
+        w_func = W_Function('fn', code, Closure('globals', [{}]))
+        objs = [W_Int(1), W_Str('a'), W_Tuple([]), w_func, code,
+                code.body[0], w_func.closure, Frame(w_func)]
+        for obj in objs:
+            assert not hasattr(obj, '__dict__'), obj
+
+    def test_measure(self):
+        from toyvm.benchmarks.memory import measure_classes, measure_peval
+        results = measure_classes()
+        for name, (dict_based, slotted) in results.items():
+            assert slotted < dict_based, name
+        n, per_op, peak = measure_peval(size=10)
+        assert n > 0
+
+
+class TestTailCalls:
+
+    @pytest.mark.parametrize('mode', list(MODES))
+    def test_constant_stack_depth(self, mode):
+        from toyvm.benchmarks.tailcalls import measure
+        depth1, _ = measure(10, mode)
+        depth2, _ = measure(3000, mode)
+        assert depth1 == depth2
+
+
+class TestParallelPeval:
+
+    def test_measure(self):
+        from toyvm.benchmarks.parallel import measure
+        _, checksum1 = measure(10, workers=1)
+        _, checksum2 = measure(10, workers=2)
+        assert checksum1 == checksum2
+
+
+class TestBoot:
+
+    def test_main(self, capsys):
+        from toyvm.benchmarks.boot import main
+        assert main(['--funcs', '4']) == 0
+        stdout, _ = capsys.readouterr()
+        assert 'from image (mmap)' in stdout
+
+
+class TestRegVM:
+
+    @pytest.mark.parametrize('bench', BENCHMARKS, ids=BENCH_IDS)
+    def test_measure(self, bench):
+        from toyvm.benchmarks.regvm import measure
+        n_stack, _, n_reg, _ = measure(bench, size=5,
+                                       use_peval=True, repeat=1)
+        assert n_reg < n_stack
+
+
+class TestBindingTimeAnalysis:
+
+    def test_untagged_consts(self):
+        from toyvm.benchmarks.programs import UNTAGGED_CONSTS
+        from toyvm.benchmarks.bta import measure
+        folded1, ops1, _ = measure(UNTAGGED_CONSTS, infer_green=False,
+                                   size=5, repeat=1)
+        folded2, ops2, _ = measure(UNTAGGED_CONSTS, infer_green=True,
+                                   size=5, repeat=1)
+        assert folded2 > folded1
+        assert ops2 < ops1
+
+
+class TestLICM:
+
+    def test_measure(self):
+        from toyvm.benchmarks.licm import NESTED_BENCHMARKS, measure
+        for bench in NESTED_BENCHMARKS:
+            measure(bench, use_peval=True, size=5, repeat=1)
+
+
+class TestSSA:
+
+    def test_measure(self):
+        from toyvm.benchmarks.programs import COMMON_SUBEXPRS
+        from toyvm.benchmarks.ssa import measure
+        n_peval, n_ssa, n_cse, n_gvn, _, _ = measure(COMMON_SUBEXPRS,
+                                                     size=5, repeat=1)
+        assert n_peval > n_cse > n_gvn
+
+
+class TestIntOps:
+
+    def test_measure(self):
+        from toyvm.benchmarks.programs import INT_KERNEL
+        from toyvm.benchmarks.intops import measure
+        n1, _ = measure(INT_KERNEL, 'interp', typed_locals=False,
+                        size=5, repeat=1)
+        n2, _ = measure(INT_KERNEL, 'interp', typed_locals=True,
+                        size=5, repeat=1)
+        assert n2 < n1
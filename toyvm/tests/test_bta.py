@@ -0,0 +1,173 @@
+import textwrap
+from toyvm.compiler import toy_compile, ModuleCompiler
+from toyvm.rainbow import peval, peval_with_stats
+from toyvm.objects import W_Int, W_Tuple
+from toyvm.bta import report
+
+def analyze(src):
+    comp = ModuleCompiler(textwrap.dedent(src), '<test>', infer_green=True)
+    w_mod = comp.compile()
+    return w_mod, comp.inferred
+
+def w_ints(*values):
+    return W_Tuple([W_Int(v) for v in values])
+
+
+class TestBindingTimeAnalysis:
+
+    def test_simple(self):
+        w_mod, inferred = analyze("""
+        def foo(a):
+            b = 3
+            c = b * 2
+            d = c + a
+            return d
+        """)
+        bta = inferred['foo']
+        assert bta.inferred == {'b', 'c'}
+        assert bta.reasons == {'d': 'red value at line 5'}
+        assert w_mod.globals_w['foo'].code.equals("""
+        load_const W_Int(3)
+        store_local_green b
+        load_local_green b
+        load_const W_Int(2)
+        mul
+        store_local_green c
+        load_local_green c
+        load_local a
+        add
+        store_local d
+        load_local d
+        return
+        load_const w_None
+        return
+        """)
+
+    def test_off_by_default(self):
+        w_mod = toy_compile("""
+        def foo():
+            b = 3
+            return b
+        """)
+        assert w_mod.globals_w['foo'].code.body[1].name == 'store_local'
+
+    def test_red_control_flow(self):
+        w_mod, inferred = analyze("""
+        def foo(a, t):
+            b = 1
+            c = 2
+            d = 3
+            if a:
+                b = 4
+            for x in t:
+                c = 5
+            return (b, c, d)
+        """)
+        bta = inferred['foo']
+        assert bta.inferred == {'d'}
+        assert bta.reasons == {
+            'b': 'assigned under a red if at line 6',
+            'c': 'assigned in a red loop at line 8',
+            'x': 'target of a for loop at line 8',
+        }
+
+    def test_green_control_flow(self):
+        w_mod, inferred = analyze("""
+        def foo(a):
+            TUP = (1, 2, 3)
+            s = 0
+            for X in UNROLL(TUP):
+                s = s + X
+            if s:
+                b = 1
+            else:
+                b = 2
+            return a + s + b
+        """)
+        assert inferred['foo'].inferred == {'s', 'b'}
+        w_foo = peval(w_mod.globals_w['foo'])
+        assert w_foo.code.equals("""
+        for_0:
+        then_1:
+          br endif_1
+        endif_1:
+          load_local a
+          load_const W_Int(6)
+          add
+          load_const W_Int(1)
+          add
+          return
+          load_const w_None
+          return
+        """)
+
+    def test_fixpoint(self):
+        # c depends on b, which is demoted only when we see the loop
+        w_mod, inferred = analyze("""
+        def foo(t):
+            b = 1
+            c = b
+            for x in t:
+                b = x
+            d = c
+            return d
+        """)
+        assert inferred['foo'].inferred == set()
+        w_foo = peval(w_mod.globals_w['foo'])
+        assert w_foo.call(w_ints(7)) == W_Int(1)
+
+    def test_compare_is_red(self):
+        # lt is not in PURE_OPS, so peval doesn't fold it
+        w_mod, inferred = analyze("""
+        def foo():
+            a = 1
+            b = a < 2
+            return b
+        """)
+        assert inferred['foo'].inferred == {'a'}
+
+    def test_calls(self):
+        w_mod, inferred = analyze("""
+        @green
+        def double(x):
+            return x * 2
+
+        def red(x):
+            return x
+
+        def foo(a):
+            b = double(21)
+            c = red(1)
+            d = double(a)
+            return (b, c, d)
+        """)
+        assert set(inferred) == {'red', 'foo'}
+        assert inferred['foo'].inferred == {'b'}
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert stats.green_calls == 1
+        assert w_foo.call(W_Int(5)) == w_ints(42, 1, 10)
+
+    def test_green_tuple_in_red_loop(self):
+        w_mod, inferred = analyze("""
+        def foo():
+            t = (1, 2, 3)
+            s = 0
+            for x in t:
+                s = s + x
+            return s
+        """)
+        assert inferred['foo'].inferred == {'t'}
+        w_foo = peval(w_mod.globals_w['foo'])
+        assert w_foo.call() == W_Int(6)
+
+    def test_report(self):
+        _, inferred = analyze("""
+        def foo(a):
+            b = 3
+            c = a
+            return b + c
+        """)
+        assert report(inferred) == textwrap.dedent("""\
+        foo:
+            green b
+            red   c: red value at line 4""")
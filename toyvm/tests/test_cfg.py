@@ -0,0 +1,143 @@
+import textwrap
+from toyvm.compiler import toy_compile
+from toyvm.opcode import CodeObject, OpCode
+from toyvm.objects import w_None
+from toyvm.cfg import CFG
+
+def get_cfg(src, name='foo'):
+    w_mod = toy_compile(src)
+    return CFG(w_mod.globals_w[name].code)
+
+def check_dump(cfg, expected):
+    expected = textwrap.dedent(expected).strip('\n')
+    assert cfg.dump() == expected
+
+
+class TestCFG:
+
+    def test_straight_line(self):
+        cfg = get_cfg("""
+        def foo(a):
+            return a + 1
+        """)
+        check_dump(cfg, """
+        b0: -> b1
+        b1:
+            load_local a
+            load_const W_Int(1)
+            add
+            return
+        """)
+        # the trailing 'load_const w_None; return' is unreachable
+        assert len(cfg.blocks) == 3
+        assert not cfg.blocks[2].reachable
+        assert cfg.rpo == cfg.blocks[:2]
+
+    def test_if_else(self):
+        cfg = get_cfg("""
+        def foo(a, b):
+            if a < b:
+                x = a
+            else:
+                x = b
+            return x
+        """)
+        check_dump(cfg, """
+        b0: -> b1
+        b1: -> then_0, else_0
+            load_local a
+            load_local b
+            lt
+            br_if then_0 else_0 endif_0
+        then_0: -> endif_0
+            load_local a
+            store_local x
+            br endif_0
+        else_0: -> endif_0
+            load_local b
+            store_local x
+        endif_0:
+            load_local x
+            return
+        """)
+        b1 = cfg.blocks[1]
+        then = cfg.by_label['then_0']
+        else_ = cfg.by_label['else_0']
+        endif = cfg.by_label['endif_0']
+        assert endif.preds == [then, else_]
+        assert then.idom is b1
+        assert else_.idom is b1
+        assert endif.idom is b1
+        assert cfg.dominates(b1, endif)
+        assert not cfg.dominates(then, endif)
+        assert set(cfg.dominator_tree()[b1]) == {then, else_, endif}
+
+    def test_if_without_else(self):
+        cfg = get_cfg("""
+        def foo(a):
+            if a:
+                return 1
+            return 2
+        """)
+        b1 = cfg.blocks[1]
+        then = cfg.by_label['then_0']
+        endif = cfg.by_label['endif_0']
+        # 'br_if then_0 endif_0 endif_0'
+        assert b1.succs == [then, endif]
+        assert then.succs == []
+        assert endif.preds == [b1]
+
+    def test_loop(self):
+        cfg = get_cfg("""
+        def foo(items):
+            total = 0
+            for x in items:
+                total = total + x
+            return total
+        """)
+        check_dump(cfg, """
+        b0: -> b1
+        b1: -> for_0
+            load_const W_Int(0)
+            store_local total
+            load_local items
+            get_iter @iter_0
+        for_0: -> b3, endfor_0
+            for_iter @iter_0 x endfor_0
+        b3: -> for_0
+            load_local total
+            load_local x
+            add
+            store_local total
+            br for_0
+        endfor_0:
+            load_local total
+            return
+        """)
+        b1, header, body = cfg.blocks[1:4]
+        endfor = cfg.by_label['endfor_0']
+        assert header.preds == [b1, body]
+        assert body.idom is header
+        assert endfor.idom is header
+        assert cfg.dominates(header, body)
+        assert not cfg.dominates(body, header)
+        assert [block.name for block in cfg.rpo] == [
+            'b0', 'b1', 'for_0', 'endfor_0', 'b3']
+
+    def test_loop_at_pc_0(self):
+        # the entry block is never a loop header
+        code = CodeObject('foo', ['it'], [
+            OpCode('label', 'loop'),
+            OpCode('for_iter', 'it', 'x', 'end'),
+            OpCode('br', 'loop'),
+            OpCode('label', 'end'),
+            OpCode('load_const', w_None),
+            OpCode('return'),
+        ])
+        cfg = CFG(code)
+        entry, header, body, end = cfg.blocks
+        assert header.label == 'loop'
+        assert entry.preds == []
+        assert header.preds == [entry, body]
+        assert header.idom is entry
+        assert end.idom is header
@@ -40,28 +40,32 @@ class TestCompiler:
         assert w_func.call() == W_Int(42)
 
     def test_add_mul(self):
-        w_func = self.compile("""
+        src = """
         def foo():
             return 1 + 2 * 3
+        """
+        w_func = self.compile(src)
+        # folded by the AST optimizer in both modes
+        assert w_func.code.equals("""
+        load_const W_Int(7)
+        return
+        load_const w_None
+        return
+        """)
+        assert w_func.call() == W_Int(7)
+        #
+        w_mod = toy_compile(src, optimize=False)
+        w_func = w_mod.globals_w['foo']
+        assert w_func.code.equals("""
+        load_const W_Int(1)
+        load_const W_Int(2)
+        load_const W_Int(3)
+        mul
+        add
+        return
+        load_const w_None
+        return
         """)
-        if self.mode == 'interp':
-            assert w_func.code.equals("""
-            load_const W_Int(1)
-            load_const W_Int(2)
-            load_const W_Int(3)
-            mul
-            add
-            return
-            load_const w_None
-            return
-            """)
-        else:
-            assert w_func.code.equals("""
-            load_const W_Int(7)
-            return
-            load_const w_None
-            return
-            """)
         assert w_func.call() == W_Int(7)
 
     def test_i32_add(self):
@@ -73,8 +77,11 @@ class TestCompiler:
         if self.mode == 'interp':
             assert w_func.code.equals("""
             load_const W_Int(2)
+            i32_unbox
             load_const W_Int(3)
+            i32_unbox
             i32_add
+            i32_box
             return
             load_const w_None
             return
@@ -393,8 +400,7 @@ class TestCompiler:
             assert w_foo.code.equals("""
             load_const W_Function(name='add', code=<CodeObject 'add<peval>'>, closure=<Closure 'make_adder:locals'>)
             load_local a
-            call 1
-            return
+            tail_call 1
             load_const w_None
             return
             """)
@@ -409,3 +415,64 @@ class TestCompiler:
             load_const w_None
             return
             """)
+
+    def test_closure_captures_only_freevars(self):
+        w_make = self.compile("""
+        @green
+        def make(X, Y):
+            Z = X + Y
+            UNUSED = 42
+            def f(a):
+                b = a + Y
+                return b + Z
+            return f
+        """, auto_rainbow=False)
+        w_f = w_make.call(W_Int(1), W_Int(10))
+        assert w_f.code.freevars == ('Y', 'Z')
+        assert w_f.closure.cells == (W_Int(10), W_Int(11))
+        assert w_f.code.equals("""
+        load_local a
+        load_cell_green 0
+        add
+        store_local b
+        load_local b
+        load_cell_green 1
+        add
+        return
+        load_const w_None
+        return
+        """)
+        assert w_f.call(W_Int(100)) == W_Int(121)
+        if self.mode == 'rainbow':
+            w_f2 = peval(w_f)
+            assert w_f2.code.freevars == ('Y', 'Z')
+            assert w_f2.call(W_Int(100)) == W_Int(121)
+
+    def test_tail_call(self):
+        w_count = self.compile("""
+        def count(i, n):
+            if i < n:
+                return count(i + 1, n)
+            return i
+        """)
+        if self.mode == 'interp':
+            assert w_count.code.equals("""
+              load_local i
+              load_local n
+              lt
+              br_if then_0 endif_0 endif_0
+            then_0:
+              load_nonlocal count
+              load_local i
+              load_const W_Int(1)
+              add
+              load_local n
+              tail_call 2
+            endif_0:
+              load_local i
+              return
+              load_const w_None
+              return
+            """)
+        # much deeper than the Python recursion limit
+        assert w_count.call(W_Int(0), W_Int(5000)) == W_Int(5000)
@@ -0,0 +1,120 @@
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Tuple, W_Function
+from toyvm.fuel import Fuel, ResourceExhausted, get_block_costs
+from toyvm.scheduler import Scheduler
+from toyvm.packed import pack
+from toyvm.regvm import translate
+
+SRC = """
+def total(tup):
+    t = 0
+    for x in tup:
+        t = t + x
+    return t
+
+def twice(tup):
+    return total(tup) + total(tup)
+"""
+
+def w_ints(n):
+    return W_Tuple([W_Int(i) for i in range(n)])
+
+class TestFuel:
+
+    def setup_method(self, meth):
+        self.w_mod = toy_compile(SRC)
+        self.w_total = self.w_mod.globals_w['total']
+        self.w_twice = self.w_mod.globals_w['twice']
+
+    def test_block_costs(self):
+        costs = get_block_costs(self.w_total.code)
+        assert self.w_total.code.equals("""
+          load_const W_Int(0)
+          store_local t
+          load_local tup
+          get_iter @iter_0
+        for_0:
+          for_iter @iter_0 x endfor_0
+          load_local t
+          load_local x
+          add
+          store_local t
+          br for_0
+        endfor_0:
+          load_local t
+          return
+          load_const w_None
+          return
+        """)
+        assert costs.entry == 4
+        assert costs.at_label == {4: 7, 11: 5}
+
+    def test_consume(self):
+        fuel = Fuel(100)
+        w_res = self.w_total.call(w_ints(3), fuel=fuel)
+        assert w_res == W_Int(3)
+        # entry + 4 iterations of the loop (the last one exits) + endfor
+        assert fuel.consumed == 4 + 4*7 + 5
+        assert fuel.remaining == 100 - fuel.consumed
+
+    def test_exhausted(self):
+        fuel = Fuel(30)
+        with pytest.raises(ResourceExhausted, match='out of fuel'):
+            self.w_total.call(w_ints(100), fuel=fuel)
+        assert fuel.remaining == 0
+
+    def test_shared_by_callees(self):
+        fuel = Fuel(1000)
+        self.w_twice.call(w_ints(3), fuel=fuel)
+        one = Fuel(1000)
+        self.w_total.call(w_ints(3), fuel=one)
+        assert fuel.consumed > 2 * one.consumed
+
+    def test_unlimited(self):
+        assert self.w_twice.call(w_ints(3)) == W_Int(6)
+
+    def test_scheduler(self):
+        sched = Scheduler(slice_steps=5)
+        fuel = Fuel(1000)
+        task = sched.spawn(self.w_twice, w_ints(3), fuel=fuel)
+        sched.run()
+        assert task.w_result == W_Int(6)
+        expected = Fuel(1000)
+        self.w_twice.call(w_ints(3), fuel=expected)
+        assert fuel.consumed == expected.consumed
+
+    def convert_all(self, convert):
+        for name, w_func in self.w_mod.globals_w.items():
+            if isinstance(w_func, W_Function):
+                self.w_mod.globals_w[name] = W_Function(
+                    w_func.name, convert(w_func.code), w_func.closure)
+
+    @pytest.mark.parametrize('convert', [pack, translate],
+                             ids=['packed', 'regvm'])
+    def test_other_executors(self, convert):
+        expected = Fuel(1000)
+        self.w_twice.call(w_ints(3), fuel=expected)
+        self.convert_all(convert)
+        w_twice = self.w_mod.globals_w['twice']
+        fuel = Fuel(1000)
+        assert w_twice.call(w_ints(3), fuel=fuel) == W_Int(6)
+        assert fuel.consumed == expected.consumed
+        #
+        fuel = Fuel(30)
+        with pytest.raises(ResourceExhausted):
+            w_twice.call(w_ints(100), fuel=fuel)
+
+    @pytest.mark.parametrize('convert', [pack, translate],
+                             ids=['packed', 'regvm'])
+    def test_other_executors_scheduler(self, convert):
+        expected = Fuel(1000)
+        self.w_twice.call(w_ints(3), fuel=expected)
+        self.convert_all(convert)
+        sched = Scheduler(slice_steps=5)
+        fuel = Fuel(1000)
+        task = sched.spawn(self.w_mod.globals_w['twice'], w_ints(3),
+                           fuel=fuel)
+        sched.run()
+        assert task.w_result == W_Int(6)
+        assert fuel.consumed == expected.consumed
@@ -0,0 +1,112 @@
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int
+from toyvm import rainbow
+from toyvm.guards import enable_tiering, disable_tiering
+
+SRC = """
+@green
+def SCALE():
+    return 10
+
+def f(x):
+    return x * SCALE()
+
+def g(x):
+    return x + 1
+"""
+
+NEW_SCALE = """
+@green
+def SCALE():
+    return 20
+"""
+
+class TestGuards:
+
+    def test_tier_up(self):
+        w_mod = toy_compile(SRC)
+        enable_tiering(w_mod, threshold=3)
+        w_f = w_mod.globals_w['f']
+        assert w_mod.globals_w['SCALE'].tier is None # green
+        for i in range(2):
+            assert w_f.call(W_Int(i)) == W_Int(i*10)
+            assert w_f.code.name == 'f'
+        assert w_f.call(W_Int(2)) == W_Int(20)
+        assert w_f.code.name == 'f<peval>'
+        assert w_f.code.equals("""
+        load_local x
+        load_const W_Int(10)
+        mul
+        return
+        load_const w_None
+        return
+        """)
+        assert w_f.tier.deps == {'SCALE'}
+
+    def test_invalidate(self):
+        w_mod = toy_compile(SRC)
+        enable_tiering(w_mod, threshold=2)
+        w_f = w_mod.globals_w['f']
+        w_f.call(W_Int(1))
+        w_f.call(W_Int(1))
+        assert w_f.tier.is_specialized
+        #
+        # unrelated changes don't invalidate
+        w_mod.globals_w['g'] = w_mod.globals_w['g']
+        w_mod.globals_w['h'] = W_Int(42)
+        assert w_f.tier.is_specialized
+        #
+        w_mod.globals_w['SCALE'] = toy_compile(NEW_SCALE).globals_w['SCALE']
+        assert not w_f.tier.is_specialized
+        assert w_f.tier.invalidations == 1
+        assert w_f.code.name == 'f'
+        assert w_mod.globals_w.watchers['SCALE'] == set()
+        assert w_f.call(W_Int(1)) == W_Int(20)
+        # re-specialization with the new value
+        assert w_f.call(W_Int(2)) == W_Int(40)
+        assert w_f.tier.is_specialized
+        assert w_f.tier.specializations == 2
+        assert w_f.code.body[1].args[0] == W_Int(20)
+
+    def test_del(self):
+        w_mod = toy_compile(SRC)
+        enable_tiering(w_mod, threshold=1)
+        w_f = w_mod.globals_w['f']
+        w_f.call(W_Int(1))
+        assert w_f.tier.is_specialized
+        del w_mod.globals_w['SCALE']
+        assert not w_f.tier.is_specialized
+
+    def test_disable_tiering(self):
+        w_mod = toy_compile(SRC)
+        enable_tiering(w_mod, threshold=1)
+        w_f = w_mod.globals_w['f']
+        w_f.call(W_Int(1))
+        disable_tiering(w_mod)
+        assert w_f.tier is None
+        assert w_f.code.name == 'f'
+        assert w_mod.globals_w.watchers['SCALE'] == set()
+
+    def test_invalidate_call_specializations(self, monkeypatch):
+        cache = rainbow.SpecializationCache()
+        monkeypatch.setattr(rainbow, 'SPEC_CACHE', cache)
+        w_mod = toy_compile(SRC + """
+@green
+def make_op():
+    def apply(x, k):
+        return x * k * SCALE()
+    return apply
+
+def h(x):
+    APPLY = make_op()
+    return APPLY(x, 2)
+""")
+        enable_tiering(w_mod, threshold=1)
+        w_h = w_mod.globals_w['h']
+        assert w_h.call(W_Int(1)) == W_Int(20)
+        [code] = [op.args[0] for op in w_mod.globals_w['make_op'].code.body
+                  if op.name == 'make_function']
+        assert cache.get_variants(code)
+        w_mod.globals_w['SCALE'] = toy_compile(NEW_SCALE).globals_w['SCALE']
+        assert not cache.get_variants(code)
+        assert w_h.call(W_Int(1)) == W_Int(40)
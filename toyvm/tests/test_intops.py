@@ -0,0 +1,186 @@
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Tuple
+from toyvm.allocprof import AllocProfiler
+from toyvm.intops import BINOPS, wrap32, wrap64
+from toyvm.benchmarks.runner import MODES
+
+def w_ints(*values):
+    return W_Tuple([W_Int(v) for v in values])
+
+def call(src, mode, *args_w, typed_locals=True):
+    w_mod = toy_compile(src, typed_locals=typed_locals)
+    w_func = MODES[mode](w_mod.globals_w['foo'])
+    return w_func.call(*args_w)
+
+I32_MAX = 2**31 - 1
+I32_MIN = -2**31
+I64_MAX = 2**63 - 1
+I64_MIN = -2**63
+
+
+class TestOps:
+
+    def test_wrap(self):
+        assert wrap32(I32_MAX + 1) == I32_MIN
+        assert wrap32(I32_MIN - 1) == I32_MAX
+        assert wrap32(2**32 + 5) == 5
+        assert wrap32(-1) == -1
+        assert wrap64(I64_MAX + 1) == I64_MIN
+        assert wrap64(2**32) == 2**32
+
+    def test_arith(self):
+        assert BINOPS['i32_add'](I32_MAX, 1) == I32_MIN
+        assert BINOPS['i32_sub'](I32_MIN, 1) == I32_MAX
+        assert BINOPS['i32_mul'](65536, 65536) == 0
+        assert BINOPS['i64_mul'](65536, 65536) == 2**32
+        assert BINOPS['i64_add'](I64_MAX, 1) == I64_MIN
+
+    def test_bitwise(self):
+        assert BINOPS['i32_and'](-1, 0xFF) == 0xFF
+        assert BINOPS['i32_or'](0xF0, 0x0F) == 0xFF
+        assert BINOPS['i32_xor'](-1, 0) == -1
+
+    def test_shifts(self):
+        assert BINOPS['i32_shl'](1, 31) == I32_MIN
+        assert BINOPS['i32_shl'](1, 32) == 1 # the count is masked
+        assert BINOPS['i64_shl'](1, 32) == 2**32
+        assert BINOPS['i32_shr'](-8, 1) == -4 # arithmetic
+        assert BINOPS['i32_shr'](-1, 33) == -1
+
+    def test_compare(self):
+        assert BINOPS['i32_lt'](I32_MIN, 0) == W_Int(1)
+        assert BINOPS['i32_gt'](I32_MIN, 0) == W_Int(0)
+        assert BINOPS['i64_eq'](3, 3) == W_Int(1)
+
+
+@pytest.mark.parametrize('mode', list(MODES))
+class TestCompiled:
+
+    def test_builtins(self, mode):
+        src = """
+        def foo(a, b):
+            return (__i32_add__(a, b), __i32_mul__(a, b),
+                    __i64_mul__(a, b), __i32_shr__(a, 4),
+                    __i32_lt__(a, b))
+        """
+        res = call(src, mode, W_Int(I32_MAX), W_Int(3))
+        assert res == w_ints(I32_MIN + 2, wrap32(I32_MAX * 3),
+                             I32_MAX * 3, I32_MAX >> 4, 0)
+
+    def test_unbox_wraps(self, mode):
+        src = """
+        def foo(a):
+            return __i32_or__(a, 0)
+        """
+        assert call(src, mode, W_Int(2**32 + 7)) == W_Int(7)
+
+    def test_typed_locals(self, mode):
+        src = """
+        def foo(items):
+            h = 1
+            for x in items:
+                h = __i32_mul__(__i32_add__(h, x), 65599)
+            return h
+        """
+        h = 1
+        for x in range(100):
+            h = wrap32((h + x) * 65599)
+        assert call(src, mode, w_ints(*range(100))) == W_Int(h)
+
+    def test_mixed_widths(self, mode):
+        # an i64 local used by an i32 op is wrapped
+        src = """
+        def foo(a):
+            big = __i64_shl__(a, 32)
+            small = __i32_add__(big, 1)
+            return (big, small)
+        """
+        assert call(src, mode, W_Int(3)) == w_ints(3 << 32, 1)
+
+
+class TestTypedLocals:
+
+    def test_islots(self):
+        w_mod = toy_compile("""
+        def foo(items, k):
+            h = 0
+            n = 0
+            for x in items:
+                h = __i32_xor__(h, x)
+                n = n + k
+            return h
+        """)
+        code = w_mod.globals_w['foo'].code
+        # n is assigned a boxed value, so it's a regular local
+        assert code.islots == ('h',)
+        names = [op.name for op in code.body]
+        assert 'store_islot' in names
+        assert 'load_islot' in names
+
+    def test_not_typed(self):
+        w_mod = toy_compile("""
+        def foo(a):
+            h = __i32_add__(a, 1)
+            h = __i64_add__(h, 1)
+            x = __i32_add__(a, 1)
+            print(x)
+            x = a
+            return h
+        """)
+        code = w_mod.globals_w['foo'].code
+        # h has two different widths, x is assigned a boxed value
+        assert code.islots == ()
+
+    def test_big_constant(self):
+        src = """
+        def foo(c):
+            x = 5000000000
+            if c:
+                x = __i32_add__(x, 1)
+            y = 2000000000
+            if c:
+                y = __i32_add__(y, 1)
+            return (x, y)
+        """
+        w_mod = toy_compile(src)
+        assert w_mod.globals_w['foo'].code.islots == ('y',)
+        for c in (0, 1):
+            results = [call(src, 'interp', W_Int(c), typed_locals=typed)
+                       for typed in (False, True)]
+            assert results[0] == results[1]
+        assert results[0] == w_ints(wrap32(5000000001), 2000000001)
+
+    def test_unbound(self):
+        w_mod = toy_compile("""
+        def foo(c):
+            if c:
+                h = __i32_add__(c, 1)
+            return h
+        """)
+        w_foo = w_mod.globals_w['foo']
+        assert w_foo.call(W_Int(1)) == W_Int(2)
+        with pytest.raises(KeyError):
+            w_foo.call(W_Int(0))
+
+    @pytest.mark.parametrize('mode', ['interp', 'regvm', 'packed'])
+    def test_no_allocations(self, mode):
+        src = """
+        def foo(items):
+            h = 0
+            for x in items:
+                h = __i32_add__(__i32_mul__(h, 31), x)
+            return h
+        """
+        args_w = [w_ints(*range(50))]
+        counts = []
+        for typed_locals in (False, True):
+            w_mod = toy_compile(src, typed_locals=typed_locals)
+            w_foo = MODES[mode](w_mod.globals_w['foo'])
+            with AllocProfiler() as prof:
+                w_foo.call(*args_w)
+            counts.append(sum(count for (_, _, typename), (count, _)
+                              in prof.stats().items()
+                              if typename == 'W_Int'))
+        assert counts[0] >= 50
+        assert counts[1] == 1 # the result
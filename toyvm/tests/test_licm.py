@@ -0,0 +1,198 @@
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Int, W_Str, W_Tuple, W_Function
+from toyvm.licm import licm
+
+def w_ints(*values):
+    return W_Tuple([W_Int(v) for v in values])
+
+def hoisted(w_func):
+    return W_Function(w_func.name, licm(w_func.code), w_func.closure)
+
+
+class TestLICM:
+
+    def test_nested(self):
+        w_mod = toy_compile("""
+        def foo(rows, cols, k):
+            total = 0
+            for r in rows:
+                for c in cols:
+                    total = total + c * (r * k + 1) + k * (k + 3)
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_foo2 = hoisted(w_foo)
+        # k * (k + 3) is invariant also for the outer loop, but the inner
+        # one might run zero times
+        assert w_foo2.code.equals("""
+          load_const W_Int(0)
+          store_local total
+          load_local rows
+          get_iter @iter_0
+        for_0:
+          for_iter @iter_0 r endfor_0
+          load_local cols
+          get_iter @iter_1
+          for_iter @iter_1 c endfor_1
+          load_local r
+          load_local k
+          mul
+          load_const W_Int(1)
+          add
+          store_local @licm_0
+          load_local k
+          load_local k
+          load_const W_Int(3)
+          add
+          mul
+          store_local @licm_1
+          br for_1_body
+        for_1:
+          for_iter @iter_1 c endfor_1
+        for_1_body:
+          load_local total
+          load_local c
+          load_local @licm_0
+          mul
+          add
+          load_local @licm_1
+          add
+          store_local total
+          br for_1
+        endfor_1:
+          br for_0
+        endfor_0:
+          load_local total
+          return
+          load_const w_None
+          return
+        """)
+        args_w = [w_ints(1, 2, 3), w_ints(4, 5), W_Int(7)]
+        assert w_foo2.call(*args_w) == w_foo.call(*args_w)
+
+    def test_outer_invariant(self):
+        w_mod = toy_compile("""
+        def foo(rows, k):
+            total = 0
+            for r in rows:
+                total = total + k * (k + 3)
+                for c in rows:
+                    total = total + c
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_foo2 = hoisted(w_foo)
+        body = w_foo2.code.body
+        # hoisted out of the outer loop, after its entry test
+        assert [op.str() for op in body[4:11]] == [
+            'for_iter @iter_0 r endfor_0',
+            'load_local k',
+            'load_local k',
+            'load_const W_Int(3)',
+            'add',
+            'mul',
+            'store_local @licm_0']
+        args_w = [w_ints(1, 2, 3), W_Int(7)]
+        assert w_foo2.call(*args_w) == w_foo.call(*args_w) == W_Int(228)
+
+    def test_untaken_branch(self):
+        # s + 1 fails if s is a W_Str, but it's never executed
+        w_mod = toy_compile("""
+        def foo(t, s, c):
+            total = 0
+            for x in t:
+                if c:
+                    total = total + (s + 1)
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        assert licm(w_foo.code) is w_foo.code
+        assert w_foo.call(w_ints(1, 2), W_Str('a'), W_Int(0)) == W_Int(0)
+
+    def test_after_early_return(self):
+        w_mod = toy_compile("""
+        def foo(t, s):
+            total = 0
+            for x in t:
+                if x < 1:
+                    return total
+                total = total + (s + 1)
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        assert licm(w_foo.code) is w_foo.code
+
+    def test_zero_iterations(self):
+        w_mod = toy_compile("""
+        def foo(t, s):
+            total = 0
+            for x in t:
+                total = total + x * (s + 1)
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_foo2 = hoisted(w_foo)
+        assert w_foo2.code is not w_foo.code
+        # the preheader doesn't run
+        assert w_foo2.call(w_ints(), W_Str('a')) == W_Int(0)
+        assert w_foo2.call(w_ints(1, 2), W_Int(3)) == W_Int(12)
+
+    def test_stored_in_loop(self):
+        w_mod = toy_compile("""
+        def foo(t, k):
+            total = 0
+            for x in t:
+                total = total + k * 2
+                k = k + 1
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        assert licm(w_foo.code) is w_foo.code
+
+    def test_nothing_to_hoist(self):
+        # single loads are not worth hoisting
+        w_mod = toy_compile("""
+        def foo(t, k):
+            total = 0
+            for x in t:
+                total = total + k
+            return total
+        """)
+        code = w_mod.globals_w['foo'].code
+        assert licm(code) is code
+
+    def test_unroll_not_hoisted(self):
+        # each iteration needs a fresh iterator
+        w_mod = toy_compile("""
+        def foo(t):
+            TUP = (1, 2)
+            total = 0
+            for x in t:
+                for Y in UNROLL(TUP):
+                    total = total + x * Y
+            return total
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_foo2 = hoisted(w_foo)
+        assert w_foo2.call(w_ints(1, 2)) == W_Int(9)
+
+    def test_peval_output(self):
+        w_mod = toy_compile("""
+        @green
+        def SCALE():
+            return 3
+
+        def foo(t, k):
+            total = 0
+            for x in t:
+                total = total + x + k * SCALE()
+            return total
+        """)
+        w_foo = peval(w_mod.globals_w['foo'])
+        w_foo2 = hoisted(w_foo)
+        body = w_foo2.code.body
+        pc_for = [op.name for op in body].index('for_iter')
+        assert [op.name for op in body[pc_for+1:pc_for+5]] == [
+            'load_local', 'load_const', 'mul', 'store_local']
+        assert w_foo2.call(w_ints(1, 2), W_Int(5)) == W_Int(33)
@@ -0,0 +1,71 @@
+import pickle
+from toyvm.objects import W_Str, W_Int
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Tuple
+
+class TestW_Str:
+
+    def test_concat(self):
+        w_a = W_Str('a' * 100)
+        w_b = w_a.concat(W_Str('b'))
+        assert w_b._value is None
+        assert w_b.length == 101
+        assert w_b == W_Str('a' * 100 + 'b')
+        assert w_b._value == 'a' * 100 + 'b'
+
+    def test_short_concat_is_eager(self):
+        w_res = W_Str('a').concat(W_Str('b'))
+        assert w_res._value == 'ab'
+
+    def test_builder_shared(self):
+        w_s = W_Str('x' * 100).concat(W_Str('a'))
+        w_a = w_s.concat(W_Str('b'))
+        w_b = w_s.concat(W_Str('c'))   # w_s's parts were already extended
+        assert w_a.value == 'x' * 100 + 'ab'
+        assert w_b.value == 'x' * 100 + 'ac'
+        assert w_s.value == 'x' * 100 + 'a'
+
+    def test_repeat(self):
+        w_s = W_Str('ab').repeat(1000)
+        assert w_s._value is None
+        assert w_s.length == 2000
+        assert w_s.str() == 'ab' * 1000
+        assert W_Str('ab').repeat(-1) == W_Str('')
+
+    def test_long_loop(self):
+        w_s = W_Str('')
+        for i in range(100000):
+            w_s = w_s.concat(W_Str('x'))
+        assert w_s.value == 'x' * 100000
+
+    def test_eq_repr_pickle(self):
+        w_s = W_Str('a' * 50).concat(W_Str('b' * 50))
+        assert repr(w_s) == f"W_Str('{'a' * 50}{'b' * 50}')"
+        assert w_s != W_Int(3)
+        w_s2 = pickle.loads(pickle.dumps(w_s))
+        assert w_s2 == w_s
+        assert w_s2._value is not None
+
+    def test_string_building(self):
+        w_mod = toy_compile("""
+        def foo(items):
+            OUT = ""
+            out = ""
+            for x in items:
+                out = out + x + ","
+            for X in UNROLL(("a", "b", "c")):
+                OUT = OUT + X * 30
+            return (out, OUT)
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_items = W_Tuple([W_Str(str(i)) for i in range(1000)])
+        expected = ''.join(f'{i},' for i in range(1000))
+        for w_func in (w_foo, peval(w_foo)):
+            w_res = w_func.call(w_items)
+            assert w_res.items_w[0].value == expected
+            assert w_res.items_w[1].value == 'a'*30 + 'b'*30 + 'c'*30
+        # peval folded the green concatenation into a flat constant
+        w_const = [op.args[0] for op in peval(w_foo).code.body
+                   if op.name == 'load_const'][-2]
+        assert w_const == W_Str('a'*30 + 'b'*30 + 'c'*30)
@@ -0,0 +1,121 @@
+import pytest
+from toyvm import osr
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Tuple
+from toyvm.frame import Frame, FastFrame
+from toyvm.verifier import verify
+from toyvm.benchmarks.programs import BENCHMARKS
+
+SRC = """
+@green
+def SCALE():
+    return 3
+
+def f(t):
+    s = 0
+    for x in t:
+        s = s + x * SCALE()
+    return s
+"""
+
+def make_tuple(n):
+    return W_Tuple([W_Int(i) for i in range(n)])
+
+
+class TestOSR:
+
+    @pytest.fixture
+    def threshold(self, monkeypatch):
+        monkeypatch.setattr(osr, 'THRESHOLD', 5)
+
+    def test_osr(self, threshold):
+        w_mod = toy_compile(SRC)
+        w_f = w_mod.globals_w['f']
+        frame = w_f.make_frame(make_tuple(20))
+        assert frame.run() == W_Int(3 * sum(range(20)))
+        assert frame.code.name == 'f<peval>'
+        assert frame.backedges is None
+        # w_f itself is unchanged
+        assert w_f.code.name == 'f'
+        assert w_f.code.osr_target is frame.code
+
+    def test_global_changed(self, threshold):
+        w_mod = toy_compile(SRC + """
+@green
+def BIG():
+    return 100
+""")
+        w_f = w_mod.globals_w['f']
+        assert w_f.call(make_tuple(20)) == W_Int(3 * sum(range(20)))
+        assert w_f.code.osr_target
+        w_mod.globals_w['SCALE'] = w_mod.globals_w['BIG']
+        assert w_f.code.osr_target is None
+        frame = w_f.make_frame(make_tuple(20))
+        assert frame.run() == W_Int(100 * sum(range(20)))
+        assert frame.code.name == 'f<peval>'
+
+    def test_short_loop(self, threshold):
+        w_mod = toy_compile(SRC)
+        w_f = w_mod.globals_w['f']
+        frame = w_f.make_frame(make_tuple(3))
+        assert frame.run() == W_Int(9)
+        assert frame.code.name == 'f'
+        assert frame.backedges == 3
+
+    def test_disabled(self, threshold):
+        w_mod = toy_compile(SRC)
+        frame = Frame(w_mod.globals_w['f'], osr=False)
+        frame.locals['t'] = make_tuple(20)
+        frame.run()
+        assert frame.code.name == 'f'
+
+    def test_disabled_fastframe(self, threshold):
+        w_mod = toy_compile(SRC)
+        w_f = w_mod.globals_w['f']
+        verify(w_f.code)
+        frame = FastFrame(w_f, osr=False)
+        frame.locals['t'] = make_tuple(20)
+        assert frame.run() == W_Int(3 * sum(range(20)))
+        assert frame.code.name == 'f'
+        assert frame.backedges is None
+
+    def test_green_store_in_loop(self, threshold):
+        w_mod = toy_compile("""
+        def f(t):
+            N = 0
+            for x in t:
+                N = N + 1
+            return N
+        """)
+        w_f = w_mod.globals_w['f']
+        frame = w_f.make_frame(make_tuple(20))
+        assert frame.run() == W_Int(20)
+        assert frame.code.name == 'f'
+
+    def test_peval_fails(self, threshold):
+        w_mod = toy_compile("""
+        def f(t):
+            s = 0
+            for x in t:
+                s = s + x
+            for Y in UNROLL(t):
+                s = s + Y
+            return s
+        """)
+        w_f = w_mod.globals_w['f']
+        frame = w_f.make_frame(make_tuple(20))
+        assert frame.run() == W_Int(2 * sum(range(20)))
+        assert frame.code.name == 'f'
+        assert w_f.code.osr_target is False
+
+    @pytest.mark.parametrize('bench', BENCHMARKS,
+                             ids=[bench.name for bench in BENCHMARKS])
+    def test_same_results(self, bench, monkeypatch):
+        def run():
+            w_mod = toy_compile(bench.get_src(5))
+            w_main = w_mod.globals_w[bench.entry]
+            return w_main.call(*bench.make_args(5)).str()
+        monkeypatch.setattr(osr, 'THRESHOLD', 10**9)
+        expected = run()
+        monkeypatch.setattr(osr, 'THRESHOLD', 2)
+        assert run() == expected
@@ -0,0 +1,87 @@
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.opcode import OpCode, CodeObject, OPNUMS
+from toyvm.objects import W_Int, W_Tuple, W_Function
+from toyvm.packed import pack, PackedCode, PackedFrame
+from toyvm.scheduler import Task
+from toyvm.benchmarks.programs import BENCHMARKS
+
+def packed_func(w_func):
+    return W_Function(w_func.name, pack(w_func.code), w_func.closure)
+
+class TestPacked:
+
+    def test_encoding(self):
+        w_one = W_Int(1)
+        code = CodeObject('fn', ['a'], [
+            OpCode('load_local', 'a'),
+            OpCode('load_const', w_one),
+            OpCode('load_const', w_one),
+            OpCode('make_tuple', 2),
+            OpCode('store_local', 'a'),
+            OpCode('br', 'foo'),
+            OpCode('label', 'foo'),
+            OpCode('load_local', 'a'),
+            OpCode('return'),
+        ])
+        packed = pack(code)
+        assert isinstance(packed, PackedCode)
+        assert list(packed.co_code) == [
+            OPNUMS['load_local'], 0,
+            OPNUMS['load_const'], 0,
+            OPNUMS['load_const'], 0,
+            OPNUMS['make_tuple'], 2,
+            OPNUMS['store_local'], 0,
+            OPNUMS['br'], 0,
+            OPNUMS['label'], 0,
+            OPNUMS['load_local'], 0,
+            OPNUMS['return'],
+        ]
+        assert packed.consts == [w_one]
+        assert packed.names == ['a']
+        assert packed.labels == ['foo']
+        assert list(packed.label_offsets) == [12]
+
+    @pytest.mark.parametrize('bench', BENCHMARKS, ids=lambda b: b.name)
+    def test_roundtrip(self, bench):
+        w_mod = toy_compile(bench.get_src(5))
+        for w_func in w_mod.globals_w.values():
+            codes = [w_func.code]
+            if not w_func.is_green:
+                codes.append(peval(w_func).code)
+            for code in codes:
+                code2 = pack(code).unpack()
+                assert code2.name == code.name
+                assert code2.argnames == code.argnames
+                assert code2.freevars == code.freevars
+                assert code2.body == code.body
+                assert code2.dump() == code.dump()
+
+    @pytest.mark.parametrize('bench', BENCHMARKS, ids=lambda b: b.name)
+    def test_execute(self, bench):
+        w_mod = toy_compile(bench.get_src(5))
+        w_func = w_mod.globals_w[bench.entry]
+        args_w = bench.make_args(5)
+        w_packed = packed_func(w_func)
+        frame = w_packed.make_frame(*args_w)
+        assert isinstance(frame, PackedFrame)
+        assert w_packed.call(*args_w) == w_func.call(*args_w)
+
+    def test_resume(self):
+        w_mod = toy_compile("""
+        def foo(tup):
+            t = 0
+            for x in tup:
+                t = t + inc(x)
+            return t
+
+        def inc(x):
+            return x + 1
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_mod.globals_w['inc'] = packed_func(w_mod.globals_w['inc'])
+        task = Task(packed_func(w_foo), [W_Tuple([W_Int(1), W_Int(2)])])
+        while not task.run_slice(3):
+            pass
+        assert task.w_result == W_Int(5)
@@ -0,0 +1,79 @@
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int
+from toyvm.parallel import (peval_module, dependency_graph, compute_waves,
+                            _dumps, _loads)
+
+SRC = """
+@green
+def FUNCS():
+    return (inc, double)
+
+@green
+def TABLE():
+    return (1, 2, 3)
+
+def inc(x):
+    for K in UNROLL(TABLE()):
+        x = x + K
+    return x
+
+def double(x):
+    return x * 2
+
+def main(x):
+    for F in UNROLL(FUNCS()):
+        x = F(x)
+    return helper(x)
+
+def helper(x):
+    return x + 1
+"""
+
+class TestParallel:
+
+    def test_dependency_graph(self):
+        w_mod = toy_compile(SRC)
+        deps = dependency_graph(w_mod, ['inc', 'double', 'main', 'helper'])
+        # helper is called through load_nonlocal: no dependency
+        assert deps == {
+            'inc': set(),
+            'double': set(),
+            'main': {'inc', 'double'},
+            'helper': set(),
+        }
+        assert compute_waves(deps) == [['double', 'helper', 'inc'],
+                                       ['main']]
+
+    def test_compute_waves_cycle(self):
+        deps = {'a': {'b'}, 'b': {'a'}, 'c': set(), 'd': {'a'}}
+        assert compute_waves(deps) == [['c'], ['a', 'b', 'd']]
+
+    def test_pickle_wiring(self):
+        w_mod = toy_compile(SRC)
+        w_main = w_mod.globals_w['main']
+        w_main2 = _loads(_dumps(w_main, w_mod, by_value={'main'}), w_mod)
+        assert w_main2 is not w_main
+        assert w_main2.code.dump() == w_main.code.dump()
+        assert w_main2.closure.scopes[0] is w_mod.globals_w
+        #
+        w_mod2 = toy_compile(SRC)
+        w_main3 = _loads(_dumps(w_main, w_mod), w_mod2)
+        assert w_main3 is w_mod2.globals_w['main']
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_peval_module(self, workers):
+        w_mod = toy_compile(SRC)
+        w_FUNCS = w_mod.globals_w['FUNCS']
+        stats = peval_module(w_mod, workers=workers)
+        assert stats.loops_unrolled == 2
+        assert w_mod.globals_w['FUNCS'] is w_FUNCS # green: not pevaled
+        w_main = w_mod.globals_w['main']
+        w_inc = w_mod.globals_w['inc']
+        assert w_main.code.name == 'main<peval>'
+        assert w_inc.code.name == 'inc<peval>'
+        # main contains the specialized version of inc
+        consts = [op.args[0] for op in w_main.code.body
+                  if op.name == 'load_const']
+        assert consts[0] is w_inc
+        assert w_main.call(W_Int(1)) == W_Int(15)
@@ -0,0 +1,66 @@
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Str
+from toyvm import quicken
+
+class TestQuicken:
+
+    def compile(self, src):
+        w_mod = toy_compile(src)
+        return list(w_mod.globals_w.values())[0]
+
+    def quickened(self, w_func):
+        return [op.name for op in w_func.code.quickened]
+
+    def test_specialize(self):
+        w_func = self.compile("""
+        def foo(a, b):
+            return a + b * a
+        """)
+        assert w_func.call(W_Int(2), W_Int(3)) == W_Int(8)
+        assert self.quickened(w_func)[:5] == [
+            'load_local', 'load_local', 'load_local', 'mul_int', 'add_int']
+        # code.body is untouched
+        assert [op.name for op in w_func.code.body][3:5] == ['mul', 'add']
+        assert w_func.call(W_Int(3), W_Int(4)) == W_Int(15)
+        stats = quicken.get_stats(w_func.code)
+        assert list(stats) == [3, 4]
+        assert stats[4].opname == 'add'
+        assert stats[4].current == 'add_int'
+        assert stats[4].specializations == 1
+        assert stats[4].deopts == 0
+
+    def test_deoptimize(self):
+        w_func = self.compile("""
+        def foo(a, b):
+            return a + b
+        """)
+        assert w_func.call(W_Int(2), W_Int(3)) == W_Int(5)
+        assert self.quickened(w_func)[2] == 'add_int'
+        assert w_func.call(W_Str('a'), W_Str('b')) == W_Str('ab')
+        assert self.quickened(w_func)[2] == 'add_str'
+        stats = quicken.get_stats(w_func.code)[2]
+        assert stats.specializations == 2
+        assert stats.deopts == 1
+
+    def test_megamorphic(self):
+        w_func = self.compile("""
+        def foo(a, b):
+            return a < b
+        """)
+        for i in range(quicken.MAX_DEOPTS + 1):
+            assert w_func.call(W_Int(2), W_Int(3)) == W_Int(True)
+            assert w_func.call(W_Str('b'), W_Str('a')) == W_Int(False)
+        assert self.quickened(w_func)[2] == 'lt'
+        stats = quicken.get_stats(w_func.code)[2]
+        assert stats.is_megamorphic()
+        assert 'megamorphic' in quicken.format_stats(w_func.code)
+
+    def test_mul_str(self):
+        w_func = self.compile("""
+        def foo(a, b):
+            return a * b
+        """)
+        assert w_func.call(W_Str('x'), W_Int(3)) == W_Str('xxx')
+        assert self.quickened(w_func)[2] == 'mul_str'
+        assert w_func.call(W_Str('y'), W_Int(2)) == W_Str('yy')
+        assert quicken.get_stats(w_func.code)[2].deopts == 0
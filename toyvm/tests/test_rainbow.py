@@ -1,5 +1,7 @@
 import pytest
-from toyvm.rainbow import RainbowInterpreter
+from toyvm import rainbow
+from toyvm.rainbow import (RainbowInterpreter, peval, peval_with_stats,
+                           PevalBudget)
 from toyvm.opcode import OpCode, CodeObject
 from toyvm.objects import W_Int, W_Str, W_Function, W_Tuple, w_None
 from toyvm.compiler import toy_compile
@@ -151,14 +153,21 @@ class TestRainbow:
             OpCode('return'),
         ]
 
-    def test_green_locals_sanity_check(self):
+    def test_store_red_in_green_local(self):
+        # B becomes red
         code = CodeObject('fn', [], [
             OpCode('load_local', 'a'),
             OpCode('store_local_green', 'B'),
+            OpCode('load_local_green', 'B'),
+            OpCode('return'),
         ])
-        with pytest.raises(AssertionError,
-                           match='store_local_green called on a red'):
-            self.peval(code)
+        code2 = self.peval(code)
+        assert code2.body == [
+            OpCode('load_local', 'a'),
+            OpCode('store_local', 'B'),
+            OpCode('load_local', 'B'),
+            OpCode('return'),
+        ]
 
     def test_unroll(self):
         w_tup = W_Tuple([W_Int(2), W_Int(3)])
@@ -200,3 +209,417 @@ class TestRainbow:
             OpCode('load_local', 'a'),
             OpCode('return')
         ]
+
+    def test_green_tail_call(self):
+        w_mod = toy_compile("""
+        def foo():
+            return INC(5)
+
+        @green
+        def INC(x):
+            return x + 1
+        """)
+        self.interp = RainbowInterpreter(w_mod.globals_w['foo'])
+        self.interp.run()
+        assert self.interp.out.body == [
+            OpCode('load_const', W_Int(6)),
+            OpCode('return'),
+            OpCode('load_const', w_None),
+            OpCode('return'),
+        ]
+
+    def test_red_tail_call(self):
+        code = CodeObject('fn', [], [
+            OpCode('load_local', 'f'),
+            OpCode('load_const', W_Int(1)),
+            OpCode('load_const', W_Int(2)),
+            OpCode('add'),
+            OpCode('tail_call', 1),
+        ])
+        code2 = self.peval(code)
+        assert code2.body == [
+            OpCode('load_local', 'f'),
+            OpCode('load_const', W_Int(3)),
+            OpCode('tail_call', 1),
+        ]
+
+
+class TestPevalBudget:
+
+    NESTED = """
+    def foo():
+        OUT = ""
+        for R in UNROLL(("1", "2", "3")):
+            for C in UNROLL(("a", "b")):
+                OUT = OUT + C + R
+        return OUT
+    """
+
+    CLOSURE = """
+    def foo(a):
+        return make_adder(5)(a)
+
+    @green
+    def make_adder(X):
+        def add(y):
+            return X + y
+        return add
+    """
+
+    def test_stats(self):
+        w_mod = toy_compile(self.NESTED)
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert w_foo.call() == W_Str('a1b1a2b2a3b3')
+        assert stats.loops_unrolled == 4 # the outer loop + 3 inner loops
+        assert stats.labels_created == 6 # for_1, endfor_1 per outer iteration
+        assert stats.ops_emitted == len(w_foo.code.body)
+        assert stats.ops_folded > 0
+        assert stats.green_calls == 0
+        assert stats.fallbacks == []
+        assert stats.time > 0
+
+    def test_max_ops(self):
+        w_mod = toy_compile(self.NESTED)
+        w_foo = w_mod.globals_w['foo']
+        budget = PevalBudget(max_ops=3)
+        w_foo2, stats = peval_with_stats(w_foo, budget=budget)
+        assert w_foo2 is w_foo
+        assert stats.fallbacks == ['foo: more than 3 ops']
+        assert stats.ops_emitted == 0
+        #
+        budget = PevalBudget(max_ops=100)
+        assert peval(w_foo, budget=budget) is not w_foo
+
+    def test_max_unroll_depth(self):
+        w_mod = toy_compile(self.NESTED)
+        w_foo = w_mod.globals_w['foo']
+        budget = PevalBudget(max_unroll_depth=1)
+        w_foo2, stats = peval_with_stats(w_foo, budget=budget)
+        assert w_foo2 is w_foo
+        assert stats.fallbacks == ['foo: unroll depth > 1']
+        #
+        budget = PevalBudget(max_unroll_depth=2)
+        assert peval(w_foo, budget=budget) is not w_foo
+
+    def test_max_peval_depth(self):
+        w_mod = toy_compile(self.CLOSURE)
+        w_foo = w_mod.globals_w['foo']
+        budget = PevalBudget(max_peval_depth=0)
+        w_foo2, stats = peval_with_stats(w_foo, budget=budget)
+        assert stats.green_calls == 1
+        assert stats.fallbacks == ['add: peval depth > 0']
+        w_add = w_foo2.code.body[0].args[0]
+        assert w_add.code.name == 'add' # not pevaled
+        assert w_foo2.call(W_Int(10)) == W_Int(15)
+        #
+        w_foo2, stats = peval_with_stats(w_foo)
+        w_add = w_foo2.code.body[0].args[0]
+        assert w_add.code.name == 'add<peval>'
+        assert stats.fallbacks == []
+
+
+class TestRedBrIf:
+
+    def check(self, src, *argss):
+        w_foo = toy_compile(src).globals_w['foo']
+        w_foo2 = peval(w_foo)
+        for args in argss:
+            args_w = [W_Int(arg) for arg in args]
+            assert w_foo2.call(*args_w) == w_foo.call(*args_w)
+        return w_foo2.code
+
+    def test_arms_dont_leak(self):
+        # the else arm sees X = 1, not the X = 2 of the then arm. Both arms
+        # end with X = 2, so X stays green
+        code = self.check("""
+        def foo(a):
+            X = 1
+            if a:
+                X = 2
+            else:
+                Y = X + 1
+                X = Y
+            return X
+        """, [0], [1])
+        assert code.equals("""
+          load_local a
+          br_if then_0 else_0 endif_0
+        then_0:
+          br endif_0
+        else_0:
+          load_const W_Int(2)
+          store_local Y
+        endif_0:
+          load_const W_Int(2)
+          return
+          load_const w_None
+          return
+        """)
+
+    def test_diverging_arms(self):
+        # X is stored at the end of both arms, before the 'br endif_0'
+        code = self.check("""
+        def foo(a):
+            X = 1
+            if a:
+                X = 2
+            else:
+                X = 3
+            X = X + 1
+            return X
+        """, [0], [1])
+        assert code.equals("""
+          load_local a
+          br_if then_0 else_0 endif_0
+        then_0:
+          load_const W_Int(2)
+          store_local X
+          br endif_0
+        else_0:
+          load_const W_Int(3)
+          store_local X
+        endif_0:
+          load_local X
+          load_const W_Int(1)
+          add
+          store_local X
+          load_local X
+          return
+          load_const w_None
+          return
+        """)
+
+    def test_dependent_local(self):
+        # X is red after the merge, so Y is red too
+        code = self.check("""
+        def foo(a):
+            X = 1
+            if a:
+                X = 2
+            Y = X + 1
+            return Y
+        """, [0], [1])
+        assert [op.name for op in code.body[-8:]] == [
+            'load_local', 'load_const', 'add', 'store_local',
+            'load_local', 'return', 'load_const', 'return']
+
+    def test_synthesized_else(self):
+        # X must be stored on the edge from br_if to endif_0 too
+        code = self.check("""
+        def foo(a):
+            X = 1
+            if a:
+                X = 2
+            return X * 10
+        """, [0], [1])
+        assert code.equals("""
+          load_local a
+          br_if then_0 endif_0_else endif_0
+        then_0:
+          load_const W_Int(2)
+          store_local X
+          br endif_0
+        endif_0_else:
+          load_const W_Int(1)
+          store_local X
+        endif_0:
+          load_local X
+          load_const W_Int(10)
+          mul
+          return
+          load_const w_None
+          return
+        """)
+
+    def test_arm_which_returns(self):
+        # the then arm doesn't reach endif_0, so X stays green
+        code = self.check("""
+        def foo(a):
+            X = 1
+            if a:
+                X = 2
+                return X
+            return X * 10
+        """, [0], [1])
+        assert 'store_local' not in [op.name for op in code.body]
+
+    def test_nested(self):
+        self.check("""
+        def foo(a, b):
+            X = 1
+            if a:
+                X = 2
+                if b:
+                    X = 5
+                    return X
+            else:
+                if b:
+                    X = 3
+            return X * 10
+        """, [0, 0], [0, 1], [1, 0], [1, 1])
+
+
+class TestCallSpecialization:
+
+    SRC = """
+    @green
+    def make_op():
+        def apply(x, op, k):
+            if op:
+                return x * k
+            return x + k
+        return apply
+
+    def foo(a):
+        APPLY = make_op()
+        return APPLY(a, 1, 3) + APPLY(a, 0, 5) + APPLY(a, 1, 3)
+    """
+
+    @pytest.fixture(autouse=True)
+    def cache(self, monkeypatch):
+        self.cache = rainbow.SpecializationCache(max_variants=8)
+        monkeypatch.setattr(rainbow, 'SPEC_CACHE', self.cache)
+
+    def get_callees(self, w_func):
+        return [op.args[0] for op in w_func.code.body
+                if op.name == 'load_const' and
+                isinstance(op.args[0], W_Function)]
+
+    def get_variants(self, w_mod):
+        # the variants are attached to the original code of apply
+        [code] = [op.args[0] for op in w_mod.globals_w['make_op'].code.body
+                  if op.name == 'make_function']
+        return self.cache.get_variants(code)
+
+    def test_specialize(self):
+        w_mod = toy_compile(self.SRC)
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert w_foo.call(W_Int(10)) == W_Int(30 + 15 + 30)
+        assert stats.calls_specialized == 3
+        w_a, w_b, w_c = self.get_callees(w_foo)
+        assert w_a is w_c # reused from the cache
+        assert w_a.code.name == 'apply<op=1,k=3><peval>'
+        assert w_a.code.equals("""
+        then_0:
+          load_local x
+          load_const W_Int(3)
+          mul
+          return
+        endif_0:
+          load_local x
+          load_const W_Int(3)
+          add
+          return
+          load_const w_None
+          return
+        """)
+        assert w_b.code.name == 'apply<op=0,k=5><peval>'
+
+    def test_repeated_pevals(self):
+        w_mod = toy_compile(self.SRC)
+        w_foo1 = peval(w_mod.globals_w['foo'])
+        for i in range(10):
+            w_foo2 = peval(w_mod.globals_w['foo'])
+        assert self.get_callees(w_foo1) == self.get_callees(w_foo2)
+        assert len(self.get_variants(w_mod)) == 2
+
+    def test_callee_global_changed(self):
+        w_mod = toy_compile("""
+        @green
+        def K():
+            return 3
+
+        def apply(x, op):
+            if op:
+                return x * K()
+            return x
+
+        @green
+        def get_op():
+            return apply
+
+        def foo(a):
+            APPLY = get_op()
+            return APPLY(a, 1)
+        """)
+        code = w_mod.globals_w['apply'].code
+        w_foo = peval(w_mod.globals_w['foo'])
+        assert w_foo.call(W_Int(10)) == W_Int(30)
+        assert len(self.cache.get_variants(code)) == 1
+        # the variant folded K()
+        w_mod.globals_w['K'] = toy_compile("""
+        @green
+        def K():
+            return 4
+        """).globals_w['K']
+        assert self.cache.get_variants(code) is None
+        w_foo = peval(w_mod.globals_w['foo'])
+        assert w_foo.call(W_Int(10)) == W_Int(40)
+
+    def test_reassigned_arg(self):
+        w_mod = toy_compile("""
+        @green
+        def make_op():
+            def apply(x, k):
+                k = k + x
+                return k
+            return apply
+
+        def foo(a):
+            APPLY = make_op()
+            return APPLY(a, 1)
+        """)
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert stats.calls_specialized == 0
+        assert w_foo.call(W_Int(10)) == W_Int(11)
+
+    def test_loop_variable_arg(self):
+        w_mod = toy_compile("""
+        @green
+        def make_op():
+            def last(n, t):
+                for n in t:
+                    print(n)
+                return n
+            return last
+
+        def foo(t):
+            LAST = make_op()
+            return LAST(3, t)
+        """)
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert stats.calls_specialized == 0
+        assert w_foo.call(W_Tuple([W_Int(5), W_Int(9)])) == W_Int(9)
+
+    def test_lru(self):
+        self.cache.max_variants = 2
+        w_mod = toy_compile("""
+        @green
+        def make_op():
+            def apply(x, k):
+                return x + k
+            return apply
+
+        def foo(a):
+            APPLY = make_op()
+            return (APPLY(a, 1), APPLY(a, 2), APPLY(a, 1), APPLY(a, 3),
+                    APPLY(a, 2))
+        """)
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert w_foo.call(W_Int(10)) == W_Tuple(
+            [W_Int(11), W_Int(12), W_Int(11), W_Int(13), W_Int(12)])
+        w_1, w_2, w_1b, w_3, w_2b = self.get_callees(w_foo)
+        assert w_1 is w_1b
+        # 2 was the least recently used when 3 was added
+        assert w_2 is not w_2b
+        assert self.cache.evictions == 2
+        assert len(self.get_variants(w_mod)) == 2
+
+    def test_disabled(self):
+        self.cache.max_variants = 0
+        w_mod = toy_compile(self.SRC)
+        w_foo, stats = peval_with_stats(w_mod.globals_w['foo'])
+        assert stats.calls_specialized == 0
+        callees = self.get_callees(w_foo)
+        assert len(callees) == 3
+        assert len({id(w_apply) for w_apply in callees}) == 1
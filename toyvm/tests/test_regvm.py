@@ -0,0 +1,103 @@
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Int, W_Tuple, W_Function
+from toyvm.trace import TraceRecorder
+from toyvm.regvm import RegCode, RegFrame, translate, count_insns
+from toyvm.scheduler import Task
+from toyvm.benchmarks.programs import BENCHMARKS
+
+BENCH_IDS = [bench.name for bench in BENCHMARKS]
+
+def to_regvm(w_func):
+    return W_Function(w_func.name, translate(w_func.code), w_func.closure)
+
+
+class TestTranslate:
+
+    def test_simple(self):
+        w_mod = toy_compile("""
+        def foo(a, b):
+            a = a + 1
+            return a * b
+        """)
+        code = translate(w_mod.globals_w['foo'].code)
+        assert isinstance(code, RegCode)
+        assert code.dump() == '\n'.join([
+            '  0: add a, a, W_Int(1)',
+            '  1: mul t0, a, b',
+            '  2: return t0'])
+
+    def test_loop(self):
+        w_mod = toy_compile("""
+        def foo(a, b):
+            for x in (1, 2):
+                a = a + x
+            return a + b
+        """)
+        w_foo = to_regvm(w_mod.globals_w['foo'])
+        assert w_foo.call(W_Int(1), W_Int(10)) == W_Int(14)
+
+    def test_call_frame(self):
+        w_mod = toy_compile("""
+        def foo(a, b):
+            if a < b:
+                return b
+            return a
+        """)
+        w_foo = to_regvm(w_mod.globals_w['foo'])
+        frame = w_foo.make_frame(W_Int(3), W_Int(5))
+        assert isinstance(frame, RegFrame)
+        assert frame.run() == W_Int(5)
+        assert w_foo.call(W_Int(7), W_Int(5)) == W_Int(7)
+
+    def test_resume(self):
+        w_mod = toy_compile("""
+        def foo(tup):
+            t = 0
+            for x in tup:
+                t = t + inc(x)
+            return last(t)
+
+        def inc(x):
+            return x + 1
+
+        def last(t):
+            return inc(t)
+        """)
+        for name in ('foo', 'inc', 'last'):
+            w_mod.globals_w[name] = to_regvm(w_mod.globals_w[name])
+        w_foo = w_mod.globals_w['foo']
+        task = Task(w_foo, [W_Tuple([W_Int(1), W_Int(2)])])
+        slices = 1
+        while not task.run_slice(3):
+            slices += 1
+        assert task.w_result == W_Int(6)
+        assert slices > 1
+
+
+class TestBenchmarks:
+
+    @pytest.mark.parametrize('bench', BENCHMARKS, ids=BENCH_IDS)
+    @pytest.mark.parametrize('use_peval', [False, True],
+                             ids=['compiler', 'peval'])
+    def test_same_result(self, bench, use_peval):
+        w_mod = toy_compile(bench.get_src(5))
+        w_func = w_mod.globals_w[bench.entry]
+        if use_peval:
+            w_func = peval(w_func)
+        args_w = bench.make_args(5)
+        expected = w_func.call(*args_w)
+        assert to_regvm(w_func).call(*args_w) == expected
+
+    @pytest.mark.parametrize('bench', BENCHMARKS, ids=BENCH_IDS)
+    def test_fewer_insns(self, bench):
+        w_mod = toy_compile(bench.get_src(5))
+        w_func = peval(w_mod.globals_w[bench.entry])
+        w_reg = to_regvm(w_func)
+        args_w = bench.make_args(5)
+        with TraceRecorder(1) as rec:
+            w_func.call(*args_w)
+        with count_insns() as c:
+            w_reg.call(*args_w)
+        assert c.count < rec.count
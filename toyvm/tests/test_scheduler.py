@@ -0,0 +1,94 @@
+import asyncio
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Tuple
+from toyvm.scheduler import Task, Scheduler, VM
+
+SRC = """
+def fib(i, n):
+    if n < i + 2:
+        return 1
+    return fib(i + 1, n) + fib(i + 2, n)
+
+def total(tup):
+    t = 0
+    for x in tup:
+        t = t + x
+    return t
+"""
+
+class TestScheduler:
+
+    def setup_method(self, meth):
+        self.w_mod = toy_compile(SRC)
+        self.w_fib = self.w_mod.globals_w['fib']
+        self.w_total = self.w_mod.globals_w['total']
+
+    def test_frame_resume(self):
+        frame = self.w_total.make_frame(W_Tuple([W_Int(1), W_Int(2)]))
+        assert frame.resume(3) == 3
+        assert frame.w_result is None
+        assert frame.pc == 3
+        while frame.w_result is None:
+            frame.resume(1)
+        assert frame.w_result == W_Int(3)
+
+    def test_frame_resume_call(self):
+        frame = self.w_fib.make_frame(W_Int(0), W_Int(5))
+        frame.resume(100)
+        assert frame.child is not None
+        assert frame.child.w_func is self.w_fib
+        assert frame.child.locals == {'i': W_Int(1), 'n': W_Int(5)}
+
+    def test_task(self):
+        task = Task(self.w_fib, [W_Int(0), W_Int(10)])
+        while not task.run_slice(7):
+            pass
+        assert task.w_result == W_Int(89)
+        assert task.w_result == self.w_fib.call(W_Int(0), W_Int(10))
+        assert task.slices == (task.steps + 6) // 7
+
+    def test_interleaving(self):
+        sched = Scheduler(slice_steps=10)
+        t_long = sched.spawn(self.w_fib, W_Int(0), W_Int(12))
+        t_short = sched.spawn(self.w_fib, W_Int(0), W_Int(2))
+        sched.run()
+        assert t_long.w_result == W_Int(233)
+        assert t_short.w_result == W_Int(2)
+        # the short task finished first, even if it was spawned later
+        assert sched.finished == [t_short, t_long]
+        stats = sched.stats()
+        assert stats['tasks'] == 2
+        assert 0 < stats['fairness'] <= 1
+
+    def test_asyncio(self):
+        vm = VM(slice_steps=5)
+        order = []
+
+        async def run(name, w_func, *args_w):
+            w_res = await vm.call(w_func, *args_w)
+            order.append(name)
+            return w_res
+
+        async def main():
+            return await asyncio.gather(
+                run('fib', self.w_fib, W_Int(0), W_Int(8)),
+                run('total', self.w_total, W_Tuple([W_Int(1), W_Int(2)])))
+
+        results = asyncio.run(main())
+        assert results == [W_Int(34), W_Int(3)]
+        assert order == ['total', 'fib']
+        assert vm.stats()['tasks'] == 2
+
+    def test_tail_call(self):
+        w_mod = toy_compile("""
+        def count(i, n):
+            if i < n:
+                return count(i + 1, n)
+            return i
+        """)
+        task = Task(w_mod.globals_w['count'], [W_Int(0), W_Int(50)])
+        max_frames = 0
+        while not task.run_slice(3):
+            max_frames = max(max_frames, len(task.frames))
+        assert task.w_result == W_Int(50)
+        assert max_frames == 1
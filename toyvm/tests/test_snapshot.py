@@ -0,0 +1,95 @@
+import pytest
+from toyvm import osr
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int, W_Str, W_Tuple, w_None
+from toyvm.opcode import CodeObject
+from toyvm.rainbow import peval
+from toyvm.snapshot import (save_image, load_image, dumps_image, loads_image,
+                            ImageError)
+
+SRC = """
+@green
+def make_adder(X):
+    def add(y):
+        return X + y
+    return add
+
+def foo(a):
+    return make_adder(5)(a)
+
+def bar(a):
+    return foo(a) * 2
+"""
+
+class TestSnapshot:
+
+    def make_heap(self):
+        w_mod = toy_compile(SRC)
+        w_mod.globals_w['foo'] = peval(w_mod.globals_w['foo'])
+        w_s = W_Str('x' * 100).concat(W_Str('y' * 100)) # lazy
+        w_tup = W_Tuple([w_s, w_s, w_None])
+        return {'mod': w_mod, 'tup': w_tup}
+
+    @pytest.mark.parametrize('use_mmap', [False, True])
+    def test_roundtrip(self, tmpdir, use_mmap):
+        filename = str(tmpdir.join('heap.img'))
+        save_image(filename, self.make_heap())
+        heap = load_image(filename, use_mmap=use_mmap)
+        w_mod = heap['mod']
+        globals_w = w_mod.globals_w
+        w_foo = globals_w['foo']
+        w_bar = globals_w['bar']
+        assert w_foo.code.name == 'foo<peval>'
+        assert w_foo.call(W_Int(10)) == W_Int(15)
+        assert w_bar.call(W_Int(10)) == W_Int(30)
+        # cycles and sharing are preserved
+        assert w_foo.closure.scopes[0] is globals_w
+        assert w_bar.closure.scopes[0] is globals_w
+        w_add = w_foo.code.body[0].args[0]
+        assert w_add.code.name == 'add<peval>'
+        assert w_foo.code.verified is not None
+        items_w = heap['tup'].items_w
+        assert items_w[0] is items_w[1]
+        assert items_w[0].value == 'x' * 100 + 'y' * 100
+        assert items_w[2] is w_None
+
+    def test_caches_not_saved(self, monkeypatch):
+        monkeypatch.setattr(osr, 'THRESHOLD', 2)
+        w_mod = toy_compile("""
+        @green
+        def SCALE():
+            return 3
+
+        def f(t):
+            s = 0
+            for x in t:
+                s = s + x * SCALE()
+            return s
+        """)
+        w_t = W_Tuple([W_Int(i) for i in range(10)])
+        w_f = w_mod.globals_w['f']
+        assert w_f.call(w_t) == W_Int(135)
+        assert w_f.code.osr_target
+        assert w_f.code.quickened is not None
+        assert w_mod.globals_w.watchers['SCALE']
+        #
+        w_mod2 = loads_image(dumps_image(w_mod))
+        w_f2 = w_mod2.globals_w['f']
+        for name in CodeObject.PROCESS_CACHES:
+            assert getattr(w_f2.code, name) is None
+        assert w_f2.code.verified is not None
+        assert not w_mod2.globals_w.watchers
+        # the caches are rebuilt
+        assert w_f2.call(w_t) == W_Int(135)
+        assert w_f2.code.osr_target
+        assert w_mod2.globals_w.watchers['SCALE']
+
+    def test_bad_image(self):
+        data = dumps_image([1, 2, 3])
+        assert loads_image(data) == [1, 2, 3]
+        with pytest.raises(ImageError, match='not a toyvm image'):
+            loads_image(b'X' + data[1:])
+        with pytest.raises(ImageError, match='wrong payload size'):
+            loads_image(data[:-1])
+        with pytest.raises(ImageError, match='truncated'):
+            loads_image(data[:3])
@@ -0,0 +1,457 @@
+import textwrap
+import pytest
+from toyvm.compiler import toy_compile
+from toyvm.rainbow import peval
+from toyvm.objects import W_Int, W_Tuple, W_Function
+from toyvm.ssa import build_ssa, cse, gvn, lower, optimize
+
+def w_ints(*values):
+    return W_Tuple([W_Int(v) for v in values])
+
+def get_code(src, name='foo'):
+    w_mod = toy_compile(src)
+    return w_mod.globals_w[name].code
+
+def check_dump(func, expected):
+    expected = textwrap.dedent(expected).strip('\n')
+    assert func.dump() == expected
+
+def optimized(w_func, passes=(gvn,)):
+    return W_Function(w_func.name, optimize(w_func.code, passes),
+                      w_func.closure)
+
+
+class TestBuildSSA:
+
+    def test_straight_line(self):
+        func = build_ssa(get_code("""
+        def foo(a, b):
+            c = a + b
+            c = c * c
+            return c + 1
+        """))
+        check_dump(func, """
+        b0:
+        b1: <- b0
+            v0 = add(a, b)
+            v1 = mul(v0, v0)
+            v2 = add(v1, W_Int(1))
+            return(v2)
+        """)
+
+    def test_phi(self):
+        func = build_ssa(get_code("""
+        def foo(a, b):
+            x = a
+            if a < b:
+                x = b
+            return x
+        """))
+        check_dump(func, """
+        b0:
+        b1: <- b0
+            v0 = lt(a, b)
+            br_if[then_0, endif_0, endif_0](v0)
+        then_0: <- b1
+        endif_0: <- b1, then_0
+            p1 = phi[x](a, b)
+            return(p1)
+        """)
+
+    def test_loop(self):
+        func = build_ssa(get_code("""
+        def foo(items, k):
+            total = 0
+            for x in items:
+                total = total + x * k
+            return total
+        """))
+        # k is not modified by the loop, so it doesn't need a phi
+        check_dump(func, """
+        b0:
+        b1: <- b0
+            get_iter[@iter_0](items)
+        for_0: <- b1, b3
+            p1 = phi[total](W_Int(0), v4)
+            for_iter[@iter_0, x, endfor_0]
+        endfor_0: <- for_0
+            return(p1)
+        b3: <- for_0
+            v3 = mul(x, k)
+            v4 = add(p1, v3)
+            br[for_0]
+        """)
+
+    def test_effects(self):
+        func = build_ssa(get_code("""
+        def foo(a):
+            print(a)
+            return bar(a) + 1
+        """))
+        check_dump(func, """
+        b0:
+        b1: <- b0
+            v0 = print[1](a)
+            v1 = load_nonlocal[bar]
+            v2 = call[1](v1, a)
+            v3 = add(v2, W_Int(1))
+            return(v3)
+        """)
+
+
+class TestPasses:
+
+    def test_cse(self):
+        func = build_ssa(get_code("""
+        def foo(a, b):
+            return (a * b + 1) * (a * b + 1)
+        """))
+        assert cse(func) == 2
+        check_dump(func, """
+        b0:
+        b1: <- b0
+            v0 = mul(a, b)
+            v1 = add(v0, W_Int(1))
+            v4 = mul(v1, v1)
+            return(v4)
+        """)
+
+    def test_cse_consts(self):
+        func = build_ssa(get_code("""
+        def foo(a):
+            return (a + 1) * (a + 1) * (a + 2)
+        """))
+        assert cse(func) == 1
+
+    def test_no_cse_of_effects(self):
+        func = build_ssa(get_code("""
+        def foo(a):
+            return bar(a) + bar(a)
+        """))
+        assert cse(func) == 0
+        assert gvn(func) == 0
+
+    def test_cse_is_local(self):
+        src = """
+        def foo(a, b):
+            x = a * b
+            if a < b:
+                x = x + a * b
+            return x
+        """
+        func = build_ssa(get_code(src))
+        assert cse(func) == 0
+        func = build_ssa(get_code(src))
+        assert gvn(func) == 1
+        check_dump(func, """
+        b0:
+        b1: <- b0
+            v0 = mul(a, b)
+            v1 = lt(a, b)
+            br_if[then_0, endif_0, endif_0](v1)
+        then_0: <- b1
+            v3 = add(v0, v0)
+        endif_0: <- b1, then_0
+            p4 = phi[x](v0, v3)
+            return(p4)
+        """)
+
+    def test_gvn_siblings(self):
+        # the two arms don't dominate each other
+        func = build_ssa(get_code("""
+        def foo(a, b):
+            if a < b:
+                x = a * b
+            else:
+                x = a * b + 1
+            return x
+        """))
+        assert gvn(func) == 0
+
+
+class TestLowering:
+
+    def roundtrip(self, src, passes=(gvn,)):
+        code = get_code(src)
+        func = build_ssa(code)
+        for p in passes:
+            p(func)
+        return lower(func)
+
+    def test_same_code(self):
+        # without redundancies, we get back the original code, minus the
+        # unreachable ops
+        code = self.roundtrip("""
+        def foo(rows, cols):
+            total = 0
+            for r in rows:
+                for c in cols:
+                    total = total + r * c
+            return total
+        """)
+        assert code.equals("""
+          load_local rows
+          get_iter @iter_0
+          load_const W_Int(0)
+          store_local total
+        for_0:
+          for_iter @iter_0 r endfor_0
+          load_local cols
+          get_iter @iter_1
+        for_1:
+          for_iter @iter_1 c endfor_1
+          load_local total
+          load_local r
+          load_local c
+          mul
+          add
+          store_local total
+          br for_1
+        endfor_1:
+          br for_0
+        endfor_0:
+          load_local total
+          return
+        """)
+
+    def test_copy_propagation(self):
+        code = self.roundtrip("""
+        def foo(a):
+            b = a
+            c = b + 1
+            d = c
+            return d
+        """)
+        assert code.equals("""
+          load_local a
+          load_const W_Int(1)
+          add
+          return
+        """)
+
+    def test_materialize(self):
+        code = self.roundtrip("""
+        def foo(a, b):
+            x = a * b
+            if a < b:
+                x = x + a * b
+            return x
+        """)
+        assert code.equals("""
+          load_local a
+          load_local b
+          mul
+          store_local x
+          load_local a
+          load_local b
+          lt
+          br_if then_0 endif_0 endif_0
+        then_0:
+          load_local x
+          load_local x
+          add
+          store_local x
+        endif_0:
+          load_local x
+          return
+        """)
+
+    def test_store_in_place(self):
+        # the new total is used twice, so it's stored: directly into the
+        # local of the phi, because the old total is dead by then
+        code = self.roundtrip("""
+        def foo(items):
+            total = 0
+            for x in items:
+                total = total + x
+                print(total)
+            return total
+        """)
+        assert code.equals("""
+          load_local items
+          get_iter @iter_0
+          load_const W_Int(0)
+          store_local total
+        for_0:
+          for_iter @iter_0 x endfor_0
+          load_local total
+          load_local x
+          add
+          store_local total
+          load_local total
+          print 1
+          pop
+          br for_0
+        endfor_0:
+          load_local total
+          return
+        """)
+
+    def test_critical_edge(self):
+        # n is still needed after the if, so the phi needs its own local,
+        # which is assigned on the edge from the br_if to endif_0
+        code = self.roundtrip("""
+        def foo(n, c):
+            m = n
+            if c:
+                n = n + 1
+            return m + n
+        """)
+        assert code.equals("""
+          load_local c
+          br_if then_0 edge_0 endif_0
+        then_0:
+          load_local n
+          load_const W_Int(1)
+          add
+          store_local @n_0
+        endif_0:
+          load_local n
+          load_local @n_0
+          add
+          return
+        edge_0:
+          load_local n
+          store_local @n_0
+          br endif_0
+        """)
+        w_foo = W_Function('foo', code, None)
+        assert w_foo.call(W_Int(5), W_Int(1)) == W_Int(11)
+        assert w_foo.call(W_Int(5), W_Int(0)) == W_Int(10)
+
+    def test_swap(self):
+        code = self.roundtrip("""
+        def foo(items, a, b):
+            for i in items:
+                t = a
+                a = b
+                b = t
+            return a
+        """)
+        assert code.equals("""
+          load_local items
+          get_iter @iter_0
+        for_0:
+          for_iter @iter_0 i endfor_0
+          load_local b
+          load_local a
+          store_local b
+          store_local a
+          br for_0
+        endfor_0:
+          load_local a
+          return
+        """)
+        w_foo = W_Function('foo', code, None)
+        assert w_foo.call(w_ints(1, 2, 3), W_Int(10), W_Int(20)) == W_Int(20)
+
+    def test_effects_order(self):
+        code = self.roundtrip("""
+        def foo(x):
+            print(x)
+            y = bar(x) + bar(x)
+            bar(x)
+            return y
+        """)
+        assert code.equals("""
+          load_local x
+          print 1
+          pop
+          load_nonlocal bar
+          load_local x
+          call 1
+          load_nonlocal bar
+          load_local x
+          call 1
+          add
+          store_local @v5
+          load_nonlocal bar
+          load_local x
+          call 1
+          pop
+          load_local @v5
+          return
+        """)
+
+    def test_dead_code(self):
+        code = self.roundtrip("""
+        def foo(a):
+            unused = a * 2
+            b = a
+            if b < 3:
+                return b
+            return 3
+        """)
+        assert code.equals("""
+          load_local a
+          load_const W_Int(3)
+          lt
+          br_if then_0 endif_0 endif_0
+        then_0:
+          load_local a
+          return
+        endif_0:
+          load_const W_Int(3)
+          return
+        """)
+
+    def test_reused_loop_variable(self):
+        w_mod = toy_compile("""
+        def foo(xs, ys):
+            total = 0
+            for x in xs:
+                total = total + x
+            for x in ys:
+                total = total * x
+            return total + x
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_foo2 = optimized(w_foo)
+        assert w_foo2.code is not w_foo.code
+        assert w_foo2.call(w_ints(1, 2), w_ints(3, 4)) == W_Int(40)
+
+
+class TestOptimize:
+
+    def test_unsupported(self):
+        code = get_code("""
+        def foo(a):
+            X = 3
+            return a + X
+        """)
+        assert optimize(code) is code
+
+    @pytest.mark.parametrize('passes', [(), (cse,), (gvn,)],
+                             ids=['none', 'cse', 'gvn'])
+    def test_peval(self, passes):
+        w_mod = toy_compile("""
+        def foo(items, k):
+            total = 0
+            for x in items:
+                if x * k < 10:
+                    total = total + (x * k + 1) * (x * k + 1)
+                else:
+                    total = total + x * k
+            return total
+        """)
+        w_foo = peval(w_mod.globals_w['foo'])
+        w_foo2 = optimized(w_foo, passes)
+        args_w = [w_ints(1, 2, 3, 4, 5), W_Int(3)]
+        assert w_foo2.call(*args_w) == w_foo.call(*args_w) == W_Int(192)
+        assert len(w_foo2.code.body) < len(w_foo.code.body)
+
+    def test_gvn_shrinks_more(self):
+        w_mod = toy_compile("""
+        def foo(items, k):
+            total = 0
+            for x in items:
+                if x * k < 10:
+                    total = total + (x * k + 1) * (x * k + 1)
+                else:
+                    total = total + x * k
+            return total
+        """)
+        code = peval(w_mod.globals_w['foo']).code
+        sizes = [len(optimize(code, passes).body)
+                 for passes in [(), (cse,), (gvn,)]]
+        assert sizes[0] > sizes[1] > sizes[2]
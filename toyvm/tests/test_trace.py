@@ -0,0 +1,66 @@
+from toyvm.compiler import toy_compile
+from toyvm.objects import W_Int
+from toyvm import trace
+from toyvm.trace import TraceRecorder
+
+SRC = """
+def foo(a, b):
+    c = a + b
+    return c
+"""
+
+class TestTrace:
+
+    def setup_method(self, meth):
+        self.w_foo = toy_compile(SRC).globals_w['foo']
+
+    def test_off(self):
+        assert trace.current is None
+        frame = self.w_foo.make_frame(W_Int(1), W_Int(2))
+        assert frame.tracer is None
+
+    def test_record(self):
+        with TraceRecorder(100) as rec:
+            assert trace.current is rec
+            self.w_foo.call(W_Int(1), W_Int(2))
+        assert trace.current is None
+        records = list(rec.records())
+        code = self.w_foo.code
+        assert [r[0] for r in records] == [code] * 5
+        assert [(pc, name, depth) for _, pc, name, depth, _ in records] == [
+            (0, 'load_local', 0),
+            (1, 'load_local', 1),
+            (2, 'add', 2),
+            (3, 'store_local', 1),
+            (4, 'load_local', 0),
+        ]
+        timestamps = [r[4] for r in records]
+        assert timestamps == sorted(timestamps)
+
+    def test_ring_buffer(self):
+        with TraceRecorder(3) as rec:
+            self.w_foo.call(W_Int(1), W_Int(2))
+            self.w_foo.call(W_Int(1), W_Int(2)) # now 'add' is quickened
+        assert rec.count == 10
+        assert len(rec) == 3
+        assert [r[2] for r in rec.records()] == [
+            'add_int', 'store_local', 'load_local']
+
+    def test_dump(self):
+        w_mod = toy_compile("""
+        def foo(a):
+            return inc(a)
+
+        def inc(x):
+            return x + 1
+        """)
+        w_foo = w_mod.globals_w['foo']
+        w_inc = w_mod.globals_w['inc']
+        with TraceRecorder() as rec:
+            w_foo.call(W_Int(1))
+            w_foo.call(W_Int(1))
+        lines = rec.dump(code=w_inc.code).splitlines()
+        assert len(lines) == 6
+        assert lines[0].split()[:4] == ['inc', '0:', 'load_local', 'x']
+        assert lines[5].split()[:3] == ['inc', '2:', 'add_int']
+        assert 'depth=2' in lines[5]
@@ -0,0 +1,150 @@
+import pytest
+from toyvm.opcode import OpCode, CodeObject
+from toyvm.objects import W_Int, W_Function
+from toyvm.frame import Frame, FastFrame
+from toyvm.verifier import verify, VerifyError
+from toyvm.compiler import toy_compile
+
+def make_code(*ops):
+    return CodeObject('fn', ['a'], list(ops))
+
+class TestVerifier:
+
+    def test_simple(self):
+        code = make_code(
+            OpCode('load_const', W_Int(2)),
+            OpCode('load_const', W_Int(4)),
+            OpCode('add'),
+            OpCode('return'),
+        )
+        info = verify(code)
+        assert code.verified is info
+        assert info.depths == [0, 1, 2, 1]
+        assert info.max_stack == 2
+
+    def test_emit_invalidates(self):
+        code = make_code(
+            OpCode('load_const', W_Int(2)),
+            OpCode('return'),
+        )
+        verify(code)
+        code.emit(OpCode('abort', 'unreachable'))
+        assert code.verified is None
+
+    def test_br_if(self):
+        code = make_code(
+            OpCode('load_local', 'a'),
+            OpCode('br_if', 'then_0', 'else_0', 'endif_0'),
+            OpCode('label', 'then_0'),
+            OpCode('load_const', W_Int(3)),
+            OpCode('return'),
+            OpCode('label', 'else_0'),
+            OpCode('load_const', W_Int(4)),
+            OpCode('return'),
+            OpCode('label', 'endif_0'),
+            OpCode('abort', 'unreachable'),
+        )
+        info = verify(code)
+        assert info.labels == {'then_0': 2, 'else_0': 5, 'endif_0': 8}
+        assert info.depths == [0, 1, 0, 0, 1, 0, 0, 1, None, None]
+
+    def test_underflow(self):
+        code = make_code(
+            OpCode('load_const', W_Int(2)),
+            OpCode('add'),
+            OpCode('return'),
+        )
+        with pytest.raises(VerifyError, match='stack underflow at pc 1'):
+            verify(code)
+
+    def test_call_pops_callable(self):
+        code = make_code(
+            OpCode('load_local', 'a'),
+            OpCode('call', 0),
+            OpCode('return'),
+        )
+        info = verify(code)
+        assert info.depths == [0, 1, 1]
+
+    def test_wrong_return(self):
+        code = make_code(
+            OpCode('load_const', W_Int(2)),
+            OpCode('load_const', W_Int(2)),
+            OpCode('return'),
+        )
+        with pytest.raises(VerifyError, match='wrong stack size upon return'):
+            verify(code)
+
+    def test_no_return(self):
+        code = make_code(
+            OpCode('load_const', W_Int(2)),
+            OpCode('pop'),
+        )
+        with pytest.raises(VerifyError, match='no return'):
+            verify(code)
+
+    def test_unknown_label(self):
+        code = make_code(
+            OpCode('br', 'foo'),
+        )
+        with pytest.raises(VerifyError, match='unknown label at pc 0: foo'):
+            verify(code)
+
+    def test_duplicate_label(self):
+        code = make_code(
+            OpCode('label', 'foo'),
+            OpCode('label', 'foo'),
+        )
+        with pytest.raises(VerifyError, match='duplicate label: foo'):
+            verify(code)
+
+    def test_inconsistent_depth(self):
+        code = make_code(
+            OpCode('load_local', 'a'),
+            OpCode('br_if', 'then_0', 'endif_0', 'endif_0'),
+            OpCode('label', 'then_0'),
+            OpCode('load_const', W_Int(3)),
+            OpCode('label', 'endif_0'),
+            OpCode('return'),
+        )
+        with pytest.raises(VerifyError, match='inconsistent stack depth'):
+            verify(code)
+
+    def test_compiler_output_is_verified(self):
+        w_mod = toy_compile("""
+        @green
+        def make_adder(X):
+            def add(y):
+                return X + y
+            return add
+        """)
+        w_make_adder = w_mod.globals_w['make_adder']
+        assert w_make_adder.code.verified is not None
+        inner_code = w_make_adder.code.body[0].args[0]
+        assert inner_code.name == 'add'
+        assert inner_code.verified is not None
+
+
+class TestFastFrame:
+
+    def test_run(self):
+        code = make_code(
+            OpCode('load_local', 'a'),
+            OpCode('br_if', 'then_0', 'else_0', 'endif_0'),
+            OpCode('label', 'then_0'),
+            OpCode('load_const', W_Int(3)),
+            OpCode('return'),
+            OpCode('label', 'else_0'),
+            OpCode('load_const', W_Int(4)),
+            OpCode('return'),
+            OpCode('label', 'endif_0'),
+            OpCode('abort', 'unreachable'),
+        )
+        w_func = W_Function('fn', code, {})
+        with pytest.raises(AssertionError):
+            FastFrame(w_func)
+        verify(code)
+        frame = FastFrame(w_func)
+        frame.locals['a'] = W_Int(1)
+        assert frame.run() == W_Int(3)
+        assert w_func.call(W_Int(0)) == W_Int(4)
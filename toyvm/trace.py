@@ -0,0 +1,99 @@
+"""
+Lightweight recording of the last N executed instructions.
+
+A TraceRecorder stores (code, pc, opcode, stack depth, timestamp) records in
+a fixed-size ring buffer made of preallocated arrays, so that recording
+does not allocate any per-event object. Frames which are created while a
+recorder is active (see TraceRecorder.__enter__) record every op executed
+by Frame.run_op. When no recorder is active, the only cost is a check on
+each op.
+
+    with TraceRecorder(1000) as rec:
+        w_func.call(...)
+    print(rec.dump())
+"""
+
+import time
+from array import array
+from toyvm.opcode import OpCode, OPNAMES, OPNUMS
+
+# the recorder used by newly created frames, if any
+current = None
+
+
+class TraceRecorder:
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.code_ids = array('q', [0]) * size
+        self.pcs = array('i', [0]) * size
+        self.opnums = array('h', [0]) * size
+        self.depths = array('i', [0]) * size
+        self.timestamps = array('d', [0.0]) * size
+        self.count = 0  # total number of records, including overwritten ones
+        self.codes = {} # id(code) -> code; it also keeps the codes alive
+        self.prev = None
+
+    def __enter__(self):
+        global current
+        self.prev = current
+        current = self
+        return self
+
+    def __exit__(self, etype, evalue, tb):
+        global current
+        current = self.prev
+        self.prev = None
+
+    def record(self, code, pc, opname, depth):
+        i = self.count % self.size
+        code_id = id(code)
+        if code_id not in self.codes:
+            self.codes[code_id] = code
+        self.code_ids[i] = code_id
+        self.pcs[i] = pc
+        self.opnums[i] = OPNUMS[opname]
+        self.depths[i] = depth
+        self.timestamps[i] = time.perf_counter()
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+        self.codes.clear()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def records(self, code=None):
+        """
+        Yield (code, pc, opname, depth, timestamp) for the records still in
+        the buffer, from the oldest to the newest. If code is given, yield
+        only the records about it.
+        """
+        start = self.count - len(self)
+        for n in range(start, self.count):
+            i = n % self.size
+            rec_code = self.codes[self.code_ids[i]]
+            if code is not None and rec_code is not code:
+                continue
+            yield (rec_code, self.pcs[i], OPNAMES[self.opnums[i]],
+                   self.depths[i], self.timestamps[i])
+
+    def dump(self, code=None):
+        """
+        Render the records in the same style as CodeObject.dump(show_pc=True)
+        """
+        lines = []
+        t0 = None
+        for rec_code, pc, opname, depth, timestamp in self.records(code):
+            if t0 is None:
+                t0 = timestamp
+            op = rec_code.body[pc]
+            if op.name == opname:
+                text = op.str()
+            else:
+                # a quickened op: show what was actually executed
+                text = OpCode(opname).str()
+            lines.append(f'{rec_code.name:>12} {pc:3d}:   {text:<30} '
+                         f'depth={depth:<3d} +{(timestamp-t0)*1e6:.1f}us')
+        return '\n'.join(lines)
@@ -0,0 +1,114 @@
+from dataclasses import dataclass
+
+class VerifyError(Exception):
+    pass
+
+@dataclass
+class CodeInfo:
+    """
+    The result of the static verification of a CodeObject.
+
+    depths[pc] is the stack depth *before* executing the op at pc, or None
+    if the op is unreachable.
+    """
+    labels: dict[str, int]
+    depths: list
+    max_stack: int
+
+
+def verify(code):
+    """
+    Statically verify the given code object and all the code objects nested
+    inside it (e.g. the ones used by make_function).
+
+    Check that:
+
+      - labels are unique and all the branch targets exist;
+
+      - the stack never underflows, and every op is always reached with the
+        same stack depth, whatever path we take;
+
+      - every path ends with a return, and returns with exactly one item on
+        the stack (or with a tail_call, leaving nothing else on the
+        stack).
+
+    On success, return a CodeInfo and store it in code.verified, so that
+    the code can be executed by the faster FastFrame. On failure, raise
+    VerifyError.
+    """
+    labels = compute_labels(code)
+    n = len(code.body)
+    depths = [None] * n
+    max_stack = 0
+    pending = [(0, 0)] # (pc, depth)
+    while pending:
+        pc, depth = pending.pop()
+        if pc >= n:
+            raise VerifyError(f'{code.name}: no return at the end of the code')
+        if depths[pc] is not None:
+            if depths[pc] != depth:
+                raise VerifyError(f'{code.name}: inconsistent stack depth at '
+                                  f'pc {pc}: {depths[pc]} != {depth}')
+            continue
+        depths[pc] = depth
+        op = code.body[pc]
+        pops = op.num_pops()
+        if depth < pops:
+            raise VerifyError(f'{code.name}: stack underflow at pc {pc} '
+                              f'({op.str()})')
+        depth = depth - pops + op.num_pushes()
+        max_stack = max(max_stack, depth)
+        if op.name == 'return':
+            if depths[pc] != 1:
+                raise VerifyError(f'{code.name}: wrong stack size upon return '
+                                  f'at pc {pc}: {depths[pc]}')
+        elif op.name == 'tail_call':
+            if depth != 0:
+                raise VerifyError(f'{code.name}: wrong stack size upon '
+                                  f'tail_call at pc {pc}: {depths[pc]}')
+        elif op.name == 'abort':
+            pass
+        elif op.name == 'br':
+            pending.append((labels[op.args[0]], depth))
+        elif op.name == 'br_if':
+            then, else_, endif = op.args
+            pending.append((labels[else_], depth))
+            pending.append((labels[then], depth))
+        elif op.name == 'for_iter':
+            itername, targetname, endfor = op.args
+            pending.append((labels[endfor], depth))
+            pending.append((pc+1, depth))
+        else:
+            if op.name == 'make_function':
+                verify(op.args[0])
+            pending.append((pc+1, depth))
+    #
+    info = CodeInfo(labels, depths, max_stack)
+    code.verified = info
+    return info
+
+
+def compute_labels(code):
+    """
+    Return a dict mapping label names to pcs, and check that all the labels
+    used by branches exist
+    """
+    labels = {}
+    for pc, op in enumerate(code.body):
+        if op.name == 'label':
+            l = op.args[0]
+            if l in labels:
+                raise VerifyError(f'{code.name}: duplicate label: {l}')
+            labels[l] = pc
+    #
+    for pc, op in enumerate(code.body):
+        if op.name in ('br', 'br_if'):
+            targets = op.args
+        elif op.name == 'for_iter':
+            targets = [op.args[2]]
+        else:
+            continue
+        for l in targets:
+            if l not in labels:
+                raise VerifyError(f'{code.name}: unknown label at pc {pc}: {l}')
+    return labels